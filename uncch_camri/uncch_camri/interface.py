@@ -1,4 +1,5 @@
-from pynipt import Processor, InterfaceBuilder
+from pynipt import Processor
+from uncch_core.builder import InterfaceBuilder
 
 
 class Interface(Processor):
@@ -203,6 +204,7 @@ class Interface(Processor):
         itf.set_input(label='input', input_path=input_path, group_input=False, idx=file_idx,
                       filter_dict=filter_dict)
         itf.set_output(label='output')
+        itf.set_threading(max_threads=4, serial_fraction=0.2)
         itf.set_cmd("N4BiasFieldCorrection -i *[input] -o *[output]")
         itf.set_output_checker()  # default label='output'
         itf.run()
@@ -237,6 +239,7 @@ class Interface(Processor):
                              idx=0, filter_dict=filter_dict)
         itf.set_output(label='output')
         itf.set_output(label='tfmat', ext='aff12.1D')
+        itf.set_threading(max_threads=4, serial_fraction=0.3)
         itf.set_cmd("3dAllineate -prefix *[output] -onepass -EPI -base *[ref] -cmass+xy "
                     "-1Dmatrix_save *[tfmat] *[input]")
         itf.set_errterm(['ERROR'])
@@ -274,6 +277,7 @@ class Interface(Processor):
         itf.set_static_input(label='tfmat', input_path=ref_path,
                              idx=0, filter_dict=dict(ext='aff12.1D'))
         itf.set_output(label='output')
+        itf.set_threading(max_threads=4, serial_fraction=0.3)
         itf.set_cmd("3dAllineate -prefix *[output] -master *[ref] -1Dmatrix_apply *[tfmat] *[input]")
         itf.set_errterm(['ERROR'])
         itf.set_output_checker()  # default label='output'
@@ -310,6 +314,7 @@ class Interface(Processor):
         itf.set_output(label='tfmat', ext='aff12.1D')
         cmd = '3dAllineate -prefix *[output] -twopass -cmass+xy -zclip -conv 0.01 -base *[ref] ' \
               '-cost crM -check nmi -warp shr -1Dmatrix_save *[tfmat] *[input]'
+        itf.set_threading(max_threads=4, serial_fraction=0.3)
         itf.set_cmd(cmd)
         itf.set_errterm(['ERROR'])
         itf.set_output_checker()
@@ -347,6 +352,7 @@ class Interface(Processor):
                              idx=0, filter_dict=dict(ext='aff12.1D'))
         itf.set_output(label='output')
         cmd = '3dAllineate -prefix *[output] -master *[base] -warp shr -1Dmatrix_apply *[tfmat] *[input]'
+        itf.set_threading(max_threads=4, serial_fraction=0.3)
         itf.set_cmd(cmd)
         itf.set_errterm(['ERROR'])
         itf.set_output_checker()
@@ -367,13 +373,13 @@ class Interface(Processor):
             sub_code(str):      sub stepcode, one character, 0 or A-Z
             suffix(str):        suffix to identify the current step
         """
-        itf = InterfaceBuilder(self, n_threads=1)
+        itf = InterfaceBuilder(self)
         itf.init_step(title='SpatialNorm', mode='processing',
                       idx=step_idx, subcode=sub_code, suffix=suffix)
         itf.set_input(label='input', input_path=input_path, group_input=False, idx=file_idx,
                       filter_dict=dict(ext=img_ext))
         itf.set_var(label='ref', value=ref_path)
-        itf.set_var(label='thread', value=self._n_threads)
+        itf.set_threading(max_threads=8, serial_fraction=0.1, label='thread')
         itf.set_output(label='output', suffix='_', ext=False)
         itf.set_cmd("antsRegistrationSyN.sh -f *[ref] -m *[input] -o *[output] -n *[thread]")
         itf.set_output_checker(suffix='Warped', ext='nii.gz')
@@ -407,6 +413,7 @@ class Interface(Processor):
         itf.set_static_input(label='tfmat', input_path=ref_path,
                              idx=0, filter_dict=dict(ext='mat'))
         itf.set_output(label='output')
+        itf.set_threading(max_threads=4, serial_fraction=0.3)
         itf.set_cmd("WarpTimeSeriesImageMultiTransform 4 *[input] *[output] -R "
                     "*[base] *[tfmorph] *[tfmat]")
         itf.set_output_checker()
@@ -441,6 +448,7 @@ class Interface(Processor):
         itf.set_var(label='fwhm', value=str(fwhm))
         itf.set_var(label='mask', value=mask_path)
         itf.set_output(label='output')
+        itf.set_threading(max_threads=4, serial_fraction=0.3)
         itf.set_cmd("3dBlurInMask -prefix *[output] -FWHM *[fwhm] -mask *[mask] *[input]")
         itf.set_errterm(['ERROR'])
         itf.set_output_checker(label='output')
@@ -474,6 +482,7 @@ class Interface(Processor):
                       filter_dict=filter_dict, group_input=False)
         itf.set_var(label='fwhm', value=str(fwhm))
         itf.set_output(label='output')
+        itf.set_threading(max_threads=4, serial_fraction=0.3)
         itf.set_cmd("3dmerge -prefix *[output] -doall -1blur_fwhm *[fwhm] *[input]")
         itf.set_output_checker(label='output')
         itf.run()
@@ -564,6 +573,7 @@ class Interface(Processor):
         # set main output
         itf.set_output(label='output')
         itf.set_output(label='matrix', ext=False)
+        itf.set_threading(max_threads=4, serial_fraction=0.2)
         itf.set_cmd("3dDeconvolve -input *[input] -mask *[mask] "
                     "-num_stimts 1 -polort *[polort] -stim_times 1 '1D: *[onset_time]' "
                     "'*[model](*[parameters])' -stim_label 1 STIM -tout -bucket *[bucket] -x1D *[matrix]")
@@ -621,6 +631,7 @@ class Interface(Processor):
         itf.set_var(label='mask', value=mask_path)
         itf.set_output(label='resid', modifier=output_filename,
                        suffix='_resid', ext='nii.gz')
+        itf.set_threading(max_threads=8, serial_fraction=0.1)
         itf.set_cmd(f'3dttest++ -mask *[mask] -prefix *[output] {input_sets} '
                     f'-resid *[resid] -ACF {option}')
         itf.set_errterm(['ERROR'])
@@ -655,9 +666,8 @@ class Interface(Processor):
         """
 
         import re
-        import numpy as np
         import pandas as pd
-        from collections import OrderedDict
+        from uncch_core.group import make_datatable
 
         itf = InterfaceBuilder(self)
         itf.init_step('MultiVarModeling',
@@ -667,30 +677,10 @@ class Interface(Processor):
                       group_input=True)
 
         # Prepare data table (advanced usage of complex input structure)
-        p = re.compile(regex)
         inputs = itf.get_inputs('input')
+        df_dict = make_datatable(inputs, regex, regex_label, reindex_subj_by)
 
-        df_dict = OrderedDict()
-        subj_idx = regex_label.pop('Subj')
-        df_dict['Subj'] = [p.search(f).group(subj_idx) for f in inputs]
-
-        for label, idx in regex_label.items():
-            df_dict[label] = [p.search(f).group(idx) for f in inputs]
-
-        if reindex_subj_by is not False:
-            subjs = np.array(df_dict['Subj'], dtype=object)
-            reindex_base = np.array(df_dict[reindex_subj_by])
-            reindex_items = list(set(reindex_base))
-            offset = 0
-            for item in reindex_items:
-                sub_set = subjs[reindex_base == item]
-                sub_num = sorted(list(set(sub_set)))
-                sub_set = ['s{}'.format(i + 1 + offset) for i, n in enumerate(sub_num) for s in sub_set if s == n]
-                subjs[reindex_base == item] = sub_set
-                offset += len(sub_num)
-            df_dict['Subj'] = list(subjs)
-
-        inputs = [f.replace('nii.gz', 'nii.gz[{}]'.format(subbrick_idx)) for f in inputs]
+        inputs = [re.sub(r'(\.nii(\.gz)?)$', r'\1[{}]'.format(subbrick_idx), f) for f in inputs]
         df_dict['InputFile'] = inputs
         group_df = pd.DataFrame(df_dict)
 
@@ -704,8 +694,9 @@ class Interface(Processor):
 
         cmd = ['3dMVM']
         if n_threads is not None:
-            itf.set_var(label='n_thread', value=8)
-        cmd.append('-jobs *[n_thread]')
+            # the number of jobs granted within n_threads by the core budget of the processor
+            itf.set_threading(max_threads=n_threads, serial_fraction=0.1, label='n_thread')
+            cmd.append('-jobs *[n_thread]')
         if mask_path is not None:
             itf.set_var(label='mask', value=mask_path)
             cmd.append('-mask *[mask]')
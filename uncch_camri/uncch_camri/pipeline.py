@@ -1,4 +1,6 @@
 from pynipt import PipelineBuilder
+from uncch_core.builder import set_step_dependencies, set_output_format, set_scratch, set_profiling
+from uncch_core.nifti import set_image_cache
 
 
 class UNCCH_CAMRI(PipelineBuilder):
@@ -9,14 +11,23 @@ class UNCCH_CAMRI(PipelineBuilder):
                  # CorePreprocessing:
                  anat='anat', func='func',
                  tr=2, tpattern='altplus',
-                 template_path=None, aniso=False,
+                 template_path=None, aniso=False, combined_transform=False,
+                 native_warp=False,
+
+                 # Storage of images
+                 intermediate_ext=None, final_steps=None,
+                 scratch_root=None, scratch_quota=None, image_cache=None, cache_dir=None,
+
+                 # Run report
+                 profile=False,
 
                  # CBV-fMRI specific parameters
                  cbv_regex=None, cbv_scantime=None,
 
                  # GLM analysis
                  hrf_model=None, hrf_parameters=None, stim_onsets=None,
-                 step_idx=None, step_tag=None,
+                 step_idx=None, step_tag=None, glm_group_size=None,
+                 fused_glm=False, keep_intermediates=False,
 
                  # RSFC
                  regex=None,
@@ -26,6 +37,7 @@ class UNCCH_CAMRI(PipelineBuilder):
 
                  # T-test
                  output_filename=None, groupa=None, groupb=None, groupa_regex=None, groupb_regex=None, clustsim=None,
+                 native_ttest=False,
 
                  # MVM
 
@@ -38,6 +50,10 @@ class UNCCH_CAMRI(PipelineBuilder):
         Revised :
             ver.1: Dec.11st.2017
             ver.2: Mar.7th.2019
+        Note:
+            the native steps of uncch_core start their worker processes (n_workers) by forkserver or spawn,
+            which import the main script, so the script running the pipeline must guard its entry point by
+            "if __name__ == '__main__':", otherwise the workers are not started and the jobs run in a single process.
         Keyword Args: - listed based on each steps
             - 01_MaskPreparation
             anat(str):          datatype for anatomical image (default='anat')
@@ -65,6 +81,35 @@ class UNCCH_CAMRI(PipelineBuilder):
                                 This option is for the image has truncated brain with thicker slice thickness
                                 and it uses afni's linear registration for normalization instead ants's non-linear
                                 registration tool, SyN.
+            combined_transform(bool):   if True, the functional data is resampled into template space
+                                        in single interpolation by composing the co-registration and
+                                        spatial normalization transforms (default=False)
+            native_warp(bool):  if True, the spatial normalization is applied by the native resampler which
+                                evaluates the transforms once per subject and shares them across the runs,
+                                instead of ANTs's WarpTimeSeriesImageMultiTransform or Afni's 3dAllineate
+                                (trilinear interpolation, default=False)
+
+            - Storage of images
+            intermediate_ext(str):  if provided, the intermediate images are stored in given format,
+                                    'nii' (uncompressed) or 'nii.gz', instead of the extension of the input
+                                    (default=None)
+            final_steps(list):      step codes of which outputs are stored as 'nii.gz' when intermediate_ext
+                                    is provided, the masks (01B, 01C), the normalized data (04A, 04B, 040)
+                                    and the GLM results are used if None
+            scratch_root(str):      if provided, the temporary files are placed in this folder (e.g. node-local
+                                    storage or /dev/shm) instead of the project folder, and removed when
+                                    the step is finished (default=None)
+            scratch_quota(int):     maximum usage of scratch_root in MB, the temporary files are placed in
+                                    the project folder when exceeded (default=None, no limit)
+            image_cache(int):       memory limit in MB of the decoded masks shared by the native steps
+                                    in the process, 0 to disable (default=None, 1024 or UNCCH_IMAGE_CACHE)
+            cache_dir(str):         folder of the design matrix cache of the native GLM (default=None, '.cache/design'
+                                    in the session folder of scratch_root if provided, else in the project)
+
+            - Run report
+            profile(bool):          record wall time, CPU time, peak RSS and IO of each job and write the run
+                                    report of each pipeline stage in '<project>/.profile', the commands are
+                                    executed through the python wrapper of uncch_core.instrument (default=False)
 
             - 03_GeneralLinearModeling
             regex(str):             Regular express pattern of filename to select dataset
@@ -75,6 +120,16 @@ class UNCCH_CAMRI(PipelineBuilder):
             stim_onset(list):       stimulation onset times
             step_idx(idx):          step_index to classify the step with other when apply multiple
             step_tag(str):          suffix tag to classify the step with other when apply multiple
+            glm_group_size(int):    if provided, native GLM of uncch_core is used instead of 3dDeconvolve,
+                                    and the runs sharing the same design are solved together in batch
+                                    of given size
+            fused_glm(bool):        if True, scaling, smoothing and GLM are performed in single step
+                                    without storing intermediate files, the whole volume is smoothed
+                                    as BlurToFWHM and the GLM is solved by the native GLM with AR(1)
+                                    prewhitening, which approximates the ARMA(1,1) model of 3dREMLfit
+                                    used by Deconvolution, so the t/F-stats are not identical to the
+                                    unfused chain where the residuals are serially correlated
+            keep_intermediates(bool):   store the scaled and smoothed data when fused_glm is used
 
             - 04_TTest
             output_filename(str):   output filename of 2nd level analysis
@@ -83,6 +138,9 @@ class UNCCH_CAMRI(PipelineBuilder):
             groupa_regex(str):      regular express pattern to filter group A
             groupb_regex(str):      regular express pattern to filter group B
             clustsim(bool):         use Clustsim option if True
+            native_ttest(bool):     if True, native t-test of uncch_core is used instead of 3dttest++, and the
+                                    cluster-size thresholds are estimated by sign-flipping (one-sample) or
+                                    permutation (two-sample) of the residuals in parallel (default=False)
             step_idx(idx):          step_index to classify the step with other when apply multiple
             step_tag(str):          suffix tag to classify the step with other when apply multiple
         """
@@ -100,6 +158,27 @@ class UNCCH_CAMRI(PipelineBuilder):
         # 02_CorePreprocessing
         self.template_path = template_path
         self.aniso = aniso
+        self.combined_transform = combined_transform
+        self.native_warp = native_warp
+
+        # Storage of images
+        self.intermediate_ext = intermediate_ext
+        if final_steps is None:
+            self.final_steps = ['01B', '01C', '04A', '04B', '040']
+            self._default_final_steps = True
+        else:
+            self.final_steps = list(final_steps)
+            self._default_final_steps = False
+        if intermediate_ext is not None:
+            set_output_format(self.interface, intermediate_ext, self.final_steps)
+        if scratch_root is not None:
+            set_scratch(self.interface, scratch_root, quota=scratch_quota)
+        if image_cache is not None:
+            set_image_cache(image_cache)
+        self.cache_dir = cache_dir
+
+        # Run report
+        self.profile = profile
 
         # 03_GeneralLinearModeling
         self.regex = regex
@@ -110,6 +189,9 @@ class UNCCH_CAMRI(PipelineBuilder):
         self.stim_onsets = stim_onsets
         self.step_idx = step_idx
         self.step_tag = step_tag
+        self.glm_group_size = glm_group_size
+        self.fused_glm = fused_glm
+        self.keep_intermediates = keep_intermediates
 
         # 05_TTest
         self.output_filename = output_filename
@@ -118,6 +200,7 @@ class UNCCH_CAMRI(PipelineBuilder):
         self.groupb = groupb
         self.groupb_regex = groupb_regex
         self.clustsim = clustsim
+        self.native_ttest = native_ttest
 
         # --  end  -- #
 
@@ -129,6 +212,7 @@ class UNCCH_CAMRI(PipelineBuilder):
         """
         # Series of user defined interface commands to executed for the pipeline
         # -- start -- #
+        self._set_stage('01_MaskPreparation')
         self.interface.afni_SliceTimingCorrection(input_path=self.func,
                                                   tr=self.tr, tpattern=self.tpattern,
                                                   step_idx=1, sub_code=0)
@@ -167,6 +251,7 @@ class UNCCH_CAMRI(PipelineBuilder):
         """
         # Series of user defined interface commands to executed for the pipeline
         # -- start -- #
+        self._set_stage('02_CorePreprocessing')
 
         # Check if the brain template image is exist in given path
         if self.template_path is None:
@@ -175,6 +260,20 @@ class UNCCH_CAMRI(PipelineBuilder):
             if not self.interface.msi.path.exists(self.template_path):
                 raise Exception('No brain template image found on given path.')
 
+        # data dependencies between the steps, the independent branches are executed concurrently
+        if self.anat is not None:
+            dependencies = {'020': [], '03A': [], '03B': [],
+                            '03C': ['03A'], '03D': ['03B'], '03E': ['03C', '03D'],
+                            '04A': ['03D'], '04B': ['03A', '04A'], '03F': ['020']}
+            if self.combined_transform:
+                dependencies['040'] = ['03E', '03F', '04A']
+            else:
+                dependencies.update({'030': ['03E', '03F'], '040': ['030', '04A']})
+        else:
+            dependencies = {'020': [], '03A': [],
+                            '030': ['020'], '04A': ['03A'], '040': ['030', '04A']}
+        set_step_dependencies(self.interface, dependencies)
+
         if self.cbv_regex is not None:
             self.interface.afni_MotionCorrection(input_path='010', base='01D', regex=fr'^(?!{self.cbv_regex})',
                                                  fourier=True, verbose=True, mparam=True,
@@ -203,23 +302,19 @@ class UNCCH_CAMRI(PipelineBuilder):
                 self.interface.afni_SpatialNorm(input_path='03D', ref_path=self.template_path,
                                                 step_idx=4, sub_code='A',
                                                 suffix=self.anat)
-                self.interface.afni_ApplySpatialNorm(input_path='03A', ref_path='04A',
-                                                     step_idx=4, sub_code='B',
-                                                     suffix=f'mean{self.func}')
             else:
                 self.interface.ants_SpatialNorm(input_path='03D', ref_path=self.template_path,
                                                 step_idx=4, sub_code='A',
                                                 suffix=self.anat)
-                self.interface.ants_ApplySpatialNorm(input_path='03A', ref_path='04A',
-                                                     step_idx=4, sub_code='B',
-                                                     suffix=f'mean{self.func}')
+            self._apply_spatial_norm(input_path='03A', sub_code='B', suffix=f'mean{self.func}')
 
             self.interface.afni_SkullStripping(input_path='020', mask_path='01B',
                                                step_idx=3, sub_code='F',
                                                suffix=self.func)
-            self.interface.afni_ApplyTransform(input_path='03F', ref_path='03E',
-                                               step_idx=3, sub_code=0,
-                                               suffix=self.func)
+            if not self.combined_transform:
+                self.interface.afni_ApplyTransform(input_path='03F', ref_path='03E',
+                                                   step_idx=3, sub_code=0,
+                                                   suffix=self.func)
         else:
             self.interface.afni_SkullStripping(input_path='020', mask_path='01B',
                                                step_idx=3, sub_code=0,
@@ -228,16 +323,35 @@ class UNCCH_CAMRI(PipelineBuilder):
                                             step_idx=4, sub_code='A',
                                             suffix=self.anat)
 
-        if self.aniso is True:
-            self.interface.afni_ApplySpatialNorm(input_path='030', ref_path='04A',
-                                                 step_idx=4, sub_code=0,
-                                                 suffix=self.func)
+        if self.anat is not None and self.combined_transform:
+            self.interface.camri_ApplyCombinedTransform(input_path='03F', ref_path='04A', coreg_path='03E',
+                                                        method='afni' if self.aniso is True else 'ants',
+                                                        step_idx=4, sub_code=0,
+                                                        suffix=self.func)
         else:
-            self.interface.ants_ApplySpatialNorm(input_path='030', ref_path='04A',
-                                                 step_idx=4, sub_code=0,
-                                                 suffix=self.func)
+            self._apply_spatial_norm(input_path='030', sub_code=0, suffix=self.func)
         # --  end  -- #
 
+    def _set_stage(self, stage):
+        """ set the stage of the run report for the steps built afterward """
+        set_profiling(self.interface, stage if self.profile else None)
+
+    def _apply_spatial_norm(self, input_path, sub_code, suffix):
+        """ apply the spatial normalization of step 04A with the tool selected by aniso and native_warp """
+        if self.native_warp:
+            self.interface.camri_ApplySpatialNorm(input_path=input_path, ref_path='04A',
+                                                  method='afni' if self.aniso is True else 'ants',
+                                                  step_idx=4, sub_code=sub_code,
+                                                  suffix=suffix)
+        elif self.aniso is True:
+            self.interface.afni_ApplySpatialNorm(input_path=input_path, ref_path='04A',
+                                                 step_idx=4, sub_code=sub_code,
+                                                 suffix=suffix)
+        else:
+            self.interface.ants_ApplySpatialNorm(input_path=input_path, ref_path='04A',
+                                                 step_idx=4, sub_code=sub_code,
+                                                 suffix=suffix)
+
     def pipe_03_GeneralLinearModeling(self):
         """
         The normalized data will be scaled to have mean value of 100 for each voxel followed by the spacial smoothing
@@ -245,18 +359,43 @@ class UNCCH_CAMRI(PipelineBuilder):
         """
         # Series of user defined interface commands to executed for the pipeline
         # -- start -- #
-        self.interface.afni_Scailing(input_path='040', mask_path=self.mask_path,
-                                     mean=100, max=200, step_idx=self.step_idx, sub_code='A',
-                                     suffix=self.step_tag)
-        self.interface.afni_BlurToFWHM(input_path=f'{str(self.step_idx).zfill(2)}A',
-                                       fwhm=self.fwhm,
-                                       step_idx=self.step_idx, sub_code='B', suffix=self.step_tag)
-        self.interface.afni_Deconvolution(input_path=f'{str(self.step_idx).zfill(2)}B',
-                                          mask_path=self.mask_path,
+        self._set_stage('03_GeneralLinearModeling')
+        if self.intermediate_ext is not None and self._default_final_steps:
+            # GLM result is the output of this pipeline
+            self.final_steps.append(f'{str(self.step_idx).zfill(2)}0')
+            set_output_format(self.interface, self.intermediate_ext, self.final_steps)
+        if self.fused_glm:
+            self.interface.camri_GLMChain(input_path='040', mask_path=self.mask_path,
+                                          fwhm=self.fwhm, mean=100, max=200,
                                           regex=self.regex,
                                           onset_time=self.stim_onsets, model=self.hrf_model,
                                           parameters=self.hrf_parameters,
+                                          method='AR1',
+                                          keep_intermediates=self.keep_intermediates,
+                                          group_size=self.glm_group_size, cache_dir=self.cache_dir,
                                           step_idx=self.step_idx, sub_code=0, suffix=self.step_tag)
+        else:
+            self.interface.afni_Scailing(input_path='040', mask_path=self.mask_path,
+                                         mean=100, max=200, step_idx=self.step_idx, sub_code='A',
+                                         suffix=self.step_tag)
+            self.interface.afni_BlurToFWHM(input_path=f'{str(self.step_idx).zfill(2)}A',
+                                           fwhm=self.fwhm,
+                                           step_idx=self.step_idx, sub_code='B', suffix=self.step_tag)
+            if self.glm_group_size is not None:
+                self.interface.camri_GLM(input_path=f'{str(self.step_idx).zfill(2)}B',
+                                         mask_path=self.mask_path,
+                                         regex=self.regex,
+                                         onset_time=self.stim_onsets, model=self.hrf_model,
+                                         parameters=self.hrf_parameters,
+                                         group_size=self.glm_group_size, cache_dir=self.cache_dir,
+                                         step_idx=self.step_idx, sub_code=0, suffix=self.step_tag)
+            else:
+                self.interface.afni_Deconvolution(input_path=f'{str(self.step_idx).zfill(2)}B',
+                                                  mask_path=self.mask_path,
+                                                  regex=self.regex,
+                                                  onset_time=self.stim_onsets, model=self.hrf_model,
+                                                  parameters=self.hrf_parameters,
+                                                  step_idx=self.step_idx, sub_code=0, suffix=self.step_tag)
         # reset step_idx and step_tag
         self.step_idx = None
         self.step_tag = None
@@ -266,15 +405,20 @@ class UNCCH_CAMRI(PipelineBuilder):
     def pipe_04_2ndLevel_TTest(self):
         """
         3dttest++ is used to perform ttest. With Clustsim option, clustsim table will be generated and integrated
-        into the result file.
+        into the result file. If native_ttest is True, the table is stored next to the result file.
         """
         # Series of user defined interface commands to executed for the pipeline
         # -- start -- #
-        self.interface.afni_TTest(output_filename=self.output_filename, clustsim=self.clustsim,
-                                  input_a=self.groupa, regex_a=self.groupa_regex, data_idx_a=1,
-                                  input_b=self.groupb, regex_b=self.groupb_regex, data_idx_b=1,
-                                  mask_path=self.mask_path,
-                                  step_idx=self.step_idx, sub_code=None, suffix=self.step_tag)
+        self._set_stage('04_2ndLevel_TTest')
+        if self.native_ttest:
+            ttest = self.interface.camri_TTest
+        else:
+            ttest = self.interface.afni_TTest
+        ttest(output_filename=self.output_filename, clustsim=self.clustsim,
+              input_a=self.groupa, regex_a=self.groupa_regex, data_idx_a=1,
+              input_b=self.groupb, regex_b=self.groupb_regex, data_idx_b=1,
+              mask_path=self.mask_path,
+              step_idx=self.step_idx, sub_code=None, suffix=self.step_tag)
         # reset step_tag
         self.step_idx = None
         self.step_tag = None
@@ -0,0 +1,163 @@
+""" Tests of the step result cache, the jobs are inspected in separate interpreter processes
+as the pipeline is executed again """
+import os
+import sys
+import json
+import shutil
+import subprocess
+import pytest
+
+for module in ('pynipt', 'slfmri', 'shleeh'):
+    pytest.importorskip(module)
+
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SUBJECTS = ['sub-01', 'sub-02']
+
+# inspect the jobs of blur_func step and record them after the execution as InterfaceBuilder does,
+# the jobs that are not cached are executed by writing the parameter into the output
+RUN_STEP = '''
+import sys, os, json
+from types import SimpleNamespace
+from uncch_core.builder import InterfaceBuilder
+from uncch_core.funcs import blur_func
+
+project, fwhm, n_threads = sys.argv[1], float(sys.argv[2]), int(sys.argv[3])
+subjects, invalidate = json.loads(sys.argv[4]), sys.argv[5] == '1'
+itf = InterfaceBuilder.__new__(InterfaceBuilder)
+itf._procobj = SimpleNamespace(bucket=SimpleNamespace(path=project))
+itf._type = 'python'
+itf._func_set = {0: blur_func}
+itf._input_set = {'input': [(os.path.join(project, 'dataset', sub, 'func'), 'bold.nii') for sub in subjects]}
+itf._output_set = {'output': [(os.path.join(project, 'processing', sub, 'func'), 'bold.nii') for sub in subjects]}
+itf._output_filter = list(itf._output_set['output'])
+itf._var_set = {'fwhm': fwhm, 'mask': None, 'mem_limit': 100 * n_threads, 'n_threads': n_threads}
+itf.invalidate_stale = invalidate
+
+cache = itf._get_cache()
+jobs = itf._get_jobs()
+statuses = []
+for key, fingerprints, output, outputs in jobs:
+    status = cache.check(key, output, outputs)
+    if not os.path.exists(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w') as f:
+            f.write('fwhm={}'.format(fwhm))
+    statuses.append(status)
+for (key, fingerprints, output, outputs), status in zip(jobs, statuses):
+    if status != 'stale':
+        cache.record(key, fingerprints, output, outputs)
+print(json.dumps(statuses))
+'''
+
+
+def _env(hash_seed, package_path=PACKAGE_PATH):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([package_path] + [p for p in [env.get('PYTHONPATH')] if p])
+    # the identity must not depend on the string hashes, which are randomized in each process
+    env['PYTHONHASHSEED'] = str(hash_seed)
+    return env
+
+
+def run_step(project, fwhm, hash_seed=0, n_threads=1, invalidate=False):
+    """ statuses of the jobs from StepCache.check in a new interpreter """
+    result = subprocess.run([sys.executable, '-c', RUN_STEP, str(project), str(fwhm), str(n_threads),
+                             json.dumps(SUBJECTS), '1' if invalidate else '0'],
+                            env=_env(hash_seed), stdout=subprocess.PIPE, check=True)
+    return json.loads(result.stdout.decode().strip().splitlines()[-1])
+
+
+def func_identities(package_path=PACKAGE_PATH, hash_seed=0):
+    """ identities of the native functions in a new interpreter """
+    script = ('import json\n'
+              'import uncch_core.funcs as funcs\n'
+              'from uncch_core.cache import func_identity\n'
+              'print(json.dumps({name: func_identity(getattr(funcs, name)) for name in dir(funcs)\n'
+              '                  if name.endswith("_func")}))\n')
+    # the current folder comes first in the path of 'python -c'
+    result = subprocess.run([sys.executable, '-c', script], env=_env(hash_seed, package_path),
+                            cwd=package_path, stdout=subprocess.PIPE, check=True)
+    return json.loads(result.stdout.decode().strip().splitlines()[-1])
+
+
+def read_output(project, sub):
+    with open(os.path.join(str(project), 'processing', sub, 'func', 'bold.nii')) as f:
+        return f.read()
+
+
+@pytest.fixture
+def project(tmp_path):
+    for sub in SUBJECTS:
+        func_path = tmp_path / 'dataset' / sub / 'func'
+        func_path.mkdir(parents=True)
+        (func_path / 'bold.nii').write_bytes(os.urandom(64))
+    return tmp_path
+
+
+def test_func_identity_is_stable_across_processes():
+    identities = [func_identities(hash_seed=hash_seed) for hash_seed in (1, 2)]
+    assert len(identities[0]) > 0
+    assert identities[0] == identities[1]
+
+
+def test_func_identity_follows_helpers(tmp_path):
+    shutil.copytree(os.path.join(PACKAGE_PATH, 'uncch_core'), str(tmp_path / 'uncch_core'),
+                    ignore=shutil.ignore_patterns('__pycache__'))
+    identities = func_identities(str(tmp_path))
+
+    # the modules which are not used by the functions do not change the identities
+    with open(str(tmp_path / 'uncch_core' / 'instrument.py'), 'a') as f:
+        f.write('\n# modified\n')
+    assert func_identities(str(tmp_path)) == identities
+
+    # the declared helper module changes the identities of the functions using it
+    with open(str(tmp_path / 'uncch_core' / 'preprocessing.py'), 'a') as f:
+        f.write('\n# modified\n')
+    modified = func_identities(str(tmp_path))
+    assert modified['blur_func'] != identities['blur_func']
+    assert modified['ttest_func'] == identities['ttest_func']
+
+
+def test_rerun_is_cached(project):
+    assert run_step(project, 0.5, hash_seed=1) == [None, None]
+    assert run_step(project, 0.5, hash_seed=2) == ['cached', 'cached']
+    assert read_output(project, 'sub-01') == 'fwhm=0.5'
+
+
+def test_resources_do_not_invalidate(project):
+    run_step(project, 0.5, n_threads=1)
+    assert run_step(project, 0.5, n_threads=4) == ['cached', 'cached']
+
+
+def test_stale_output_is_kept(project):
+    run_step(project, 0.5)
+    assert run_step(project, 1.0) == ['stale', 'stale']
+    assert read_output(project, 'sub-01') == 'fwhm=0.5'
+    # the stale output is not recorded as the result of the new parameter
+    assert run_step(project, 1.0) == ['stale', 'stale']
+    assert run_step(project, 0.5) == ['cached', 'cached']
+
+
+def test_parameter_change_invalidates(project):
+    run_step(project, 0.5)
+    assert run_step(project, 1.0, invalidate=True) == ['invalidated', 'invalidated']
+    assert read_output(project, 'sub-01') == 'fwhm=1.0'
+    assert run_step(project, 1.0) == ['cached', 'cached']
+
+
+def test_input_change_invalidates(project):
+    run_step(project, 0.5)
+    with open(os.path.join(str(project), 'dataset', 'sub-02', 'func', 'bold.nii'), 'ab') as f:
+        f.write(b'modified')
+    assert run_step(project, 0.5, invalidate=True) == ['cached', 'invalidated']
+
+
+def test_restore_from_store(project):
+    run_step(project, 0.5)
+    run_step(project, 1.0, invalidate=True)
+    # the outputs of the previous parameter are restored instead of re-processed
+    assert run_step(project, 0.5, invalidate=True) == ['restored', 'restored']
+    assert read_output(project, 'sub-02') == 'fwhm=0.5'
+
+    os.remove(os.path.join(str(project), 'processing', 'sub-01', 'func', 'bold.nii'))
+    assert run_step(project, 0.5) == ['restored', 'cached']
+    assert read_output(project, 'sub-01') == 'fwhm=0.5'
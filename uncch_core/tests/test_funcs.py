@@ -0,0 +1,197 @@
+""" Tests of the native functions against the reference computations of the steps they replace """
+import io
+import numpy as np
+import nibabel as nib
+import pytest
+
+for module in ('pynipt', 'slfmri', 'shleeh'):
+    pytest.importorskip(module)
+
+from uncch_core import funcs
+
+SHAPE = (6, 5, 4)
+
+
+def save_nifti(path, data, zooms=(1., 1., 1., 2.)):
+    nii = nib.Nifti1Image(np.asarray(data, dtype=np.float32), np.diag(list(zooms[:3]) + [1.]))
+    nii.header.set_zooms(zooms[:data.ndim])
+    nii.header.set_xyzt_units('mm', 'sec')
+    nii.to_filename(str(path))
+    return str(path)
+
+
+def load_data(path):
+    return np.asarray(nib.load(str(path)).dataobj)
+
+
+def run(func, **kwargs):
+    """ run the native function, the error message is shown if failed """
+    stderr = io.StringIO()
+    assert func(stdout=io.StringIO(), stderr=stderr, **kwargs) == 0, stderr.getvalue()
+
+
+@pytest.fixture
+def series(tmp_path):
+    """ 4D series with a mask of the half of the voxels """
+    rng = np.random.RandomState(0)
+    data = 100 + rng.randn(*SHAPE + (40,))
+    mask = rng.rand(*SHAPE) > 0.5
+    return (save_nifti(tmp_path / 'input.nii', data), save_nifti(tmp_path / 'mask.nii', mask),
+            data, mask)
+
+
+# [user-001] batched periodogram, the reference is the per-voxel loop of scipy.signal.periodogram
+
+def _periodogram_reference(data, mask, dt, nfft):
+    from scipy.signal import periodogram
+    n_freqs = periodogram(np.zeros(data.shape[-1]), fs=1 / dt, nfft=nfft)[0].shape[0]
+    output = np.zeros(data.shape[:3] + (n_freqs,))
+    for idx in zip(*np.nonzero(mask)):
+        output[idx] = periodogram(data[idx], fs=1 / dt, nfft=nfft)[1]
+    return output
+
+
+@pytest.mark.parametrize('options', [dict(), dict(mem_limit=0.01), dict(n_workers=2)])
+def test_periodogram_matches_per_voxel(tmp_path, series, options):
+    input_path, mask_path, data, mask = series
+    output = str(tmp_path / 'output.nii')
+    run(funcs.periodogram_func, input=input_path, output=output, mask=mask_path, dt=2, nfft=64, **options)
+    expected = _periodogram_reference(data.astype(np.float32).astype(np.float64), mask, 2, 64)
+    np.testing.assert_allclose(load_data(output), expected, rtol=1e-5, atol=1e-7)
+
+
+def test_periodogram_bands(tmp_path, series):
+    input_path, mask_path, data, mask = series
+    output = str(tmp_path / 'output.nii')
+    run(funcs.periodogram_func, input=input_path, output=output, mask=mask_path, dt=2, nfft=64,
+        bands=[[0.01, 0.1], [0.1, 0.2]])
+    from scipy.signal import periodogram
+    f = periodogram(np.zeros(40), fs=0.5, nfft=64)[0]
+    amp = np.sqrt(_periodogram_reference(data.astype(np.float32).astype(np.float64), mask, 2, 64))
+    expected = []
+    for low, high in [[0.01, 0.1], [0.1, 0.2]]:
+        expected.append(amp[..., (f >= low) & (f <= high)].mean(-1))
+    total = amp[..., 1:].sum(-1)
+    for low, high in [[0.01, 0.1], [0.1, 0.2]]:
+        band = amp[..., (f >= low) & (f <= high)].sum(-1)
+        expected.append(np.divide(band, total, out=np.zeros_like(band), where=total > 0))
+    np.testing.assert_allclose(load_data(output), np.stack(expected, -1), rtol=1e-5, atol=1e-7)
+
+
+# [user-006] chunked 3dcalc-style expressions, the references are the expressions of the AFNI steps in numpy
+
+@pytest.mark.parametrize('mem_limit', [None, 0.01])
+def test_calc_skull_stripping(tmp_path, series, mem_limit):
+    input_path, mask_path, data, mask = series
+    output = str(tmp_path / 'output.nii')
+    run(funcs.calc_func, input=input_path, output=output, expr='a*step(b)', mask=mask_path, mem_limit=mem_limit)
+    expected = data.astype(np.float32) * (mask[..., np.newaxis] > 0)
+    np.testing.assert_allclose(load_data(output), expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize('mem_limit', [None, 0.01])
+def test_calc_scaling(tmp_path, series, mem_limit):
+    # 3dTstat -mean into the temporary mean image, then 3dcalc -expr 'c * min(200, a/b*100)'
+    input_path, mask_path, data, mask = series
+    data = data.astype(np.float32).astype(np.float64)
+    data[0, 0, 0] = 0
+    input_path = save_nifti(tmp_path / 'input.nii', data)
+    output = str(tmp_path / 'output.nii')
+    run(funcs.calc_func, input=input_path, output=output, expr='b * min(200, a/tmean(a)*100)', mask=mask_path,
+        mem_limit=mem_limit)
+    mean = data.mean(-1, keepdims=True)
+    scaled = np.divide(data, mean, out=np.zeros_like(data), where=mean != 0) * 100
+    expected = mask[..., np.newaxis] * np.minimum(200, scaled)
+    np.testing.assert_allclose(load_data(output), expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('mem_limit', [None, 0.01])
+def test_mean_image_windows(tmp_path, series, mem_limit):
+    input_path, mask_path, data, mask = series
+    output = str(tmp_path / 'output.nii')
+    run(funcs.meanimage_func, input=input_path, output=output, ranges=[[0, 9], [30, 39]], mem_limit=mem_limit)
+    data = data.astype(np.float32).astype(np.float64)
+    expected = np.stack([data[..., 0:10].mean(-1), data[..., 30:40].mean(-1)], -1)
+    np.testing.assert_allclose(load_data(output), expected, rtol=1e-6)
+
+
+# [user-010] slice timing correction in the Fourier mode of 3dTshift
+
+def test_slice_offsets():
+    from uncch_core.preprocessing import slice_offsets
+    # slice times of 3dTshift for 5 slices and TR=5
+    assert slice_offsets('alt+z', 5, 5).tolist() == [0, 3, 1, 4, 2]
+    assert slice_offsets('altplus', 5, 5).tolist() == [0, 3, 1, 4, 2]
+    assert slice_offsets('alt+z2', 5, 5).tolist() == [2, 0, 3, 1, 4]
+    assert slice_offsets('alt-z', 5, 5).tolist() == [2, 4, 1, 3, 0]
+    assert slice_offsets('seq+z', 5, 5).tolist() == [0, 1, 2, 3, 4]
+    assert slice_offsets('seqminus', 5, 5).tolist() == [4, 3, 2, 1, 0]
+    assert slice_offsets('zero', 5, 5).tolist() == [0, 0, 0, 0, 0]
+
+
+def test_fourier_shift_of_smooth_signal():
+    from uncch_core.preprocessing import fourier_shift
+    t = np.arange(200, dtype=np.float64)
+    signal = lambda x: 3 * np.sin(2 * np.pi * x / 40) + 0.01 * x
+    shifted = fourier_shift(signal(t)[np.newaxis], 0.3)[0]
+    # the edges are affected by the symmetric extension
+    np.testing.assert_allclose(shifted[20:-20], signal(t + 0.3)[20:-20], atol=1e-2)
+
+
+@pytest.mark.parametrize('options', [dict(), dict(mem_limit=0.01), dict(n_workers=2)])
+def test_slicetiming_matches_per_voxel(tmp_path, series, options):
+    from uncch_core.preprocessing import slice_offsets, fourier_shift
+    input_path, mask_path, data, mask = series
+    output = str(tmp_path / 'output.nii')
+    run(funcs.slicetiming_func, input=input_path, output=output, tr=2.0, tpattern='alt+z', **options)
+    offsets = slice_offsets('alt+z', SHAPE[2], 2.0)
+    data = data.astype(np.float32).astype(np.float64)
+    expected = np.zeros(data.shape)
+    for idx in np.ndindex(*SHAPE):
+        # aligned to the average slice time as 3dTshift does
+        expected[idx] = fourier_shift(data[idx], (offsets.mean() - offsets[idx[2]]) / 2.0)
+    np.testing.assert_allclose(load_data(output), expected, rtol=1e-6)
+
+
+# [user-011] separable in-mask smoothing, the references are the volume-wise Gaussian filters of scipy
+
+def _blur_reference(data, mask, sigma):
+    """ Gaussian filter normalized by the filtered mask, the smoothing of 3dBlurInMask """
+    from scipy.ndimage import gaussian_filter
+    mask = np.asarray(mask, dtype=np.float64)
+    weights = gaussian_filter(mask, sigma, mode='constant', truncate=4.0)
+    output = np.zeros(data.shape)
+    for t in range(data.shape[-1]):
+        blurred = gaussian_filter(data[..., t] * mask, sigma, mode='constant', truncate=4.0)
+        output[..., t] = np.divide(blurred, weights, out=np.zeros_like(blurred), where=mask > 0)
+    return output
+
+
+def test_blur_matches_gaussian_filter():
+    from scipy.ndimage import gaussian_filter
+    from uncch_core.preprocessing import blur, gaussian_kernel
+    data = np.random.RandomState(0).randn(*SHAPE)
+    sigma = [1.2, 0.8, 0.5]
+    expected = gaussian_filter(data, sigma, mode='constant', truncate=4.0)
+    np.testing.assert_allclose(blur(data, [gaussian_kernel(s) for s in sigma]), expected, rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize('options', [dict(), dict(mem_limit=0.01), dict(n_threads=2)])
+def test_blur_in_mask_matches_per_volume(tmp_path, series, options):
+    input_path, mask_path, data, mask = series
+    # anisotropic voxels, the kernel is defined in mm
+    input_path = save_nifti(tmp_path / 'input.nii', data, zooms=(1., 1., 2., 2.))
+    output = str(tmp_path / 'output.nii')
+    run(funcs.blur_func, input=input_path, output=output, fwhm=2.0, mask=mask_path, **options)
+    sigma = 2.0 / np.sqrt(8 * np.log(2)) / np.array([1., 1., 2.])
+    expected = _blur_reference(data.astype(np.float32).astype(np.float64), mask, sigma)
+    np.testing.assert_allclose(load_data(output), expected, rtol=1e-5, atol=1e-5)
+
+
+def test_blur_without_mask(tmp_path, series):
+    input_path, mask_path, data, mask = series
+    output = str(tmp_path / 'output.nii')
+    run(funcs.blur_func, input=input_path, output=output, fwhm=2.0)
+    sigma = [2.0 / np.sqrt(8 * np.log(2))] * 3
+    expected = _blur_reference(data.astype(np.float32).astype(np.float64), np.ones(SHAPE), sigma)
+    np.testing.assert_allclose(load_data(output), expected, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,130 @@
+""" Tests of the native GLM """
+import io
+import time
+import threading
+import numpy as np
+import nibabel as nib
+import pytest
+
+for module in ('pynipt', 'slfmri', 'shleeh'):
+    pytest.importorskip(module)
+
+from uncch_core import glm, funcs
+
+
+def make_design(n_vols=60):
+    return glm.Design.from_model([10, 30, 50], 'BLOCK', [5, 1], 1.0, n_vols)
+
+
+def run_jobs(solver, key, design, chunks):
+    """ submit the chunks of each job from its own thread as the concurrent jobs of the step """
+    results = [None] * len(chunks)
+
+    def job(i):
+        solver.join(key)
+        try:
+            results[i] = [solver.fit(key, design, data) for data in chunks[i]]
+        finally:
+            solver.leave(key)
+
+    threads = [threading.Thread(target=job, args=(i,)) for i in range(len(chunks))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_group_solver_matches_fit():
+    design = make_design()
+    rng = np.random.RandomState(0)
+    chunks = [[rng.randn(60, n) for n in (30, 20, 10)] for _ in range(2)]
+    results = run_jobs(glm.GroupSolver(2), 'key', design, chunks)
+    for job_chunks, job_results in zip(chunks, results):
+        for data, stats in zip(job_chunks, job_results):
+            np.testing.assert_allclose(stats, glm.fit(design, data), rtol=1e-6, atol=1e-8)
+
+
+@pytest.mark.parametrize('slabs', [[3, 3], [3, 1]])
+def test_group_solver_does_not_wait_for_missing_jobs(slabs):
+    # fewer jobs are running than group_size, and the jobs have different number of slabs
+    design = make_design()
+    rng = np.random.RandomState(0)
+    chunks = [[rng.randn(60, 10) for _ in range(n)] for n in slabs]
+    start = time.time()
+    run_jobs(glm.GroupSolver(4, timeout=5.0), 'key', design, chunks)
+    assert time.time() - start < 2.5
+
+
+# [user-007] batched GLM, the references are the per-voxel least squares fits
+
+def _ols_reference(matrix, n_baseline, y):
+    """ F-stat of the stimuli, coefficients and t-stats of a single voxel """
+    beta, _, _, _ = np.linalg.lstsq(matrix, y, rcond=None)
+    dof = matrix.shape[0] - matrix.shape[1]
+    rss = ((y - matrix.dot(beta)) ** 2).sum()
+    baseline = matrix[:, :n_baseline]
+    rss_baseline = ((y - baseline.dot(np.linalg.lstsq(baseline, y, rcond=None)[0])) ** 2).sum()
+    cov = np.linalg.inv(matrix.T.dot(matrix)) * rss / dof
+    stats = [(rss_baseline - rss) / (matrix.shape[1] - n_baseline) / (rss / dof)]
+    for j in range(n_baseline, matrix.shape[1]):
+        stats += [beta[j], beta[j] / np.sqrt(cov[j, j])]
+    return np.array(stats)
+
+
+def _ar1_reference(design, y):
+    """ OLS fit of the Prais-Winsten transformed voxel with AR(1) coefficient of the OLS residuals """
+    resid = y - design.matrix.dot(np.linalg.lstsq(design.matrix, y, rcond=None)[0])
+    rho = (resid[1:] * resid[:-1]).sum() / (resid ** 2).sum()
+    rho = np.clip(np.round(np.round(rho / glm.AR1_STEP) * glm.AR1_STEP, 4), -glm.AR1_LIMIT, glm.AR1_LIMIT)
+    return _ols_reference(glm.ar1_whiten(design.matrix, rho), design.n_baseline, glm.ar1_whiten(y, rho))
+
+
+def make_series(n_voxels=30, n_vols=60, seed=0):
+    """ time series of stimulus response with AR(1) noise """
+    design = make_design(n_vols)
+    rng = np.random.RandomState(seed)
+    noise = rng.randn(n_vols, n_voxels)
+    for t in range(1, n_vols):
+        noise[t] += 0.4 * noise[t - 1]
+    return design, 100 + design.matrix[:, -1:] * rng.rand(1, n_voxels) * 3 + noise
+
+
+def test_response_peak():
+    t = np.arange(0, 60, 0.01)
+    assert np.isclose(glm._response('BLOCK', [10, 1], t).max(), 1, atol=1e-4)
+    assert np.isclose(glm._response('GAM', [], t).max(), 1, atol=1e-4)
+
+
+@pytest.mark.parametrize('method', ['OLS', 'AR1'])
+def test_fit_matches_per_voxel(method):
+    design, data = make_series()
+    stats = glm.fit(design, data, method)
+    for i in range(data.shape[1]):
+        if method == 'OLS':
+            expected = _ols_reference(design.matrix, design.n_baseline, data[:, i])
+        else:
+            expected = _ar1_reference(design, data[:, i])
+        np.testing.assert_allclose(stats[:, i], expected, rtol=1e-6, atol=1e-8)
+
+
+@pytest.mark.parametrize('options', [dict(), dict(mem_limit=0.01), dict(n_workers=2)])
+def test_glm_func(tmp_path, options):
+    design, data = make_series(n_voxels=6 * 5 * 4)
+    data = data.T.reshape(6, 5, 4, -1).astype(np.float32)
+    mask = np.random.RandomState(1).rand(6, 5, 4) > 0.3
+    paths = []
+    for name, array in [('input', data), ('mask', mask)]:
+        nii = nib.Nifti1Image(array.astype(np.float32), np.eye(4))
+        nii.header.set_zooms((1., 1., 1., 1.)[:array.ndim])
+        nii.header.set_xyzt_units('mm', 'sec')
+        paths.append(str(tmp_path / '{}.nii'.format(name)))
+        nii.to_filename(paths[-1])
+    output = str(tmp_path / 'output.nii')
+    stderr = io.StringIO()
+    assert funcs.glm_func(paths[0], output, [10, 30, 50], 'BLOCK', [5, 1], mask=paths[1], method='AR1',
+                          stdout=io.StringIO(), stderr=stderr, **options) == 0, stderr.getvalue()
+    stats = np.asarray(nib.load(output).dataobj)
+    expected = np.zeros(stats.shape)
+    expected[mask] = glm.fit(design, data[mask].T.astype(np.float64), 'AR1').T
+    np.testing.assert_allclose(stats, expected, rtol=1e-5, atol=1e-5)
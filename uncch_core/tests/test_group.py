@@ -0,0 +1,163 @@
+""" Tests of the native group statistics """
+import io
+import numpy as np
+import nibabel as nib
+import pytest
+
+for module in ('pynipt', 'slfmri', 'shleeh'):
+    pytest.importorskip(module)
+
+from uncch_core import group, funcs
+from uncch_core.group import make_datatable, GroupModel
+
+REGEX = r'(sub-\w+)_(ses-\w+)_(grp-\w+)'
+REGEX_LABEL = dict(Subj=1, session=2, group=3)
+
+
+def test_reindex_keeps_row_order():
+    # the sessions of the subjects are interleaved as the inputs are sorted by session
+    inputs = ['sub-02_ses-1_grp-a', 'sub-01_ses-1_grp-a', 'sub-02_ses-2_grp-a', 'sub-01_ses-2_grp-a']
+    table = make_datatable(inputs, REGEX, REGEX_LABEL, reindex_subj_by='group')
+    assert table['Subj'] == ['s2', 's1', 's2', 's1']
+    assert table['session'] == ['ses-1', 'ses-1', 'ses-2', 'ses-2']
+
+
+def test_reindex_offsets_groups():
+    # the subject ids are reused across the groups
+    inputs = ['sub-02_ses-1_grp-b', 'sub-01_ses-1_grp-a', 'sub-01_ses-1_grp-b', 'sub-03_ses-1_grp-a',
+              'sub-02_ses-2_grp-b', 'sub-01_ses-2_grp-a', 'sub-01_ses-2_grp-b', 'sub-03_ses-2_grp-a']
+    table = make_datatable(inputs, REGEX, REGEX_LABEL, reindex_subj_by='group')
+    assert table['Subj'] == ['s4', 's1', 's3', 's2', 's4', 's1', 's3', 's2']
+
+
+def test_reindex_within_subject_model():
+    inputs = ['sub-02_ses-1_grp-a', 'sub-01_ses-1_grp-a', 'sub-03_ses-1_grp-a',
+              'sub-02_ses-2_grp-a', 'sub-01_ses-2_grp-a', 'sub-03_ses-2_grp-a']
+    table = make_datatable(inputs, REGEX, REGEX_LABEL, reindex_subj_by='group')
+    raw = make_datatable(inputs, REGEX, REGEX_LABEL)
+    data = np.random.RandomState(0).randn(len(inputs), 5)
+    # reindexing renames the subjects, the pairing of the sessions is unchanged
+    stats = GroupModel(table, ws_vars='session').fit(data)
+    expected = GroupModel(raw, ws_vars='session').fit(data)
+    np.testing.assert_allclose(stats, expected)
+
+
+# [user-023] vectorized t-test and sign-flip/permutation cluster-size inference, the references are
+# the voxel-wise t-tests of scipy and the null samples drawn one at a time
+
+SHAPE = (6, 5, 4)
+
+
+def test_one_sample_ttest_matches_scipy():
+    from scipy.stats import ttest_1samp
+    data = np.random.RandomState(0).randn(8, 50) + 0.3
+    stats, resid, dof = group.ttest(data)
+    expected = ttest_1samp(data, 0)
+    np.testing.assert_allclose(stats[0], data.mean(0))
+    np.testing.assert_allclose(stats[1], expected.statistic, rtol=1e-10)
+    np.testing.assert_allclose(resid, data - data.mean(0))
+    assert dof == 7
+
+
+def test_two_sample_ttest_matches_scipy():
+    from scipy.stats import ttest_1samp, ttest_ind
+    rng = np.random.RandomState(0)
+    data_a, data_b = rng.randn(8, 50) + 0.3, rng.randn(6, 50)
+    stats, resid, dof = group.ttest(data_a, data_b)
+    np.testing.assert_allclose(stats[0], data_a.mean(0) - data_b.mean(0))
+    np.testing.assert_allclose(stats[1], ttest_ind(data_a, data_b).statistic, rtol=1e-10)
+    np.testing.assert_allclose(stats[3], ttest_1samp(data_a, 0).statistic, rtol=1e-10)
+    np.testing.assert_allclose(stats[5], ttest_1samp(data_b, 0).statistic, rtol=1e-10)
+    np.testing.assert_allclose(resid, np.concatenate([data_a - data_a.mean(0), data_b - data_b.mean(0)]))
+    assert dof == 12
+
+
+def test_max_cluster_sizes():
+    volume = np.zeros(SHAPE)
+    volume[0:2, 0:2, 0] = 3
+    volume[4, 3, 2:4] = -4
+    # the corner neighbour joins the clusters only with NN3
+    volume[2, 2, 1] = 3
+    structure = group.get_structure(1)
+    assert group.max_cluster_sizes(volume, [2, 3.5, 5], structure).tolist() == [4, 2, 0]
+    assert group.max_cluster_sizes(volume, [2], group.get_structure(3)).tolist() == [5]
+
+
+def test_cluster_thresholds():
+    max_sizes = np.random.RandomState(0).permutation(np.arange(1, 101)).reshape(100, 1)
+    table = group.cluster_thresholds(max_sizes, [0.1, 0.05, 0.01])
+    # the fraction of the null samples reaching the threshold does not exceed alpha
+    for alpha, size in zip([0.1, 0.05, 0.01], table[0]):
+        assert (max_sizes >= size).mean() <= alpha < (max_sizes >= size - 1).mean()
+
+
+def _null_reference(resid, n_a, mask, thresholds, nn, n_iter, seed):
+    """ largest cluster sizes of the null samples with scipy t-tests """
+    from scipy.ndimage import label, generate_binary_structure
+    from scipy.stats import ttest_1samp, ttest_ind
+    sizes = np.zeros((n_iter, len(thresholds)), dtype=np.int64)
+    for i in range(n_iter):
+        rng = np.random.RandomState([seed, i])
+        if n_a is None:
+            t = ttest_1samp(resid * (rng.randint(0, 2, resid.shape[0]) * 2 - 1)[:, np.newaxis], 0).statistic
+        else:
+            order = rng.permutation(resid.shape[0])
+            t = ttest_ind(resid[order[:n_a]], resid[order[n_a:]]).statistic
+        volume = np.zeros(mask.shape)
+        volume[mask] = t
+        for j, thr in enumerate(thresholds):
+            for supra in (volume >= thr, volume <= -thr):
+                labels, n_labels = label(supra, generate_binary_structure(3, nn))
+                if n_labels:
+                    sizes[i, j] = max(sizes[i, j], np.bincount(labels.ravel())[1:].max())
+    return sizes
+
+
+def _read_table(path):
+    with open(path) as f:
+        return np.array([[int(v) for v in line.split()[1:]] for line in f if not line.startswith('#')])
+
+
+@pytest.fixture
+def subjects(tmp_path):
+    """ buckets of coefficient and t-stat of the subjects of two groups """
+    rng = np.random.RandomState(0)
+    mask = rng.rand(*SHAPE) > 0.2
+    paths, data = [], []
+    for i in range(14):
+        coef = rng.randn(*SHAPE) + (1 if i < 8 else 0)
+        path = str(tmp_path / 'sub-{:02d}.nii'.format(i))
+        nib.Nifti1Image(np.stack([rng.randn(*SHAPE), coef], -1).astype(np.float32), np.eye(4)).to_filename(path)
+        paths.append(path)
+        data.append(coef.astype(np.float32)[mask])
+    mask_path = str(tmp_path / 'mask.nii')
+    nib.Nifti1Image(mask.astype(np.float32), np.eye(4)).to_filename(mask_path)
+    return paths[:8], paths[8:], mask_path, mask, np.array(data, dtype=np.float64)
+
+
+@pytest.mark.parametrize('two_sample', [False, True])
+@pytest.mark.parametrize('n_workers', [None, 2])
+def test_ttest_func(tmp_path, subjects, two_sample, n_workers):
+    from scipy.stats import ttest_1samp, ttest_ind
+    group_a, group_b, mask_path, mask, data = subjects
+    output, resid = str(tmp_path / 'ttest.nii'), str(tmp_path / 'resid.nii')
+    stderr = io.StringIO()
+    assert funcs.ttest_func(group_a, output, resid, groupB=group_b if two_sample else None, mask=mask_path,
+                            n_iter=20, seed=3, n_workers=n_workers, stdout=io.StringIO(), stderr=stderr) == 0, \
+        stderr.getvalue()
+    stats = np.asarray(nib.load(output).dataobj)[mask]
+    if two_sample:
+        n_a, expected = 8, ttest_ind(data[:8], data[8:]).statistic
+        resid_data = np.concatenate([data[:8] - data[:8].mean(0), data[8:] - data[8:].mean(0)])
+    else:
+        n_a, expected = None, ttest_1samp(data[:8], 0).statistic
+        data = data[:8]
+        resid_data = data - data.mean(0)
+    np.testing.assert_allclose(stats[:, 1], expected, rtol=1e-5)
+    np.testing.assert_allclose(np.asarray(nib.load(resid).dataobj)[mask], resid_data.T, rtol=1e-5, atol=1e-6)
+
+    thresholds = group.t_thresholds(group.P_THRESHOLDS, data.shape[0] - (2 if two_sample else 1))
+    max_sizes = _null_reference(resid_data, n_a, mask, thresholds, 2, 20, 3)
+    # the table is the same regardless of the number of workers
+    np.testing.assert_array_equal(_read_table(funcs.clustsim_path(output, 2)),
+                                  group.cluster_thresholds(max_sizes, group.ALPHAS))
@@ -0,0 +1,66 @@
+""" Tests of the resource usage records """
+import os
+import inspect
+import subprocess
+import threading
+import pytest
+
+for module in ('pynipt', 'slfmri', 'shleeh'):
+    pytest.importorskip(module)
+
+from uncch_core import instrument
+
+
+def write_func(input, output, size=1024, barrier=None):
+    if barrier is not None:
+        barrier.wait()
+    with open(output, 'wb') as f:
+        f.write(os.urandom(size))
+    return 0
+
+
+def test_profiled_keeps_arguments(tmp_path):
+    record_path = str(tmp_path / 'stage.jsonl')
+    wrapper = instrument.profiled(write_func, record_path, 'stage', 'step', str(tmp_path))
+    assert inspect.signature(wrapper) == inspect.signature(write_func)
+
+
+def test_profiled_records(tmp_path):
+    record_path = str(tmp_path / 'stage.jsonl')
+    os.makedirs(str(tmp_path / 'sub-01'))
+    wrapper = instrument.profiled(write_func, record_path, 'stage', 'step', str(tmp_path))
+    wrapper(input=None, output=str(tmp_path / 'sub-01' / 'out.bin'))
+    record, = instrument.load_records(record_path)
+    assert set(record) == set(instrument.FIELDS)
+    assert (record['subject'], record['file'], record['returncode'], record['scope']) == \
+        ('sub-01', 'out.bin', 0, 'job')
+    assert record['write_bytes'] % instrument.BLOCK_SIZE == 0
+
+
+@pytest.mark.skipif(not hasattr(instrument.resource, 'RUSAGE_THREAD'), reason='per-thread usage is not available')
+def test_concurrent_jobs_are_measured_by_thread(tmp_path):
+    record_path = str(tmp_path / 'stage.jsonl')
+    wrapper = instrument.profiled(write_func, record_path, 'stage', 'step', str(tmp_path))
+    barrier = threading.Barrier(2)
+    threads = [threading.Thread(target=wrapper, kwargs=dict(input=None, output=str(tmp_path / '{}.bin'.format(i)),
+                                                            barrier=barrier)) for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [r['scope'] for r in instrument.load_records(record_path)] == ['thread', 'thread']
+
+
+def test_wrap_command_quotes_arguments(tmp_path):
+    step_path = tmp_path / 'project with space' / 'step'
+    os.makedirs(str(step_path / 'sub-01'))
+    record_path = str(tmp_path / 'project with space' / '.profile' / 'stage.jsonl')
+    output = str(step_path / 'sub-01' / 'out.txt')
+    cmd = instrument.wrap_command('touch {}'.format(output.replace(' ', '\\ ')), record_path,
+                                  'stage', 'step', str(step_path), 3, output)
+    assert subprocess.call(cmd, shell=True) == 0
+    record, = instrument.load_records(record_path)
+    assert (record['subject'], record['file'], record['job'], record['returncode'], record['scope']) == \
+        ('sub-01', 'out.txt', 3, 0, 'job')
+    # the commands and the python functions report the block IO of the storage
+    assert record['read_bytes'] % instrument.BLOCK_SIZE == 0
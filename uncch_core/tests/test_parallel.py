@@ -0,0 +1,56 @@
+""" Tests of the process pool on shared buffers """
+import os
+import sys
+import subprocess
+import numpy as np
+import pytest
+
+for module in ('pynipt', 'slfmri', 'shleeh'):
+    pytest.importorskip(module)
+
+from uncch_core.parallel import SharedPool, split_chunks
+
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = '''
+import numpy as np
+from uncch_core.parallel import SharedPool
+
+{guard}
+    print('started')
+    with SharedPool(2, x=((4,), np.float64)) as pool:
+        print(pool.n_workers)
+'''
+
+
+def _square_task(arrays, task):
+    start, end = task
+    arrays['output'][start:end] = arrays['input'][start:end] ** 2
+    return end - start
+
+
+def test_split_chunks():
+    assert split_chunks(10, 3) == [(0, 3), (3, 6), (6, 10)]
+    assert split_chunks(2, 4) == [(0, 1), (1, 2)]
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_shared_pool(n_workers):
+    data = np.random.RandomState(0).randn(100)
+    with SharedPool(n_workers, input=((100,), np.float64), output=((100,), np.float64)) as pool:
+        pool['input'][:] = data
+        assert sum(pool.map(_square_task, split_chunks(100, 8))) == 100
+        np.testing.assert_array_equal(pool['output'], data ** 2)
+
+
+@pytest.mark.parametrize('guarded', [True, False])
+def test_main_script_guard(tmp_path, guarded):
+    script = tmp_path / 'run.py'
+    script.write_text(SCRIPT.format(guard="if __name__ == '__main__':" if guarded else 'if True:'))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([PACKAGE_PATH] + [p for p in [env.get('PYTHONPATH')] if p])
+    result = subprocess.run([sys.executable, str(script)], env=env, cwd=str(tmp_path), timeout=60,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    # the unguarded script is not executed again by the workers
+    assert result.stdout.decode().split() == ['started', '2' if guarded else '1']
+    assert (b'not guarded' in result.stderr) is not guarded
@@ -0,0 +1,198 @@
+""" Tests of the native resampling and its cache """
+import io
+import os
+from types import SimpleNamespace
+import numpy as np
+import nibabel as nib
+import pytest
+
+for module in ('pynipt', 'slfmri', 'shleeh'):
+    pytest.importorskip(module)
+
+from uncch_core import transform, funcs
+from uncch_core.builder import get_cache_dir
+from uncch_core.scratch import ScratchSpace
+
+
+def make_resampler(grid_shape=(4, 5, 6), src_shape=(5, 6, 7), seed=0):
+    rng = np.random.RandomState(seed)
+    coords = rng.uniform(-1, np.array(src_shape).reshape(3, 1), size=(3, int(np.prod(grid_shape))))
+    return transform.Resampler.from_coordinates(coords, grid_shape, src_shape)
+
+
+def test_resampler_cache_in_memory(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    cache = transform.ResamplerCache()
+    resampler = cache.get('key', make_resampler)
+    assert cache.get('key', lambda: None) is resampler
+    assert cache.path is None
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_resampler_cache_on_disk(tmp_path):
+    resampler = transform.ResamplerCache(str(tmp_path)).get('key', make_resampler)
+    # a new process loads the stored resampler instead of evaluating the transforms
+    restored = transform.ResamplerCache(str(tmp_path)).get('key', lambda: None)
+    data = np.random.RandomState(1).randn(5, 6, 7, 3)
+    np.testing.assert_array_equal(restored.apply(data), resampler.apply(data))
+
+
+def test_default_cache_dir(tmp_path):
+    processor = SimpleNamespace(bucket=SimpleNamespace(path=str(tmp_path / 'project')))
+    assert get_cache_dir(processor, 'resampler') == str(tmp_path / 'project' / '.cache' / 'resampler')
+
+    processor._scratch = ScratchSpace(str(tmp_path / 'scratch'))
+    try:
+        assert get_cache_dir(processor, 'resampler') == processor._scratch.step_path('.cache', 'resampler')
+    finally:
+        processor._scratch.cleanup()
+
+
+# [user-016] single-interpolation combined transform, the reference is map_coordinates on the composed points
+
+RAS_TO_LPS = np.diag([-1., -1., 1., 1.])
+BASE_AFFINE = np.array([[-1.2, 0, 0, 3], [0, 1.2, 0, -2.4], [0, 0, 1., -1.5], [0, 0, 0, 1]])
+SRC_AFFINE = np.array([[-1.5, 0, 0, 4], [0, 1.5, 0, -4.5], [0, 0, 1.5, -3], [0, 0, 0, 1]])
+# coregistration (anatomy to input), normalization affine and the linear displacement field in LPS mm
+COREG = np.array([[0.99, -0.05, 0, 0.3], [0.05, 0.99, 0, -0.2], [0, 0, 1., 0.1], [0, 0, 0, 1]])
+NORM = np.array([[1.05, 0.02, 0, 0.5], [-0.02, 0.95, 0.03, 0.2], [0, -0.03, 1.02, -0.4], [0, 0, 0, 1]])
+NORM_CENTER = np.array([1., -0.5, 0.5])
+DISPLACEMENT = np.array([[0.02, 0.01, 0, 0.3], [0, -0.03, 0.02, -0.1], [0.01, 0, 0.02, 0.2]])
+
+
+def save_image(path, data, affine):
+    nib.Nifti1Image(np.asarray(data, dtype=np.float32), affine).to_filename(str(path))
+    return str(path)
+
+
+def save_afni_matrix(path, affine):
+    np.savetxt(str(path), affine[:3].reshape(1, 12), header='3dAllineate matrices (DICOM-to-DICOM)')
+    return str(path)
+
+
+def save_ants_affine(path, affine, center):
+    from scipy.io import savemat
+    # ANTs stores the matrix and the translation about the fixed center
+    translation = affine[:3, 3] - center + affine[:3, :3].dot(center)
+    params = np.concatenate([affine[:3, :3].ravel(), translation]).reshape(12, 1)
+    savemat(str(path), {'AffineTransform_double_3_3': params, 'fixed': center.reshape(3, 1)})
+    return str(path)
+
+
+def save_warp(path):
+    # the field covers the base grid, the linear displacement is exact with trilinear interpolation
+    affine = np.array([[-1., 0, 0, 8], [0, 1., 0, -8], [0, 0, 1., -7], [0, 0, 0, 1]])
+    voxels = np.mgrid[:17, :17, :15].reshape(3, -1).astype(np.float64)
+    points = RAS_TO_LPS[:3, :3].dot(affine[:3, :3].dot(voxels) + affine[:3, 3:])
+    field = (DISPLACEMENT[:, :3].dot(points) + DISPLACEMENT[:, 3:]).T.reshape(17, 17, 15, 1, 3)
+    nib.Nifti1Image(field.astype(np.float32), affine).to_filename(str(path))
+    return str(path)
+
+
+def _reference_coords(affines):
+    """ source voxel coordinates of each base voxel through the chain, applied one point at a time """
+    coords = []
+    for idx in np.ndindex(6, 5, 4):
+        point = RAS_TO_LPS.dot(BASE_AFFINE).dot(list(idx) + [1.])
+        for affine in affines:
+            if affine is None:
+                point[:3] += DISPLACEMENT[:, :3].dot(point[:3]) + DISPLACEMENT[:, 3]
+            else:
+                point = affine.dot(point)
+        coords.append(np.linalg.inv(RAS_TO_LPS.dot(SRC_AFFINE)).dot(point)[:3])
+    return np.array(coords).T
+
+
+def _reference_resample(data, coords):
+    from scipy.ndimage import map_coordinates
+    volumes = [map_coordinates(data[..., t], coords, order=1, mode='constant', cval=0).reshape(6, 5, 4)
+               for t in range(data.shape[-1])]
+    return np.stack(volumes, -1)
+
+
+@pytest.fixture
+def images(tmp_path):
+    data = np.random.RandomState(0).rand(7, 6, 5, 8) * 100
+    return (save_image(tmp_path / 'input.nii', data, SRC_AFFINE),
+            save_image(tmp_path / 'base.nii', np.zeros((6, 5, 4)), BASE_AFFINE),
+            data.astype(np.float32).astype(np.float64))
+
+
+@pytest.mark.parametrize('options', [dict(), dict(mem_limit=0.01, n_threads=2)])
+def test_combined_transform_ants(tmp_path, images, options):
+    input_path, base_path, data = images
+    output = str(tmp_path / 'output.nii')
+    assert funcs.combined_transform_func(input_path, output, base_path,
+                                         save_afni_matrix(tmp_path / 'coreg.aff12.1D', COREG),
+                                         save_ants_affine(tmp_path / 'norm.mat', NORM, NORM_CENTER),
+                                         tfmorph=save_warp(tmp_path / 'norm_1Warp.nii.gz'),
+                                         stdout=io.StringIO(), stderr=io.StringIO(), **options) == 0
+    expected = _reference_resample(data, _reference_coords([None, NORM, COREG]))
+    assert np.count_nonzero(expected[..., 0]) > 100
+    np.testing.assert_allclose(np.asarray(nib.load(output).dataobj), expected, rtol=1e-4, atol=1e-3)
+
+
+def test_combined_transform_afni(tmp_path, images):
+    input_path, base_path, data = images
+    output = str(tmp_path / 'output.nii')
+    assert funcs.combined_transform_func(input_path, output, base_path,
+                                         save_afni_matrix(tmp_path / 'coreg.aff12.1D', COREG),
+                                         save_afni_matrix(tmp_path / 'norm.aff12.1D', NORM),
+                                         stdout=io.StringIO(), stderr=io.StringIO()) == 0
+    expected = _reference_resample(data, _reference_coords([NORM, COREG]))
+    np.testing.assert_allclose(np.asarray(nib.load(output).dataobj), expected, rtol=1e-4, atol=1e-3)
+
+
+# [user-017] precomputed trilinear resampling, the reference is map_coordinates(order=1, mode='constant')
+
+@pytest.mark.parametrize('src_shape', [(5, 6, 7), (5, 6, 1)])
+@pytest.mark.parametrize('n_vols', [None, 3])
+def test_resampler_matches_map_coordinates(src_shape, n_vols):
+    from scipy.ndimage import map_coordinates
+    rng = np.random.RandomState(0)
+    coords = rng.uniform(-1, np.array(src_shape).reshape(3, 1), size=(3, 4 * 5 * 6))
+    if src_shape[2] == 1:
+        # single slice, only the points on the slice are inside the image
+        coords[2, ::2] = 0
+    data = rng.randn(*src_shape + (() if n_vols is None else (n_vols,)))
+    resampled = transform.Resampler.from_coordinates(coords, (4, 5, 6), src_shape).apply(data)
+    volumes = data[..., np.newaxis] if n_vols is None else data
+    expected = np.stack([map_coordinates(volumes[..., t], coords, order=1, mode='constant', cval=0)
+                         for t in range(volumes.shape[-1])], -1).reshape(resampled.shape)
+    np.testing.assert_allclose(resampled, expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('options', [dict(), dict(mem_limit=0.01, n_threads=2)])
+def test_spatial_norm_ants(tmp_path, images, options):
+    input_path, base_path, data = images
+    output = str(tmp_path / 'output.nii')
+    assert funcs.spatial_norm_func(input_path, output, base_path,
+                                   save_ants_affine(tmp_path / 'norm.mat', NORM, NORM_CENTER),
+                                   tfmorph=save_warp(tmp_path / 'norm_1Warp.nii.gz'),
+                                   stdout=io.StringIO(), stderr=io.StringIO(), **options) == 0
+    expected = _reference_resample(data, _reference_coords([None, NORM]))
+    np.testing.assert_allclose(np.asarray(nib.load(output).dataobj), expected, rtol=1e-4, atol=1e-3)
+
+
+def test_spatial_norm_afni(tmp_path, images):
+    input_path, base_path, data = images
+    output = str(tmp_path / 'output.nii')
+    assert funcs.spatial_norm_func(input_path, output, base_path,
+                                   save_afni_matrix(tmp_path / 'norm.aff12.1D', NORM),
+                                   stdout=io.StringIO(), stderr=io.StringIO()) == 0
+    expected = _reference_resample(data, _reference_coords([NORM]))
+    np.testing.assert_allclose(np.asarray(nib.load(output).dataobj), expected, rtol=1e-4, atol=1e-3)
+
+
+def test_spatial_norm_cached_runs(tmp_path, images):
+    # the other runs of the subject reuse the stored resampler
+    input_path, base_path, data = images
+    tfmat = save_afni_matrix(tmp_path / 'norm.aff12.1D', NORM)
+    cache_dir = str(tmp_path / 'cache')
+    outputs = [str(tmp_path / 'output{}.nii'.format(i)) for i in range(2)]
+    for output in outputs:
+        assert funcs.spatial_norm_func(input_path, output, base_path, tfmat, cache_dir=cache_dir,
+                                       stdout=io.StringIO(), stderr=io.StringIO()) == 0
+    assert len(os.listdir(cache_dir)) > 0
+    np.testing.assert_array_equal(np.asarray(nib.load(outputs[1]).dataobj),
+                                  np.asarray(nib.load(outputs[0]).dataobj))
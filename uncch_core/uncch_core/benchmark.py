@@ -0,0 +1,535 @@
+""" Benchmark of the native functions and the interface steps on synthetic datasets
+
+The datasets are generated without real scans: an ellipsoid brain-like mask, BOLD-like signal
+(tissue contrast, slow drift and AR(1) noise) and block-design responses in a spherical active region.
+Each native function is timed for the data sizes and the worker counts, and the results are saved as JSON
+with the versions of the packages, so that the results of two versions can be compared by compare().
+The interface steps are timed through the pynipt pipeline on a synthetic BIDS project,
+using the run report of the steps (see instrument module).
+
+Example:
+    python -m uncch_core.benchmark --sizes small medium --workers 1 2 4 --output bench-new.json --baseline bench-old.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+from collections import OrderedDict
+import numpy as np
+import nibabel as nib
+
+from .nifti import SlabWriter, save_image
+from .glm import stim_regressor
+
+# (x, y, z) shape and number of volumes
+SIZES = OrderedDict([('tiny', ((32, 32, 12), 60)),
+                     ('small', ((64, 64, 16), 120)),
+                     ('medium', ((96, 96, 32), 200)),
+                     ('large', ((128, 128, 48), 300))])
+TR = 2.0
+VOXEL_SIZE = (0.3, 0.3, 0.5)
+BLOCK_DURATION = 20
+BLOCK_INTERVAL = 60
+
+
+def make_mask(shape, scale=0.42):
+    """ ellipsoid brain-like mask
+        Args:
+            shape: (x, y, z) shape
+            scale: semi-axes of the ellipsoid relative to the field of view
+        Returns:
+            (x, y, z) uint8 array
+    """
+    grid = np.meshgrid(*[(np.arange(n) - (n - 1) / 2.) / (n * scale) for n in shape], indexing='ij')
+    return (sum(g ** 2 for g in grid) <= 1).astype(np.uint8)
+
+
+def make_active(shape, mask, radius=0.15):
+    """ spherical active region in the mask, off the center of the field of view """
+    center = [n * 0.5 for n in shape]
+    center[0] = shape[0] * 0.65
+    grid = np.meshgrid(*[(np.arange(n) - c) / n for n, c in zip(shape, center)], indexing='ij')
+    return ((sum(g ** 2 for g in grid) <= radius ** 2) & (mask > 0)).astype(np.uint8)
+
+
+def get_onset_time(n_vols, tr=TR, duration=BLOCK_DURATION, interval=BLOCK_INTERVAL):
+    """ onset time of the blocks in second """
+    return list(range(duration, int(n_vols * tr) - duration, interval))
+
+
+def make_affine(shape, voxel_size=VOXEL_SIZE):
+    affine = np.diag(list(voxel_size) + [1.])
+    affine[:3, 3] = -np.array(shape) * voxel_size / 2.
+    return affine
+
+
+def make_bold(path, shape, n_vols, tr=TR, onset_time=None, duration=BLOCK_DURATION, amplitude=0.02,
+              noise=0.01, rho=0.3, drift=0.01, voxel_size=VOXEL_SIZE, seed=0, n_threads=None):
+    """ write BLOCK-design BOLD-like 4D image, the image is generated by z-slabs to bound the memory usage
+        Args:
+            path: file path for output destination (.nii or .nii.gz)
+            shape: (x, y, z) shape
+            n_vols: number of volumes
+            tr: repetition time in second
+            onset_time: onset time of the blocks in second, see get_onset_time if None
+            duration: duration of the blocks in second
+            amplitude: response amplitude relative to the baseline
+            noise: standard deviation of the noise relative to the baseline
+            rho: AR(1) coefficient of the noise
+            drift: linear drift over the run relative to the baseline
+            voxel_size: voxel size in mm
+            seed: random seed
+            n_threads: number of threads for compression
+        Returns:
+            mask, active region
+    """
+    if onset_time is None:
+        onset_time = get_onset_time(n_vols, tr, duration)
+    rng = np.random.RandomState(seed)
+    mask = make_mask(shape)
+    active = make_active(shape, mask)
+    response = stim_regressor(onset_time, 'BLOCK', [duration, 1], tr, n_vols).astype(np.float32)
+    trend = np.linspace(0, drift, n_vols, dtype=np.float32)
+
+    # tissue contrast, brighter in the center of the brain
+    grid = np.meshgrid(*[(np.arange(n) - (n - 1) / 2.) / n for n in shape], indexing='ij')
+    radius = np.sqrt(sum(g ** 2 for g in grid))
+    baseline = np.where(mask > 0, 800 + 400 * np.cos(np.pi * np.minimum(radius * 2, 1)), 20).astype(np.float32)
+
+    affine = make_affine(shape, voxel_size)
+    header = nib.Nifti1Header()
+    header.set_data_shape(tuple(shape) + (n_vols,))
+    header.set_data_dtype(np.float32)
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_xyzt_units(xyz='mm', t='sec')
+    header['pixdim'][4] = tr
+
+    slab_size = max(1, int(64 * 1024 ** 2 // (shape[0] * shape[1] * n_vols * 4)))
+    with SlabWriter(path, header, n_threads) as writer:
+        for z0 in range(0, shape[2], slab_size):
+            z1 = min(z0 + slab_size, shape[2])
+            base = baseline[:, :, z0:z1, np.newaxis]
+            innovation = rng.standard_normal(base.shape[:3] + (n_vols,)).astype(np.float32)
+            ts = np.empty_like(innovation)
+            ts[..., 0] = innovation[..., 0]
+            scale = np.float32(np.sqrt(1 - rho ** 2))
+            for t in range(1, n_vols):
+                ts[..., t] = rho * ts[..., t - 1] + scale * innovation[..., t]
+            signal = 1 + trend + amplitude * response * active[:, :, z0:z1, np.newaxis] + noise * ts
+            writer.write(z0, z1, base * signal)
+    return mask, active
+
+
+def make_dataset(path, shape, n_vols, tr=TR, ext='nii.gz', seed=0, n_threads=None, **kwargs):
+    """ write synthetic dataset into the folder
+        Args:
+            path: output folder
+            shape: (x, y, z) shape
+            n_vols: number of volumes
+            tr: repetition time in second
+            ext: file extension of the images, 'nii' or 'nii.gz'
+            seed: random seed
+            n_threads: number of threads for compression
+            kwargs: options for make_bold
+        Returns:
+            dict of the file paths (func, mask, active, base, tfmat) and the design (tr, onset_time, model, parameters)
+    """
+    os.makedirs(path, exist_ok=True)
+    onset_time = kwargs.pop('onset_time', None) or get_onset_time(n_vols, tr)
+    duration = kwargs.pop('duration', BLOCK_DURATION)
+    dataset = dict(func=os.path.join(path, 'func.{}'.format(ext)),
+                   mask=os.path.join(path, 'mask.{}'.format(ext)),
+                   active=os.path.join(path, 'active.{}'.format(ext)),
+                   base=os.path.join(path, 'base.{}'.format(ext)),
+                   tfmat=os.path.join(path, 'base2func.aff12.1D'),
+                   tr=tr, onset_time=onset_time, model='BLOCK', parameters=[duration, 1])
+    mask, active = make_bold(dataset['func'], shape, n_vols, tr, onset_time, duration,
+                             seed=seed, n_threads=n_threads, **kwargs)
+    affine = make_affine(shape, kwargs.get('voxel_size', VOXEL_SIZE))
+    save_image(nib.Nifti1Image(mask, affine), dataset['mask'], n_threads)
+    save_image(nib.Nifti1Image(active, affine), dataset['active'], n_threads)
+    save_image(nib.Nifti1Image(mask.astype(np.float32) * 1000, affine), dataset['base'], n_threads)
+
+    # small rotation and shift from the template (base) to the functional space
+    theta = np.deg2rad(3)
+    matrix = np.eye(4)
+    matrix[:2, :2] = [[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]]
+    matrix[:3, 3] = [0.4, -0.3, 0.2]
+    np.savetxt(dataset['tfmat'], matrix[:3].reshape(1, 12), fmt='%.6f')
+    return dataset
+
+
+def make_project(path, n_subjects, shape, n_vols, n_sessions=None, ext='nii.gz', seed=0, n_threads=None):
+    """ write synthetic BIDS project for the interface steps, '<path>/Data/sub-XX[/ses-XX]/func'
+        Args:
+            path: project folder
+            n_subjects: number of subjects
+            shape: (x, y, z) shape
+            n_vols: number of volumes
+            n_sessions: number of sessions of each subject, no session folder if None
+            ext: file extension of the images
+            seed: random seed, the runs are generated with different seeds
+            n_threads: number of threads for compression
+        Returns:
+            dict of the mask path and the design (tr, onset_time, model, parameters)
+    """
+    data_path = os.path.join(path, 'Data')
+    os.makedirs(data_path, exist_ok=True)
+    with open(os.path.join(data_path, 'dataset_description.json'), 'w') as f:
+        json.dump(dict(Name='uncch_core benchmark', BIDSVersion='1.2.0'), f, indent=2)
+    sessions = [None] if n_sessions is None else ['ses-{:02d}'.format(i + 1) for i in range(n_sessions)]
+    run = 0
+    for i in range(n_subjects):
+        subject = 'sub-{:02d}'.format(i + 1)
+        for session in sessions:
+            folder = os.path.join(data_path, subject, *([session] if session else []), 'func')
+            os.makedirs(folder, exist_ok=True)
+            fname = '_'.join([subject] + ([session] if session else []) + ['task-block_bold.{}'.format(ext)])
+            make_bold(os.path.join(folder, fname), shape, n_vols, seed=seed + run, n_threads=n_threads)
+            run += 1
+    mask_path = os.path.join(path, 'Masks', 'mask.nii.gz')
+    os.makedirs(os.path.dirname(mask_path), exist_ok=True)
+    save_image(nib.Nifti1Image(make_mask(shape), make_affine(shape)), mask_path, n_threads)
+    return dict(mask=mask_path, tr=TR, onset_time=get_onset_time(n_vols), model='BLOCK',
+                parameters=[BLOCK_DURATION, 1])
+
+
+# name: (function in funcs module, option for the number of workers, options from the dataset)
+BENCHMARKS = OrderedDict([
+    ('periodogram', ('periodogram_func', 'n_workers',
+                     lambda d: dict(mask=d['mask'], dt=d['tr'], nfft=256, bands=[[0.01, 0.1]]))),
+    ('meanimage', ('meanimage_func', None, lambda d: dict())),
+    ('calc', ('calc_func', None, lambda d: dict(expr='b*min(200, a/tmean(a)*100)', mask=d['mask']))),
+    ('slicetiming', ('slicetiming_func', 'n_workers', lambda d: dict(tr=d['tr'], tpattern='altplus'))),
+    ('blur', ('blur_func', 'n_threads', lambda d: dict(fwhm=0.5, mask=d['mask']))),
+    ('glm', ('glm_func', 'n_workers',
+             lambda d: dict(onset_time=d['onset_time'], model=d['model'], parameters=d['parameters'],
+                            mask=d['mask'], cache_dir=d['cache_dir']))),
+    ('glm_chain', ('glm_chain_func', 'n_workers',
+                   lambda d: dict(mask=d['mask'], fwhm=0.5, onset_time=d['onset_time'], model=d['model'],
+                                  parameters=d['parameters'], cache_dir=d['cache_dir']))),
+    ('spatial_norm', ('spatial_norm_func', 'n_threads',
+                      lambda d: dict(base=d['base'], tfmat=d['tfmat'], cache_dir=d['cache_dir']))),
+])
+
+# interface method of the scratch package and its options from the project
+INTERFACE_BENCHMARKS = OrderedDict([
+    ('camri_Periodogram', ('n_workers', lambda p: dict(mask_path=p['mask'], dt=p['tr'], nfft=256,
+                                                       bands=[[0.01, 0.1]]))),
+    ('camri_SliceTimingCorrection', ('n_workers', lambda p: dict(tr=p['tr'], tpattern='altplus'))),
+    ('camri_BlurInMask', ('n_threads', lambda p: dict(fwhm=0.5, mask_path=p['mask']))),
+    ('camri_GLM', ('n_workers', lambda p: dict(mask_path=p['mask'], onset_time=p['onset_time'],
+                                               model=p['model'], parameters=p['parameters']))),
+])
+
+
+def get_environment(label=None):
+    """ versions and the machine of the benchmark """
+    def version(module):
+        try:
+            return __import__(module).__version__
+        except Exception:
+            return None
+
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                           cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    try:
+        import pkg_resources
+        package_version = pkg_resources.get_distribution('pynipt-plugin-uncch_core').version
+    except Exception:
+        package_version = None
+    return dict(label=label, version=package_version, revision=revision,
+                python=platform.python_version(), numpy=np.__version__,
+                scipy=version('scipy'), nibabel=nib.__version__, pynipt=version('pynipt'),
+                platform=platform.platform(), machine=platform.machine(), hostname=socket.gethostname(),
+                cpu_count=os.cpu_count(), time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def _usage():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = self_usage.ru_utime + self_usage.ru_stime + child_usage.ru_utime + child_usage.ru_stime
+    # kilobytes on linux
+    return cpu, max(self_usage.ru_maxrss, child_usage.ru_maxrss) * 1024
+
+
+class _Stream(object):
+    """ discard the messages, keep the errors """
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, message):
+        self.lines.append(message)
+
+    def flush(self):
+        pass
+
+
+def time_call(func, repeat=1, **kwargs):
+    """ time the native function
+        Args:
+            func: native function which returns 0 if success
+            repeat: number of repetitions, the minimum wall time is reported
+            kwargs: arguments of the function
+        Returns:
+            dict of wall (min and mean), cpu, max_rss (peak of the process so far) and the error message if failed
+    """
+    walls, cpus = [], []
+    error = None
+    for _ in range(repeat):
+        stderr = _Stream()
+        cpu0, _ = _usage()
+        start = time.perf_counter()
+        returncode = func(stdout=_Stream(), stderr=stderr, **kwargs)
+        walls.append(time.perf_counter() - start)
+        cpus.append(_usage()[0] - cpu0)
+        if returncode != 0:
+            error = ''.join(stderr.lines)
+            break
+    return dict(wall=min(walls), wall_mean=float(np.mean(walls)), cpu=min(cpus),
+                max_rss=_usage()[1], error=error)
+
+
+def _warm_up(funcs, names, path, ext):
+    dataset = make_dataset(path, (16, 16, 8), 60, ext=ext)
+    dataset['cache_dir'] = os.path.join(path, 'cache')
+    for name in names:
+        func_name, _, get_options = BENCHMARKS[name]
+        getattr(funcs, func_name)(input=dataset['func'], output=os.path.join(path, '{}.{}'.format(name, ext)),
+                                  stdout=_Stream(), stderr=_Stream(), **get_options(dataset))
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def run_benchmarks(sizes=('tiny', 'small'), workers=(1, 2), names=None, repeat=1, workspace=None,
+                   ext='nii.gz', label=None, output=None, verbose=True):
+    """ time the native functions on the synthetic datasets
+        Args:
+            sizes: names of SIZES or (shape, n_vols) pairs
+            workers: numbers of workers (or threads), the functions without the option run once
+            names: names of BENCHMARKS to run, all if None
+            repeat: number of repetitions for each condition
+            workspace: folder for the datasets and outputs, temporary folder if None
+            ext: file extension of the datasets, 'nii' or 'nii.gz'
+            label: label of the results (e.g. version to be compared)
+            output: file path to save the results (.json)
+            verbose: print the results
+        Returns:
+            dict of environment and results
+    """
+    from . import funcs
+    names = list(BENCHMARKS.keys()) if names is None else list(names)
+    remove = workspace is None
+    workspace = tempfile.mkdtemp(prefix='uncch-bench-') if workspace is None else workspace
+    results = []
+    try:
+        # the first call of each function includes the imports and the start-up of the libraries
+        _warm_up(funcs, names, os.path.join(workspace, 'warm-up'), ext)
+        for size in sizes:
+            size_name, (shape, n_vols) = (size, SIZES[size]) if isinstance(size, str) else ('custom', size)
+            data_path = os.path.join(workspace, '{}_{}x{}x{}x{}'.format(size_name, *shape, n_vols))
+            dataset = make_dataset(data_path, shape, n_vols, ext=ext, n_threads=os.cpu_count())
+            dataset['cache_dir'] = os.path.join(data_path, 'cache')
+            for name in names:
+                func_name, worker_option, get_options = BENCHMARKS[name]
+                for n_workers in (workers if worker_option else [None]):
+                    kwargs = get_options(dataset)
+                    if worker_option:
+                        kwargs[worker_option] = n_workers
+                    out_path = os.path.join(data_path, '{}.{}'.format(name, ext))
+                    # the design matrix and the resampler are cached from the second call as in a pipeline
+                    shutil.rmtree(dataset['cache_dir'], ignore_errors=True)
+                    result = time_call(getattr(funcs, func_name), repeat,
+                                       input=dataset['func'], output=out_path, **kwargs)
+                    result.update(name=name, size=size_name, shape=list(shape), n_vols=n_vols,
+                                  workers=n_workers, repeat=repeat)
+                    results.append(result)
+                    if os.path.exists(out_path):
+                        os.remove(out_path)
+                    if verbose:
+                        print(format_result(result))
+    finally:
+        if remove:
+            shutil.rmtree(workspace, ignore_errors=True)
+    report = dict(environment=get_environment(label), results=results)
+    if output is not None:
+        save_results(report, output)
+    return report
+
+
+def _wait(interface, timeout=None):
+    start = time.time()
+    while len(interface.waiting_list) != 0:
+        if timeout is not None and time.time() - start > timeout:
+            raise TimeoutError('the steps are not finished in {} seconds'.format(timeout))
+        time.sleep(1)
+
+
+def run_interface_benchmarks(sizes=('tiny',), workers=(1, 2), names=None, n_subjects=2, workspace=None,
+                             label=None, output=None, timeout=None, verbose=True):
+    """ time the interface steps through the pynipt pipeline on the synthetic projects,
+    the wall time of each step and the resource usage of its jobs are taken from the run report
+        Args:
+            sizes: names of SIZES or (shape, n_vols) pairs
+            workers: numbers of workers (or threads) of each job
+            names: names of INTERFACE_BENCHMARKS to run, all if None
+            n_subjects: number of subjects of the project
+            workspace: folder for the projects, temporary folder if None
+            label: label of the results
+            output: file path to save the results (.json)
+            timeout: timeout of each step in seconds
+            verbose: print the results
+        Returns:
+            dict of environment and results
+    """
+    import pynipt as pn
+    from .builder import set_profiling
+    from .instrument import get_record_path, load_records, PROFILE_DIR
+    names = list(INTERFACE_BENCHMARKS.keys()) if names is None else list(names)
+    remove = workspace is None
+    workspace = tempfile.mkdtemp(prefix='uncch-bench-') if workspace is None else workspace
+    results = []
+    try:
+        for size in sizes:
+            size_name, (shape, n_vols) = (size, SIZES[size]) if isinstance(size, str) else ('custom', size)
+            for n_workers in workers:
+                path = os.path.join(workspace, '{}_{}x{}x{}x{}_w{}'.format(size_name, *shape, n_vols, n_workers))
+                project = make_project(path, n_subjects, shape, n_vols, n_threads=os.cpu_count())
+                pipe = pn.Pipeline(path, logging=False, verbose=False)
+                pipe.set_scratch_package('Benchmark')
+                interface = pipe.interface
+                stage = 'benchmark'
+                set_profiling(interface, stage)
+                for idx, name in enumerate(names):
+                    worker_option, get_options = INTERFACE_BENCHMARKS[name]
+                    kwargs = get_options(project)
+                    kwargs[worker_option] = n_workers
+                    start = time.time()
+                    getattr(interface, name)(input_path='func', step_idx=idx + 1, sub_code='0', **kwargs)
+                    _wait(interface, timeout)
+                    wall = time.time() - start
+                    records = [r for r in load_records(get_record_path(path, stage))
+                               if r['start'] >= start - 1]
+                    result = dict(name=name, size=size_name, shape=list(shape), n_vols=n_vols,
+                                  workers=n_workers, n_subjects=n_subjects, wall=wall,
+                                  n_jobs=len(records),
+                                  job_wall=sum(r['wall'] for r in records),
+                                  cpu=sum(r['cpu_user'] + r['cpu_system'] for r in records),
+                                  max_rss=max([r['max_rss'] or 0 for r in records] + [0]),
+                                  error=None if all(r['returncode'] == 0 for r in records) and records
+                                  else 'failed jobs, see {}'.format(os.path.join(path, PROFILE_DIR)))
+                    results.append(result)
+                    if verbose:
+                        print(format_result(result))
+                if remove:
+                    shutil.rmtree(path, ignore_errors=True)
+    finally:
+        if remove:
+            shutil.rmtree(workspace, ignore_errors=True)
+    report = dict(environment=get_environment(label), results=results)
+    if output is not None:
+        save_results(report, output)
+    return report
+
+
+def save_results(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def format_result(result):
+    status = 'FAILED' if result.get('error') else ''
+    return '{:<28} {:<8} workers={:<5} wall={:8.3f}s cpu={:8.3f}s rss={:8.1f}MB {}'.format(
+        result['name'], result['size'], str(result['workers']), result['wall'], result['cpu'],
+        result['max_rss'] / 1024 ** 2, status)
+
+
+def _condition(result):
+    return result['name'], result['size'], result['workers']
+
+
+def compare(baseline, current, threshold=0.1):
+    """ compare the wall time of the same conditions between two results
+        Args:
+            baseline: results (dict or path of JSON) of the reference version
+            current: results (dict or path of JSON) of the version to be checked
+            threshold: relative increase of the wall time regarded as a regression
+        Returns:
+            list of dict (name, size, workers, baseline, current, ratio, regression)
+    """
+    if isinstance(baseline, str):
+        baseline = load_results(baseline)
+    if isinstance(current, str):
+        current = load_results(current)
+    reference = {_condition(r): r for r in baseline['results'] if not r.get('error')}
+    comparison = []
+    for result in current['results']:
+        ref = reference.get(_condition(result))
+        if ref is None or result.get('error'):
+            continue
+        ratio = result['wall'] / max(ref['wall'], 1e-9)
+        comparison.append(dict(name=result['name'], size=result['size'], workers=result['workers'],
+                               baseline=ref['wall'], current=result['wall'], ratio=ratio,
+                               regression=ratio > 1 + threshold))
+    return comparison
+
+
+def format_comparison(comparison):
+    lines = ['{:<28} {:<8} {:>7} {:>10} {:>10} {:>7}'.format('name', 'size', 'workers',
+                                                              'baseline', 'current', 'ratio')]
+    for item in comparison:
+        lines.append('{:<28} {:<8} {:>7} {:>9.3f}s {:>9.3f}s {:>6.2f}x{}'.format(
+            item['name'], item['size'], str(item['workers']), item['baseline'], item['current'],
+            item['ratio'], '  REGRESSION' if item['regression'] else ''))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark of uncch_core on synthetic datasets')
+    parser.add_argument('--sizes', nargs='+', default=['tiny', 'small'], choices=list(SIZES.keys()))
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2])
+    parser.add_argument('--names', nargs='+', default=None, help='benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--ext', default='nii.gz', choices=['nii', 'nii.gz'])
+    parser.add_argument('--interface', action='store_true', help='time the interface steps (requires pynipt)')
+    parser.add_argument('--subjects', type=int, default=2, help='number of subjects for the interface steps')
+    parser.add_argument('--workspace', default=None, help='folder for the datasets (default: temporary)')
+    parser.add_argument('--label', default=None, help='label of the results, e.g. version')
+    parser.add_argument('--output', default=None, help='file path to save the results (.json)')
+    parser.add_argument('--baseline', default=None, help='results of the reference version to compare')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown regarded as a regression')
+    args = parser.parse_args(argv)
+
+    if args.interface:
+        report = run_interface_benchmarks(args.sizes, args.workers, args.names, args.subjects,
+                                          args.workspace, args.label, args.output)
+    else:
+        report = run_benchmarks(args.sizes, args.workers, args.names, args.repeat, args.workspace,
+                                args.ext, args.label, args.output)
+    if args.baseline is not None:
+        comparison = compare(args.baseline, report, args.threshold)
+        print(format_comparison(comparison))
+        if any(item['regression'] for item in comparison):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,458 @@
+import os
+import time
+import shutil
+import threading
+from pynipt import InterfaceBuilder as BaseInterfaceBuilder
+from .cache import StepCache, func_identity
+from .scratch import ScratchSpace
+from . import instrument
+
+IMAGE_EXTS = ['nii', 'nii.gz']
+# variables of the native functions for the number of worker processes or threads of each job
+WORKER_LABELS = ['n_workers', 'n_threads']
+# variables of the resources, which do not change the results and are not included in the job keys
+RESOURCE_LABELS = WORKER_LABELS + ['mem_limit', 'group_size', 'cache_dir']
+
+
+class CoreBudget(object):
+    """ Counting semaphore of the cores shared by the concurrently running steps """
+
+    def __init__(self, n_cores):
+        self._n_cores = max(int(n_cores), 1)
+        self._n_used = 0
+        self._cond = threading.Condition()
+
+    @property
+    def n_cores(self):
+        return self._n_cores
+
+    def acquire(self, n):
+        """ wait until n cores are available, a step larger than the budget runs alone """
+        n = min(max(int(n), 1), self._n_cores)
+        with self._cond:
+            while self._n_used + n > self._n_cores:
+                self._cond.wait()
+            self._n_used += n
+        return n
+
+    def release(self, n):
+        with self._cond:
+            self._n_used -= n
+            self._cond.notify_all()
+
+
+def allocate_threads(n_cores, n_jobs, max_threads=1, serial_fraction=0.1):
+    """ choose the number of concurrent jobs and threads per job which minimize the processing time
+    of the step, assuming Amdahl's law for the speed-up of each job by multi-threading
+        Args:
+            n_cores: number of available cores
+            n_jobs: number of jobs in the step
+            max_threads: maximum number of threads per job, where the scaling of the tool flattens
+            serial_fraction: fraction of the job that does not benefit from multi-threading
+        Returns:
+            number of concurrent jobs, number of threads per job
+    """
+    n_cores = max(int(n_cores), 1)
+    n_jobs = max(int(n_jobs), 1)
+    best = None
+    for n_per_job in range(1, min(max(int(max_threads), 1), n_cores) + 1):
+        n_concurrent = min(n_jobs, n_cores // n_per_job)
+        n_waves = -(-n_jobs // n_concurrent)
+        cost = n_waves * (serial_fraction + (1 - serial_fraction) / n_per_job)
+        if best is None or cost < best[0] - 1e-9:
+            best = (cost, n_concurrent, n_per_job)
+    return best[1], best[2]
+
+
+def set_step_dependencies(processor, dependencies, n_cores=None):
+    """ declare the data dependencies between the step codes, the declared steps are executed
+    as soon as the steps they depend on are processed, instead of waiting for all preceding steps
+        Args:
+            processor: Processor instance which the steps are built on (interface of the pipeline)
+            dependencies: dict of step code: list of step codes that the step depends on,
+                          the steps not listed here are executed in order as before
+            n_cores: number of cores shared by the concurrent steps,
+                     the number of threads of the processor is used if None
+    """
+    if n_cores is None:
+        n_cores = processor.scheduler_param['n_threads'] or os.cpu_count()
+    step_dependencies = dict(getattr(processor, '_step_dependencies', None) or dict())
+    step_dependencies.update({code: list(deps) for code, deps in dependencies.items()})
+    processor._step_dependencies = step_dependencies
+    processor._step_budget = CoreBudget(n_cores)
+    if not hasattr(processor, '_step_lock'):
+        processor._step_lock = threading.Lock()
+
+
+def set_output_format(processor, ext='nii', final_steps=None):
+    """ set the file format of the images produced by the steps, the intermediate images can be stored
+    uncompressed to avoid compressing and decompressing them at every step, while the outputs of the
+    final steps are kept as 'nii.gz'. The image inputs of the steps accept both formats.
+        Args:
+            processor: Processor instance which the steps are built on (interface of the pipeline)
+            ext: extension of the intermediate images, 'nii' or 'nii.gz'
+            final_steps: list of step codes of which outputs are stored as 'nii.gz'
+    """
+    if ext not in IMAGE_EXTS:
+        raise ValueError('ext must be one of {}.'.format(IMAGE_EXTS))
+    processor._intermediate_ext = ext
+    processor._final_steps = set(final_steps or [])
+
+
+def set_scratch(processor, root, quota=None, keep=False):
+    """ place the temporary files of the steps and the native functions in the scratch root
+    (e.g. node-local NVMe or /dev/shm) instead of the project folder, the temporary files of
+    each step are removed when the step is finished
+        Args:
+            processor: Processor instance which the steps are built on (interface of the pipeline)
+            root: scratch root folder
+            quota: maximum usage of the scratch root in MB, the temporary files of the step are
+                   placed in the project folder if the usage exceeds the quota
+            keep: keep the temporary files after the step is finished
+    """
+    scratch = ScratchSpace(root, quota=quota, keep=keep)
+    scratch.publish()
+    processor._scratch = scratch
+
+
+def get_cache_dir(processor, name):
+    """ default folder of the persistent cache of the native functions (e.g. the design matrices, the resamplers),
+    the session folder of the scratch space if set by set_scratch, else '<project>/.cache/<name>'
+        Args:
+            processor: Processor instance which the steps are built on (interface of the pipeline)
+            name: name of the cache
+    """
+    scratch = getattr(processor, '_scratch', None)
+    if scratch is not None:
+        return scratch.step_path('.cache', name)
+    return os.path.join(processor.bucket.path, '.cache', name)
+
+
+def set_profiling(processor, stage):
+    """ record the resource usage of each job of the steps built after this call into the run report
+    of the stage ('<project>/.profile/<stage>.json' and '.csv'), see instrument module
+        Args:
+            processor: Processor instance which the steps are built on (interface of the pipeline)
+            stage: name of the pipeline stage (e.g. '01_MaskPreparation'), None to disable
+    """
+    processor._profile_stage = stage
+
+
+class InterfaceBuilder(BaseInterfaceBuilder):
+    """ InterfaceBuilder with job level result cache and dependency based step scheduling
+
+    Before the jobs are scheduled, the hash of each job is compared with the one recorded
+    for its output, the output is kept if the hash matches, and restored from the object store
+    if the same job had been processed before (see cache.StepCache). The output of which hash does not
+    match is reported as stale and kept, or removed to be re-processed if invalidate_stale is set.
+    The resource variables (RESOURCE_LABELS) are not included in the hash.
+
+    If the dependencies of the step are declared by set_step_dependencies, the step starts when
+    the steps it depends on are processed and the cores are available in the budget shared by
+    the concurrent steps, instead of waiting for all preceding steps in the queue.
+
+    The cores of the processor are divided into the concurrent jobs (up to n_threads of the builder)
+    and the threads of each job by allocate_threads, and the thread count is passed to the commands through OMP_NUM_THREADS
+    and ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS. The commands run single-threaded unless the step
+    declares its multi-threading by set_threading, to prevent the oversubscription of the cores.
+    The python functions get the thread count through their n_workers or n_threads variables,
+    which are reduced to fit in the cores if they request more.
+
+    If the scratch space is set by set_scratch, the temporary files of the step are placed in the
+    scratch space and removed when the step is finished.
+
+    If the stage is set by set_profiling, the wall time, CPU time, peak RSS and IO of each job
+    are recorded and the run report of the stage is updated when the step is finished.
+
+    If the format of the images is set by set_output_format, the image outputs of which extension
+    follows the input are stored in the format of the step (intermediate or final).
+
+    Attributes:
+        use_cache:          enable the result cache (default=True)
+        hash_content:       fingerprint the inputs by the contents instead of size and mtime (default=False)
+        invalidate_stale:   remove the stale outputs to be re-processed (default=False)
+    """
+    use_cache = True
+    hash_content = False
+    invalidate_stale = False
+
+    def __init__(self, processor, n_threads=None, relpath=False):
+        super(InterfaceBuilder, self).__init__(processor, n_threads=n_threads, relpath=relpath)
+        # the stage when the step is built, the steps are executed after the next stage is set
+        self._profile_stage = getattr(processor, '_profile_stage', None)
+
+    def _get_record_path(self):
+        return instrument.get_record_path(self._procobj.bucket.path, self._profile_stage)
+
+    def set_threading(self, max_threads, serial_fraction=0.1, label=None):
+        """ declare the multi-threading of the command
+            Args:
+                max_threads:        maximum number of threads per job, where the scaling of the tool flattens
+                serial_fraction:    fraction of the job that does not benefit from multi-threading
+                label:              variable label to pass the number of threads per job to the command
+        """
+        self._thread_profile = (max_threads, serial_fraction, label)
+
+    def _get_image_ext(self):
+        """ extension of the output images of the step, None if the format is not set """
+        ext = getattr(self._procobj, '_intermediate_ext', None)
+        if ext is not None and self.step_code in self._procobj._final_steps:
+            return 'nii.gz'
+        return ext
+
+    def _accept_image_exts(self, filter_dict):
+        """ extend the image extension of the filter to accept both formats """
+        if self._get_image_ext() is None or filter_dict is None or filter_dict.get('ext') not in IMAGE_EXTS:
+            return filter_dict
+        filter_dict = dict(filter_dict)
+        filter_dict['ext'] = list(IMAGE_EXTS)
+        return filter_dict
+
+    def set_input(self, label, input_path, filter_dict=None, group_input=False, mask=False,
+                  idx=None, join_modifier=None):
+        if not hasattr(self, '_image_output'):
+            # the output follows the extension of the main input
+            self._image_output = filter_dict is not None and filter_dict.get('ext') in IMAGE_EXTS
+        super(InterfaceBuilder, self).set_input(label, input_path, filter_dict=self._accept_image_exts(filter_dict),
+                                                group_input=group_input, mask=mask, idx=idx,
+                                                join_modifier=join_modifier)
+
+    def set_static_input(self, label, input_path, filter_dict=None, idx=0, mask=False):
+        super(InterfaceBuilder, self).set_static_input(label, input_path,
+                                                       filter_dict=self._accept_image_exts(filter_dict),
+                                                       idx=idx, mask=mask)
+
+    def set_output(self, label, prefix=None, suffix=None, modifier=None, ext=None):
+        if ext is None and getattr(self, '_image_output', False):
+            ext = self._get_image_ext()
+        super(InterfaceBuilder, self).set_output(label, prefix=prefix, suffix=suffix, modifier=modifier, ext=ext)
+
+    def set_output_checker(self, label='output', prefix=None, suffix=None, ext=None):
+        if ext is None and getattr(self, '_image_output', False):
+            ext = self._get_image_ext()
+        super(InterfaceBuilder, self).set_output_checker(label, prefix=prefix, suffix=suffix, ext=ext)
+
+    def _set_temporary(self, run_order, label, path_only, relpath):
+        super(InterfaceBuilder, self)._set_temporary(run_order, label, path_only, relpath)
+        scratch = getattr(self._procobj, '_scratch', None)
+        if scratch is None or self._step_processed is True or label not in self._temporary_set:
+            return
+        if not scratch.has_room():
+            self.logging('warn', '[{}]-scratch quota exceeded, temporary files are stored '
+                                 'in the project folder.'.format(self.step_code), method='set_temporary')
+            return
+        temp_path = self._procobj.temp_path
+        if relpath:
+            temp_path = os.path.relpath(temp_path)
+        scratch_path = scratch.step_path(os.path.basename(self._procobj.temp_path))
+
+        def relocate(path):
+            return os.path.join(scratch_path, os.path.relpath(path, temp_path))
+
+        value = self._temporary_set[label]
+        if isinstance(value, str):
+            self._temporary_set[label] = relocate(value)
+        else:
+            self._temporary_set[label] = [(relocate(path), fname) for path, fname in value]
+        self._scratch_path = os.path.join(scratch_path, os.path.basename(self.path))
+
+    def _count_jobs(self):
+        inputs = self._input_set.get(self._main_input) if self._main_input is not None else None
+        if isinstance(inputs, list):
+            return len(inputs)
+        return 1
+
+    def _reserve_cores(self, n_cores):
+        """ reserve the cores from the budget of the concurrent steps, if declared """
+        if self._get_dependencies() is None:
+            return n_cores
+        self._n_reserved = self._procobj._step_budget.acquire(n_cores)
+        return self._n_reserved
+
+    def _allocate_cores(self, max_threads, serial_fraction, method):
+        """ divide the cores granted to the step into the concurrent jobs and the threads of each job
+            Returns:
+                number of threads per job
+        """
+        # n_threads of the builder limits the number of concurrent jobs
+        n_jobs = min(self._count_jobs(), self._n_threads or os.cpu_count())
+        n_cores = self._procobj.scheduler_param['n_threads'] or os.cpu_count()
+        n_concurrent, n_per_job = allocate_threads(n_cores, n_jobs, max_threads, serial_fraction)
+        n_granted = self._reserve_cores(n_concurrent * n_per_job)
+        if n_granted < n_concurrent * n_per_job:
+            n_concurrent, n_per_job = allocate_threads(n_granted, n_jobs, max_threads, serial_fraction)
+        self._schd = type(self._schd)(n_threads=n_concurrent)
+        self.logging('debug', '[{}]-{} concurrent job(s) with {} thread(s) each.'.format(self.step_code,
+                                                                                      n_concurrent, n_per_job),
+                     method=method)
+        return n_per_job
+
+    def _call_manager(self):
+        max_threads, serial_fraction, label = getattr(self, '_thread_profile', None) or (1, 0.1, None)
+        n_per_job = self._allocate_cores(max_threads, serial_fraction, '_call_manager')
+        env = 'env OMP_NUM_THREADS={0} ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS={0} '.format(n_per_job)
+        for i, cmd in self._cmd_set.items():
+            self._cmd_set[i] = env + cmd
+            if self._profile_stage is not None:
+                output = '*[output]' if 'output' in self._output_set else None
+                self._cmd_set[i] = instrument.wrap_command(self._cmd_set[i], self._get_record_path(),
+                                                           self._profile_stage, self.step_code, self.path,
+                                                           i, output)
+        if label is not None:
+            self._var_set[label] = str(n_per_job)
+        return super(InterfaceBuilder, self)._call_manager()
+
+    def _call_func_manager(self):
+        # python functions run their own workers or threads, the number requested by the variables
+        # is bounded by the cores granted to each job
+        labels = [label for label in WORKER_LABELS if self._var_set.get(label) is not None]
+        max_workers = max([int(self._var_set[label]) for label in labels] or [1])
+        n_per_job = self._allocate_cores(max_workers, 0.1, '_call_func_manager')
+        for label in labels:
+            self._var_set[label] = n_per_job
+        if self._profile_stage is None:
+            return super(InterfaceBuilder, self)._call_func_manager()
+        func_set = dict(self._func_set)
+        try:
+            for i, func in func_set.items():
+                self._func_set[i] = instrument.profiled(func, self._get_record_path(),
+                                                        self._profile_stage, self.step_code, self.path)
+            return super(InterfaceBuilder, self)._call_func_manager()
+        finally:
+            self._func_set.update(func_set)
+
+    def _get_dependencies(self):
+        """ list of dependent step codes if declared by set_step_dependencies, else None """
+        dependencies = getattr(self._procobj, '_step_dependencies', None)
+        if not dependencies or self.step_code not in dependencies:
+            return None
+        return dependencies[self.step_code]
+
+    def _init_step(self, run_order, mode_idx):
+        dependencies = self._get_dependencies()
+        if dependencies is None:
+            return super(InterfaceBuilder, self)._init_step(run_order, mode_idx)
+
+        if run_order != 0:
+            self.logging('warn', 'init_step must be perform first for building command interface.',
+                         method='init_step')
+        if self.step_code not in self._procobj.waiting_list:
+            self._step_processed = True
+        else:
+            declared = self._procobj._step_dependencies
+            while True:
+                waiting = list(self._procobj.waiting_list)
+                ahead = waiting[:waiting.index(self.step_code)]
+                # undeclared steps queued ahead of this step work as barriers
+                blocking = [code for code in waiting
+                            if code in dependencies or (code in ahead and code not in declared)]
+                if not blocking:
+                    break
+                time.sleep(self._refresh_rate)
+
+        with self._procobj._step_lock:
+            self._procobj.bucket.update()
+            if mode_idx != 2:
+                try:
+                    self._procobj.update_attributes(mode_idx)
+                except IndexError:
+                    self._procobj.update_attributes(1)
+        self.logging('debug', '[{}]-step initiated.'.format(self.step_code),
+                     method='init_step')
+        self._report_status(run_order)
+
+    def _run(self, run_order):
+        self._n_reserved = 0
+        try:
+            super(InterfaceBuilder, self)._run(run_order)
+        finally:
+            if self._n_reserved:
+                self._procobj._step_budget.release(self._n_reserved)
+            scratch_path = getattr(self, '_scratch_path', None)
+            if scratch_path is not None and not self._procobj._scratch.keep:
+                shutil.rmtree(scratch_path, ignore_errors=True)
+            if self._profile_stage is not None and os.path.exists(self._get_record_path()):
+                instrument.write_report(self._get_record_path())
+
+    def clear(self):
+        if self._get_dependencies() is None:
+            return super(InterfaceBuilder, self).clear()
+        # the concurrent step can be finished in any order
+        with self._procobj._step_lock:
+            if self.step_code in self._procobj.waiting_list:
+                self._procobj.waiting_list.remove(self.step_code)
+                self._procobj.processed_list.append(self.step_code)
+        self.logging('debug', 'processed.', method='run-[{}]'.format(self.step_code))
+
+    def _get_cache(self):
+        return StepCache(self._procobj.bucket.path, hash_content=self.hash_content,
+                         invalidate=self.invalidate_stale)
+
+    def _get_identity(self):
+        if self._type == 'python':
+            return [func_identity(func) for _, func in sorted(self._func_set.items())]
+        return [cmd for _, cmd in sorted(self._cmd_set.items())]
+
+    @staticmethod
+    def _get_item(value, i, n_jobs):
+        """ value of i-th job from the argument set """
+        if isinstance(value, list) and len(value) == n_jobs:
+            value = value[i]
+        if isinstance(value, tuple):
+            return [os.path.join(*value)]
+        if isinstance(value, list):
+            return [os.path.join(*v) if isinstance(v, tuple) else v for v in value]
+        if isinstance(value, str):
+            # group input are joined by white space
+            return value.split()
+        return []
+
+    def _get_jobs(self):
+        """ list of (key, input fingerprints, output checker path, dict of output paths) """
+        cache = self._get_cache()
+        identity = self._get_identity()
+        variables = {label: value for label, value in self._var_set.items() if label not in RESOURCE_LABELS}
+        n_jobs = len(self._output_filter)
+        jobs = []
+        for i, (path, fname) in enumerate(self._output_filter):
+            inputs = []
+            for label, value in sorted(self._input_set.items()):
+                inputs.extend(self._get_item(value, i, n_jobs))
+            outputs = dict()
+            for label, value in self._output_set.items():
+                paths = self._get_item(value, i, n_jobs)
+                if len(paths) == 1:
+                    outputs[label] = paths[0]
+            output = os.path.join(path, fname)
+            if output not in outputs.values():
+                outputs['checker'] = output
+            key, fingerprints = cache.get_key(identity, variables, inputs)
+            jobs.append((key, fingerprints, output, outputs))
+        return jobs
+
+    def _inspect_output(self):
+        if self.use_cache and len(self._output_filter):
+            cache = self._get_cache()
+            self._jobs = self._get_jobs()
+            self._stale = set()
+            for key, _, output, outputs in self._jobs:
+                status = cache.check(key, output, outputs)
+                if status == 'stale':
+                    self._stale.add(output)
+                    self.logging('warn', 'stale output is kept: [{}], set invalidate_stale to re-process.'.format(
+                        output), method='_inspect_output-[{}]'.format(self.step_code))
+                elif status is not None:
+                    self.logging('debug', '{}: [{}]'.format(status, os.path.basename(output)),
+                                 method='_inspect_output-[{}]'.format(self.step_code))
+        super(InterfaceBuilder, self)._inspect_output()
+
+    def _inspect_run(self):
+        result = super(InterfaceBuilder, self)._inspect_run()
+        if self.use_cache and getattr(self, '_jobs', None):
+            cache = self._get_cache()
+            for key, fingerprints, output, outputs in self._jobs:
+                if os.path.exists(output) and output not in self._stale:
+                    cache.record(key, fingerprints, output,
+                                 {label: p for label, p in outputs.items() if os.path.exists(p)})
+            self._jobs = None
+        return result
@@ -0,0 +1,391 @@
+""" Content-addressed cache of step results
+
+The result of each job (one input to its outputs) is identified by the hash of the command
+template or python function (including the sources of its module and declared helpers),
+the variables and the fingerprints of the input files.
+The hash of the successful job is recorded in the manifest of the session folder of its output,
+which is stored in the mirrored folder under '<project>/.cache/manifests' to keep the dataset clean,
+and the output files are hard-linked into the object store of the project ('<project>/.cache/objects'),
+so that the job can be skipped or its outputs can be restored when the same step is executed
+again with the same inputs and parameters.
+"""
+import os
+import sys
+import re
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import types
+
+MANIFEST = 'manifest.json'
+
+
+def fingerprint(path, hash_content=False):
+    """ fingerprint of the file, size and mtime or sha1 of the contents
+        Args:
+            path: file path
+            hash_content: hash the contents instead of size and mtime if True
+        Returns:
+            str, None if the file does not exist
+    """
+    if not os.path.isfile(path):
+        return None
+    if hash_content:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(4 * 1024 ** 2), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+    stat = os.stat(path)
+    return '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def _const_repr(const):
+    """ repr of the constant which is stable across the processes """
+    if isinstance(const, (frozenset, set)):
+        # the order of the items follows the string hashes, which are randomized in each process
+        return '{}({})'.format(type(const).__name__, sorted(_const_repr(c) for c in const))
+    if isinstance(const, tuple):
+        return '({})'.format(','.join(_const_repr(c) for c in const))
+    return repr(const)
+
+
+def _update_code(sha1, code):
+    """ hash the bytecode, names and constants of the code object and its nested code objects
+    (comprehensions, lambdas, inner functions), of which repr contains the memory address """
+    sha1.update(code.co_code)
+    sha1.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _update_code(sha1, const)
+        else:
+            sha1.update(_const_repr(const).encode())
+
+
+_source_identities = dict()
+
+
+def source_identity(module_name):
+    """ hash of the source file of the module, None if the source is not available """
+    if module_name not in _source_identities:
+        path = getattr(sys.modules.get(module_name), '__file__', None)
+        if path is None or not os.path.isfile(path):
+            _source_identities[module_name] = None
+        else:
+            with open(path, 'rb') as f:
+                _source_identities[module_name] = hashlib.sha1(f.read()).hexdigest()
+    return _source_identities[module_name]
+
+
+def helpers(*modules):
+    """ declare the modules of which functions are called by the python function of the step,
+    the sources of the modules are included in the identity of the function (see func_identity)
+        Args:
+            modules: module names, relative to the package of the function if starting with '.'
+
+    Example:
+        @helpers('.nifti', '.glm')
+        def glm_func(input, output, ...):
+    """
+    def decorator(func):
+        func.__helpers__ = modules
+        return func
+    return decorator
+
+
+def func_identity(func):
+    """ identity of python function which changes when its code, the source of its module
+    or the sources of its declared helper modules are modified """
+    sha1 = hashlib.sha1()
+    _update_code(sha1, func.__code__)
+    package = func.__module__.rpartition('.')[0]
+    for module_name in [func.__module__] + list(getattr(func, '__helpers__', ())):
+        if module_name.startswith('.'):
+            module_name = package + module_name
+        sha1.update('{}:{}'.format(module_name, source_identity(module_name)).encode())
+    return '{}.{}:{}'.format(func.__module__, func.__qualname__, sha1.hexdigest())
+
+
+def get_key(identity, variables, inputs, hash_content=False):
+    """ hash of a job
+        Args:
+            identity: list of command templates or function identities
+            variables: dict of variables, the values that are existing file paths are fingerprinted
+            inputs: list of input file paths
+            hash_content: fingerprint the files by the contents
+        Returns:
+            key (str), dict of input fingerprints
+    """
+    fingerprints = {path: fingerprint(path, hash_content) for path in inputs}
+    var_items = []
+    for label, value in sorted(variables.items()):
+        if isinstance(value, str) and os.path.isfile(value):
+            fingerprints[value] = fingerprint(value, hash_content)
+        var_items.append([label, repr(value)])
+    content = json.dumps([identity, var_items, sorted(fingerprints.items())])
+    return hashlib.sha1(content.encode()).hexdigest(), fingerprints
+
+
+def load_manifest(path):
+    """ load the manifest of the folder, empty dict if not exists """
+    manifest_path = os.path.join(path, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return dict()
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        # broken manifest, the outputs will be adopted again
+        return dict()
+
+
+def save_manifest(path, manifest):
+    """ save the manifest atomically """
+    os.makedirs(path, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix='.json', dir=path)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, os.path.join(path, MANIFEST))
+
+
+def _link(src, dst):
+    """ hard-link the file, copy if the link is not available (e.g. different file system) """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class ObjectStore(object):
+    """ Storage of the step outputs addressed by job key
+
+    The outputs are stored as '<root>/<key[:2]>/<key>/<label>/<filename>'
+    """
+
+    def __init__(self, root):
+        self._root = root
+
+    @property
+    def root(self):
+        return self._root
+
+    def _object_path(self, key):
+        return os.path.join(self._root, key[:2], key)
+
+    def contains(self, key):
+        return os.path.isdir(self._object_path(key))
+
+    def save(self, key, outputs):
+        """ store the output files
+            Args:
+                key: job key
+                outputs: dict of label: file path
+        """
+        object_path = self._object_path(key)
+        parent = os.path.dirname(object_path)
+        os.makedirs(parent, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix='tmp', dir=parent)
+        for label, path in outputs.items():
+            os.makedirs(os.path.join(tmp_path, label))
+            _link(path, os.path.join(tmp_path, label, os.path.basename(path)))
+        if os.path.exists(object_path):
+            shutil.rmtree(object_path)
+        os.rename(tmp_path, object_path)
+
+    def restore(self, key, outputs):
+        """ restore the stored output files
+            Args:
+                key: job key
+                outputs: dict of label: destination file path
+            Returns:
+                True if the outputs are restored
+        """
+        object_path = self._object_path(key)
+        if not os.path.isdir(object_path):
+            return False
+        sources = dict()
+        for label in os.listdir(object_path):
+            if label not in outputs:
+                return False
+            for fname in os.listdir(os.path.join(object_path, label)):
+                dst = os.path.join(os.path.dirname(outputs[label]), fname)
+                sources[dst] = os.path.join(object_path, label, fname)
+        if not sources:
+            return False
+        for dst, src in sources.items():
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            _link(src, dst)
+        # mark as recently used
+        os.utime(object_path)
+        return True
+
+    def keys(self):
+        if not os.path.isdir(self._root):
+            return
+        for prefix in os.listdir(self._root):
+            prefix_path = os.path.join(self._root, prefix)
+            if os.path.isdir(prefix_path):
+                for key in os.listdir(prefix_path):
+                    if not key.startswith('tmp'):
+                        yield key
+
+    def remove(self, key):
+        shutil.rmtree(self._object_path(key), ignore_errors=True)
+
+
+class StepCache(object):
+    """ Job level result cache of the project
+
+    Example:
+        cache = StepCache(project_path)
+        cache.invalidate(regex='SpatialNorm')  # force re-processing
+        cache.collect_garbage(max_age=30)      # remove stale outputs and unused objects
+    """
+
+    def __init__(self, project_path, hash_content=False, invalidate=False):
+        """
+        Args:
+            project_path: root folder of the project dataset
+            hash_content: fingerprint the input files by the contents instead of size and mtime
+            invalidate: remove the stale outputs to be re-processed if True,
+                        else the stale outputs are kept as they are and reported
+        """
+        self._project_path = project_path
+        self._manifest_root = os.path.join(project_path, '.cache', 'manifests')
+        self._store = ObjectStore(os.path.join(project_path, '.cache', 'objects'))
+        self._hash_content = hash_content
+        self._invalidate = invalidate
+
+    @property
+    def store(self):
+        return self._store
+
+    @property
+    def hash_content(self):
+        return self._hash_content
+
+    def get_key(self, identity, variables, inputs):
+        return get_key(identity, variables, inputs, self._hash_content)
+
+    def _manifest_path(self, path):
+        """ folder of the manifest for the session folder """
+        return os.path.join(self._manifest_root, os.path.relpath(os.path.abspath(path), self._project_path))
+
+    def _output_path(self, manifest_path, fname):
+        """ output file path from the folder of the manifest """
+        return os.path.join(self._project_path, os.path.relpath(manifest_path, self._manifest_root), fname)
+
+    def check(self, key, output, outputs):
+        """ check the status of the job before execution, the stale output is removed if invalidate is set and
+        the output of the same job is restored from the store if available
+            Args:
+                key: job key
+                output: path of the output file of the output checker
+                outputs: dict of label: output file path of the job
+            Returns:
+                'cached' if the output is up to date, 'restored' if restored from the store,
+                'stale' if the output is out of date but kept, 'invalidated' if the stale output is removed,
+                None if the job needs to be executed
+        """
+        path, fname = os.path.split(output)
+        entry = load_manifest(self._manifest_path(path)).get(fname)
+        status = None
+        if os.path.exists(output):
+            if entry is None or entry['key'] == key:
+                # the output created before the cache is adopted as it is
+                return 'cached'
+            if not self._invalidate:
+                # the job is skipped and its manifest entry is kept, so that it stays stale
+                return 'stale'
+            for out_path in set(outputs.values()) | {output}:
+                if os.path.exists(out_path):
+                    os.remove(out_path)
+            status = 'invalidated'
+        if self._store.restore(key, outputs):
+            return 'restored'
+        return status
+
+    def record(self, key, fingerprints, output, outputs):
+        """ record the successful job into the manifest and the store """
+        path, fname = os.path.split(output)
+        manifest_path = self._manifest_path(path)
+        manifest = load_manifest(manifest_path)
+        entry = manifest.get(fname)
+        if entry is not None and entry['key'] == key and self._store.contains(key):
+            return
+        if not self._store.contains(key):
+            self._store.save(key, {label: p for label, p in outputs.items() if os.path.exists(p)})
+        manifest[fname] = dict(key=key, inputs=fingerprints, outputs=outputs, time=time.time())
+        save_manifest(manifest_path, manifest)
+
+    def _iter_manifests(self, path=None):
+        root_path = self._manifest_root if path is None else self._manifest_path(path)
+        for root, dirs, files in os.walk(root_path):
+            if MANIFEST in files:
+                yield root
+
+    def invalidate(self, path=None, regex=None):
+        """ remove the outputs and their manifest entries to force re-processing
+            Args:
+                path: folder to search the manifests (e.g. step folder), whole project if None
+                regex: regular expression pattern of the path of output to invalidate
+            Returns:
+                number of invalidated outputs
+        """
+        n_removed = 0
+        for root in self._iter_manifests(path):
+            manifest = load_manifest(root)
+            for fname in list(manifest.keys()):
+                output = self._output_path(root, fname)
+                if regex is not None and not re.search(regex, output):
+                    continue
+                entry = manifest.pop(fname)
+                self._store.remove(entry['key'])
+                for out_path in set(entry.get('outputs', dict()).values()) | {output}:
+                    if os.path.exists(out_path):
+                        os.remove(out_path)
+                n_removed += 1
+            save_manifest(root, manifest)
+        return n_removed
+
+    def collect_garbage(self, max_age=None):
+        """ remove stale outputs whose inputs are modified or removed after processing,
+        the manifest entries of the removed outputs, and the unreferenced objects in the store
+            Args:
+                max_age: age in days, the unreferenced objects used within this period are kept if provided
+            Returns:
+                number of removed outputs, number of removed objects
+        """
+        n_outputs = 0
+        referenced = set()
+        for root in self._iter_manifests():
+            manifest = load_manifest(root)
+            for fname in list(manifest.keys()):
+                entry = manifest[fname]
+                output = self._output_path(root, fname)
+                stale = any(fingerprint(p, self._hash_content) != fp for p, fp in entry['inputs'].items())
+                if stale or not os.path.exists(output):
+                    for out_path in set(entry.get('outputs', dict()).values()) | {output}:
+                        if os.path.exists(out_path):
+                            os.remove(out_path)
+                    del manifest[fname]
+                    n_outputs += 1
+                else:
+                    referenced.add(entry['key'])
+            save_manifest(root, manifest)
+
+        n_objects = 0
+        now = time.time()
+        for key in list(self._store.keys()):
+            if key in referenced:
+                continue
+            object_path = self._store._object_path(key)
+            if max_age is not None and now - os.path.getmtime(object_path) < max_age * 86400:
+                continue
+            self._store.remove(key)
+            n_objects += 1
+        return n_outputs, n_objects
@@ -0,0 +1,123 @@
+""" Voxel-wise expression evaluation in the style of AFNI's 3dcalc """
+import ast
+import numpy as np
+
+
+def _safe_divide(x, y):
+    """ division that returns 0 where the denominator is 0, as 3dcalc does """
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    return np.divide(x, y, out=np.zeros(x.shape), where=y != 0)
+
+
+def _reduce(func, args):
+    result = args[0]
+    for arg in args[1:]:
+        result = func(result, arg)
+    return result
+
+
+FUNCTIONS = dict(step=lambda x: (np.asarray(x) > 0).astype(np.float64),
+                 ispositive=lambda x: (np.asarray(x) > 0).astype(np.float64),
+                 isnegative=lambda x: (np.asarray(x) < 0).astype(np.float64),
+                 iszero=lambda x: (np.asarray(x) == 0).astype(np.float64),
+                 notzero=lambda x: (np.asarray(x) != 0).astype(np.float64),
+                 bool=lambda x: (np.asarray(x) != 0).astype(np.float64),
+                 equals=lambda x, y: (np.asarray(x) == y).astype(np.float64),
+                 abs=np.abs, sqrt=np.sqrt, exp=np.exp, log=np.log, log10=np.log10,
+                 sin=np.sin, cos=np.cos, tan=np.tan,
+                 min=lambda *args: _reduce(np.minimum, args),
+                 max=lambda *args: _reduce(np.maximum, args),
+                 mean=lambda *args: _reduce(np.add, args) / len(args))
+
+# reductions along the time axis, computed on the loaded slab which holds the full time series
+REDUCTIONS = dict(tmean=lambda x: x.mean(-1, keepdims=True),
+                  tsum=lambda x: x.sum(-1, keepdims=True),
+                  tstd=lambda x: x.std(-1, ddof=1, keepdims=True))
+
+_NUMBERS = tuple(getattr(ast, name) for name in ('Constant', 'Num') if hasattr(ast, name))
+
+_BINOPS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+           ast.Div: _safe_divide, ast.Pow: np.power}
+
+
+class Expression(object):
+    """ Parsed 3dcalc-style expression
+
+    Single letter names are the input variables, the functions listed in FUNCTIONS
+    are element-wise as in 3dcalc (e.g. 'a*step(b)', 'c*min(200, a/b*100)'), and
+    the functions in REDUCTIONS are computed along the time axis of the variable,
+    so that e.g. 'b*min(200, a/tmean(a)*100)' can be evaluated without the
+    temporary mean image.
+    """
+
+    def __init__(self, expr):
+        self._expr = expr
+        self._tree = ast.parse(expr.replace('^', '**'), mode='eval').body
+        self._variables = set()
+        self._inspect(self._tree)
+
+    @property
+    def variables(self):
+        return sorted(self._variables)
+
+    def _inspect(self, node):
+        if isinstance(node, ast.Name):
+            if len(node.id) != 1 or not node.id.isalpha():
+                raise ValueError('unknown variable "{}" in expression.'.format(node.id))
+            self._variables.add(node.id)
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name):
+                raise ValueError('invalid function call in expression.')
+            name = node.func.id
+            if name in REDUCTIONS:
+                if len(node.args) != 1 or not isinstance(node.args[0], ast.Name):
+                    raise ValueError('{}() takes single variable.'.format(name))
+            elif name not in FUNCTIONS:
+                raise ValueError('unknown function "{}" in expression.'.format(name))
+            for arg in node.args:
+                self._inspect(arg)
+        elif isinstance(node, ast.BinOp):
+            if type(node.op) not in _BINOPS:
+                raise ValueError('unsupported operator in expression.')
+            self._inspect(node.left)
+            self._inspect(node.right)
+        elif isinstance(node, ast.UnaryOp):
+            if not isinstance(node.op, (ast.USub, ast.UAdd)):
+                raise ValueError('unsupported operator in expression.')
+            self._inspect(node.operand)
+        elif not isinstance(node, _NUMBERS) or not isinstance(self._number(node), (int, float)):
+            raise ValueError('invalid syntax in expression "{}".'.format(self._expr))
+
+    def __call__(self, **variables):
+        """ evaluate the expression, the 3D variables are broadcast along the time axis of 4D variables
+            Args:
+                variables: letter=numpy array
+            Returns:
+                numpy array
+        """
+        ndim = max(v.ndim for v in variables.values())
+        arrays = dict()
+        for label, value in variables.items():
+            value = np.asarray(value, dtype=np.float64)
+            arrays[label] = value.reshape(value.shape + (1,) * (ndim - value.ndim))
+        return np.broadcast_to(self._eval(self._tree, arrays),
+                               np.broadcast(*arrays.values()).shape)
+
+    def _eval(self, node, arrays):
+        if isinstance(node, ast.Name):
+            return arrays[node.id]
+        elif isinstance(node, ast.Call):
+            name = node.func.id
+            if name in REDUCTIONS:
+                return REDUCTIONS[name](arrays[node.args[0].id])
+            return FUNCTIONS[name](*[self._eval(arg, arrays) for arg in node.args])
+        elif isinstance(node, ast.BinOp):
+            return _BINOPS[type(node.op)](self._eval(node.left, arrays), self._eval(node.right, arrays))
+        elif isinstance(node, ast.UnaryOp):
+            operand = self._eval(node.operand, arrays)
+            return -operand if isinstance(node.op, ast.USub) else operand
+        return self._number(node)
+
+    @staticmethod
+    def _number(node):
+        return node.value if hasattr(node, 'value') else node.n
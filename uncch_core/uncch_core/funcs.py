@@ -3,18 +3,79 @@ from shleeh.utils import user_warning
 from shleeh.errors import *
 import nibabel as nib
 import numpy as np
+import os
+import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Union, IO
+from .nifti import get_chunk_size, get_slab_size, iter_slabs, read_slab, iter_volumes, make_header, SlabWriter, \
+    save_image, load_image
+from .parallel import SharedPool, split_chunks
+from .scratch import get_tempdir
+from .cache import helpers
+from .calc import Expression
+from . import glm
+from . import group
+from .preprocessing import slice_offsets, fourier_shift, fwhm_to_sigma, gaussian_kernel, blur, blur_weights, \
+    blur_in_mask
+from . import transform
 
-# Example
+
+def _band_power(pxx, band_masks):
+    """ ALFF (mean amplitude) and fALFF (band amplitude / total amplitude) for each frequency band,
+    the DC component is excluded from the total amplitude """
+    amp = np.sqrt(pxx)
+    total = amp[:, 1:].sum(-1)[:, np.newaxis]
+    band_sum = np.stack([amp[:, m].sum(-1) for m in band_masks], axis=-1)
+    alff = band_sum / band_masks.sum(-1)
+    falff = np.divide(band_sum, total, out=np.zeros_like(band_sum), where=total > 0)
+    return np.concatenate([alff, falff], axis=-1)
+
+
+def _spectrum(ts, fs, nfft, band_masks=None):
+    from scipy.signal import periodogram
+    pxx = periodogram(ts, fs=fs, nfft=nfft, axis=-1)[1]
+    if band_masks is None:
+        return pxx
+    return _band_power(pxx, band_masks)
+
+
+def _periodogram_task(arrays, task):
+    start, end, fs, nfft, band_masks = task
+    arrays['output'][start:end] = _spectrum(arrays['input'][start:end], fs, nfft, band_masks)
+
+
+def _periodogram(ts, fs, nfft, band_masks=None, pool=None):
+    """ compute spectra (or band powers) of (n_voxels, T) time series,
+    chunks of voxels are distributed to the pool if given, the spectra are computed in float64 in both cases """
+    if pool is None:
+        return _spectrum(np.asarray(ts, dtype=np.float64), fs, nfft, band_masks)
+    n_voxels = ts.shape[0]
+    pool['input'][:n_voxels] = ts
+    pool.map(_periodogram_task, [(start, end, fs, nfft, band_masks) for start, end
+                                 in split_chunks(n_voxels, pool.n_workers * 4)])
+    return pool['output'][:n_voxels]
+
+
+@helpers('.nifti')
 def periodogram_func(input, output, mask=None,
-                     dt=2, nfft=100,
+                     dt=2, nfft=100, bands=None, mem_limit=None, n_workers=None,
                      stdout=None, stderr=None):
-    """ Calculate tSNR
+    """ Calculate voxel-wise periodogram
         Args:
             input: file path of input data (.nii or .nii.gz)
             output: file path for output destination (.nii or .nii.gz)
             mask: file path of mask image (.nii or .nii.gz)
+            dt: sampling interval in second
+            nfft: length of the FFT
+            bands: list of frequency bands in Hz, e.g. [[0.01, 0.1]]. if provided, only the
+                   summary maps are written instead of the full spectrum. the output contains
+                   ALFF maps for each band followed by fALFF maps for each band.
+            mem_limit: memory budget in MB, if provided, the input will be streamed by z-slabs
+                       and the output will be written incrementally.
+                       (uncompressed input is recommended for this mode)
+            n_workers: number of worker processes, the voxels are split into chunks
+                       and distributed to the workers through shared memory
             stdout: IO stream for message
             stderr: IO stream for error message
         Returns:
@@ -31,29 +92,57 @@ def periodogram_func(input, output, mask=None,
     try:
         fs = 1 / dt
         input_nii = nib.load(input)
-        if mask is None:
-            mask_data = (np.asarray(input_nii.dataobj).mean(-1) != 0).astype(int)
+        mask_nii = None if mask is None else load_image(mask)
+        shape = input_nii.shape
+        f, _ = periodogram(np.zeros(shape[-1]), fs=fs, nfft=nfft)
+        hz_dim = np.diff(f).mean()
+
+        if bands is None:
+            band_masks = None
+            n_frames = f.shape[0]
+            output_header = make_header(input_nii, shape[:3] + (n_frames,))
+            output_header.set_xyzt_units(xyz=input_nii.header.get_xyzt_units()[0], t='hz')
+            output_header['pixdim'][4] = hz_dim
         else:
-            mask_nii = nib.load(mask)
-            mask_data = np.asarray(mask_nii.dataobj)
-
-        input_data = np.asarray(input_nii.dataobj)
-        output_data = np.zeros(mask_data.shape)
-        indices = np.transpose(np.nonzero(mask_data))
-        hz_dim = False
-
-        for x, y, z in indices:
-            f, pxx = periodogram(input_data[x, y, z, :], fs=fs, nfft=nfft)
-            if not hz_dim:
-                hz_dim = np.diff(f).mean()
-            if len(output_data.shape) == 3:
-                output_data = np.concatenate([output_data[:, :, :, np.newaxis]] * f.shape[0], axis=-1)
-            output_data[x, y, z, :] = pxx
-
-        output_nii = nib.Nifti1Image(output_data, affine=input_nii.affine, header=input_nii.header)
-        output_nii.header.set_xyzt(t=32)  # Hz
-        output_nii.header['pixdim'][4] = hz_dim
-        output_nii.to_filename(output)
+            band_masks = np.array([(f >= low) & (f <= high) for low, high in bands])
+            if not band_masks.any(-1).all():
+                raise ValueError('no frequency bin found in the band, check dt and nfft.')
+            n_frames = 2 * len(bands)
+            output_header = make_header(input_nii, shape[:3] + (n_frames,))
+            output_header.set_xyzt_units(xyz=input_nii.header.get_xyzt_units()[0], t='unknown')
+            output_header['pixdim'][4] = 1
+
+        # float64 time series, its masked copy and the complex spectrum per voxel
+        bytes_per_voxel = 8 * (2 * shape[-1] + 3 * f.shape[0])
+        if n_workers is not None and n_workers > 1:
+            # shared input and output buffers
+            bytes_per_voxel += 8 * (shape[-1] + n_frames)
+        slab_size = get_slab_size(shape, bytes_per_voxel, mem_limit)
+
+        pool = None
+        if n_workers is not None and n_workers > 1:
+            n_max = int(np.prod(shape[:2])) * slab_size
+            pool = SharedPool(n_workers,
+                              input=((n_max, shape[-1]), np.float64),
+                              output=((n_max, n_frames), np.float64))
+        try:
+            with SlabWriter(output, output_header, n_threads=n_workers) as writer:
+                for z0, z1 in iter_slabs(shape[2], slab_size):
+                    input_data = read_slab(input_nii, z0, z1)
+                    if mask_nii is None:
+                        mask_data = input_data.mean(-1) != 0
+                    else:
+                        mask_data = read_slab(mask_nii, z0, z1) != 0
+
+                    # gather all masked time series into (n_voxels, T) and compute spectra at once
+                    output_data = np.zeros(mask_data.shape + (n_frames,), dtype=np.float32)
+                    if mask_data.any():
+                        output_data[mask_data] = _periodogram(input_data[mask_data], fs, nfft,
+                                                              band_masks, pool)
+                    writer.write(z0, z1, output_data)
+        finally:
+            if pool is not None:
+                pool.close()
         stdout.write('Done...\n'.format(output))
 
     except:
@@ -64,6 +153,876 @@ def periodogram_func(input, output, mask=None,
     return 0
 
 
+@helpers('.nifti')
+def meanimage_func(input, output, ranges=None, mem_limit=None,
+                   stdout=None, stderr=None):
+    """ Calculate mean intensity images of multiple time windows in single pass
+        Args:
+            input: file path of input data (.nii or .nii.gz)
+            output: file path for output destination (.nii or .nii.gz)
+            ranges: list of [start, end] frame index pairs (inclusive, as 3dTstat's '[start..end]'),
+                    the output contains one volume per window in the given order.
+                    whole time series is averaged if None
+            mem_limit: memory budget in MB, the input is streamed in blocks of volumes
+            stdout: IO stream for message
+            stderr: IO stream for error message
+        Returns:
+            0 if success else 1
+    """
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+
+    stdout.write('[UNCCH_CAMRI] Mean Image Calculation:\n')
+    try:
+        input_nii = nib.load(input, keep_file_open=True)
+        shape = input_nii.shape
+        n_vols = shape[-1]
+        if ranges is None:
+            ranges = [[0, n_vols - 1]]
+        windows = []
+        for start, end in ranges:
+            end = min(end, n_vols - 1)
+            if start < 0 or start > end:
+                raise ValueError('invalid range [{}..{}].'.format(start, end))
+            windows.append((start, end + 1))
+
+        sums = np.zeros(shape[:3] + (len(windows),))
+        block_size = get_chunk_size(n_vols, 2 * 8 * int(np.prod(shape[:3])), mem_limit)
+        for t0, block in iter_volumes(input_nii, block_size):
+            t1 = t0 + block.shape[-1]
+            for i, (start, end) in enumerate(windows):
+                if start < t1 and end > t0:
+                    sums[..., i] += block[..., max(start, t0) - t0:min(end, t1) - t0].sum(-1)
+            if t1 >= max(end for _, end in windows):
+                break
+        output_data = sums / np.array([end - start for start, end in windows])
+        if len(windows) == 1:
+            output_data = output_data[..., 0]
+
+        output_nii = nib.Nifti1Image(output_data.astype(np.float32), affine=input_nii.affine,
+                                     header=make_header(input_nii, output_data.shape))
+        save_image(output_nii, output)
+        stdout.write('Done...\n')
+
+    except:
+        import traceback
+        stderr.write('[ERROR] Failed.\n')
+        traceback.print_exception(*sys.exc_info(), file=stderr)
+        return 1
+    return 0
+
+
+@helpers('.nifti', '.calc')
+def calc_func(input, output, expr, mask=None, mem_limit=None,
+              stdout=None, stderr=None):
+    """ Evaluate 3dcalc-style voxel-wise expression over z-slabs
+        Args:
+            input: file path of input data (.nii or .nii.gz), variable 'a' in the expression
+            output: file path for output destination (.nii or .nii.gz)
+            expr: expression (e.g. 'a*step(b)', 'b*min(200, a/tmean(a)*100)'), see calc.Expression
+            mask: file path of mask image (.nii or .nii.gz), variable 'b' in the expression
+            mem_limit: memory budget in MB, the images are read by z-slabs to fit in the budget
+            stdout: IO stream for message
+            stderr: IO stream for error message
+        Returns:
+            0 if success else 1
+    """
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+
+    stdout.write('[UNCCH_CAMRI] Voxel-wise Calculation:\n')
+    try:
+        expression = Expression(expr)
+        images = dict(a=nib.load(input))
+        if mask is not None:
+            images['b'] = load_image(mask)
+        for label in expression.variables:
+            if label not in images:
+                raise ValueError('no image is assigned to the variable "{}".'.format(label))
+        input_nii = images['a']
+        shape = input_nii.shape
+
+        # float64 copies of the inputs and the intermediate results
+        n_frames = shape[-1] if len(shape) > 3 else 1
+        bytes_per_voxel = 8 * 4 * n_frames
+        slab_size = get_slab_size(shape, bytes_per_voxel, mem_limit)
+
+        writer = None
+        try:
+            for z0, z1 in iter_slabs(shape[2], slab_size):
+                # the input is always read as it defines the output geometry, as 3dcalc does
+                variables = {label: read_slab(images[label], z0, z1)
+                             for label in set(expression.variables) | {'a'}}
+                output_data = expression(**variables)
+                if writer is None:
+                    output_shape = output_data.shape[:2] + (shape[2],) + output_data.shape[3:]
+                    writer = SlabWriter(output, make_header(input_nii, output_shape))
+                writer.write(z0, z1, output_data)
+        except:
+            if writer is not None:
+                writer.close(discard=True)
+            raise
+        writer.close()
+        stdout.write('Done...\n')
+
+    except:
+        import traceback
+        stderr.write('[ERROR] Failed.\n')
+        traceback.print_exception(*sys.exc_info(), file=stderr)
+        return 1
+    return 0
+
+
+def _glm_task(arrays, task):
+    start, end, design, method = task
+    arrays['output'][start:end] = glm.fit(design, arrays['input'][start:end].T, method).T
+
+
+def _glm(ts, design, method, pool=None):
+    """ fit (n_voxels, T) time series, chunks of voxels are distributed to the pool if given """
+    if pool is None:
+        return glm.fit(design, ts.T, method).T
+    n_voxels = ts.shape[0]
+    pool['input'][:n_voxels] = ts
+    pool.map(_glm_task, [(start, end, design, method) for start, end
+                         in split_chunks(n_voxels, pool.n_workers * 4)])
+    return pool['output'][:n_voxels]
+
+
+def _fit_glm(input_nii, mask_nii, output, onset_time, model, parameters, polort, method,
+             mem_limit, n_workers, cache_dir, group_size):
+    """ fit GLM on the loaded image, see glm_func """
+    shape = input_nii.shape
+    tr = float(input_nii.header['pixdim'][4])
+    if input_nii.header.get_xyzt_units()[1] == 'msec':
+        tr /= 1000
+    cache = glm.get_design_cache(cache_dir)
+    key, design = cache.get(onset_time, model, parameters, tr, shape[-1], polort)
+    n_whitened = design.n_whitened
+    n_frames = 1 + 2 * design.n_stims
+    solver = None
+    if group_size is not None and group_size > 1:
+        if n_workers is not None and n_workers > 1:
+            raise ValueError('n_workers cannot be used with group_size.')
+        solver = glm.get_group_solver(group_size)
+
+    # float64 time series, its masked and whitened copies, residuals
+    bytes_per_voxel = 8 * 5 * shape[-1]
+    if n_workers is not None and n_workers > 1:
+        bytes_per_voxel += 8 * (shape[-1] + n_frames)
+    slab_size = get_slab_size(shape, bytes_per_voxel, mem_limit)
+
+    output_header = make_header(input_nii, shape[:3] + (n_frames,))
+    output_header.set_xyzt_units(xyz=input_nii.header.get_xyzt_units()[0], t='unknown')
+    output_header['pixdim'][4] = 1
+
+    pool = None
+    if n_workers is not None and n_workers > 1:
+        n_max = int(np.prod(shape[:2])) * slab_size
+        pool = SharedPool(n_workers,
+                          input=((n_max, shape[-1]), np.float64),
+                          output=((n_max, n_frames), np.float64))
+    if solver is not None:
+        solver.join(key)
+    try:
+        with SlabWriter(output, output_header, n_threads=n_workers) as writer:
+            for z0, z1 in iter_slabs(shape[2], slab_size):
+                input_data = read_slab(input_nii, z0, z1)
+                if mask_nii is None:
+                    mask_data = input_data.mean(-1) != 0
+                else:
+                    mask_data = read_slab(mask_nii, z0, z1) != 0
+
+                output_data = np.zeros(mask_data.shape + (n_frames,), dtype=np.float32)
+                if solver is not None:
+                    # submit even if the slab is empty, so that the other jobs do not wait for it
+                    output_data[mask_data] = solver.fit(key, design, input_data[mask_data].T, method).T
+                elif mask_data.any():
+                    output_data[mask_data] = _glm(input_data[mask_data], design, method, pool)
+                writer.write(z0, z1, output_data)
+    finally:
+        if solver is not None:
+            solver.leave(key)
+        if pool is not None:
+            pool.close()
+    if design.n_whitened > n_whitened:
+        # keep the whitened factorizations for the next runs
+        cache.save(key, design)
+
+
+@helpers('.nifti', '.glm')
+def glm_func(input, output, onset_time, model, parameters, mask=None, polort=2, method='AR1',
+             mem_limit=None, n_workers=None, cache_dir=None, group_size=None,
+             stdout=None, stderr=None):
+    """ General linear model analysis of single stimulation model
+        Args:
+            input: file path of input data (.nii or .nii.gz)
+            output: file path for output destination (.nii or .nii.gz), contains Full F-stat,
+                    coefficient and t-stat of the stimulus (same order as 3dREMLfit -Rbuck with -tout)
+            onset_time: stimulation onset time in second
+            model: response model, 'BLOCK' or 'GAM' (3dDeconvolve definition)
+            parameters: parameters for response model
+            mask: file path of mask image (.nii or .nii.gz), non-zero mean voxels are used if None
+            polort: order of Legendre polynomials for detrending
+            method: 'OLS' or 'AR1' for serial correlation correction
+            mem_limit: memory budget in MB, the input is read by z-slabs to fit in the budget
+            n_workers: number of worker processes, the voxels are split into chunks
+                       and distributed to the workers through shared memory
+            cache_dir: directory of design matrix cache, kept only in memory if None
+            group_size: number of concurrent jobs to be solved together, the voxels of the runs
+                        sharing the same design are stacked and fitted in single batch.
+                        (cannot be used with n_workers)
+            stdout: IO stream for message
+            stderr: IO stream for error message
+        Returns:
+            0 if success else 1
+    """
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+
+    stdout.write('[UNCCH_CAMRI] General Linear Model:\n')
+    try:
+        input_nii = nib.load(input)
+        mask_nii = None if mask is None else load_image(mask)
+        _fit_glm(input_nii, mask_nii, output, onset_time, model, parameters, polort, method,
+                 mem_limit, n_workers, cache_dir, group_size)
+        stdout.write('Done...\n')
+
+    except:
+        import traceback
+        stderr.write('[ERROR] Failed.\n')
+        traceback.print_exception(*sys.exc_info(), file=stderr)
+        return 1
+    return 0
+
+
+def _intermediate_path(output, tag):
+    """ file path for the intermediate result stored next to the output """
+    for ext in ('.nii.gz', '.nii'):
+        if output.endswith(ext):
+            return '{}_{}{}'.format(output[:-len(ext)], tag, ext)
+    return '{}_{}'.format(output, tag)
+
+
+@helpers('.nifti', '.glm', '.preprocessing')
+def glm_chain_func(input, output, mask, fwhm, onset_time, model, parameters, mean_value=100, max_value=200,
+                   polort=2, method='AR1', smoothing='volume', keep_intermediates=False, mem_limit=None,
+                   n_workers=None, n_threads=None, cache_dir=None, group_size=None,
+                   stdout=None, stderr=None):
+    """ Scaling, smoothing and GLM analysis in single pass, the time series is held in
+    single working array (memory-mapped if it exceeds mem_limit) instead of intermediate files.
+        Args:
+            input: file path of input data (.nii or .nii.gz)
+            output: file path for output destination (.nii or .nii.gz), see glm_func
+            mask: file path of mask image (.nii or .nii.gz)
+            fwhm: full width half maximum in mm for smoothing
+            onset_time: stimulation onset time in second
+            model: response model, 'BLOCK' or 'GAM' (3dDeconvolve definition)
+            parameters: parameters for response model
+            mean_value: desired mean value of the scaled time series
+            max_value: value to cut the scaled time series, no cut if None
+            polort: order of Legendre polynomials for detrending
+            method: 'OLS' or 'AR1' for serial correlation correction
+            smoothing: 'volume' to smooth the whole volume as 3dmerge -1blur_fwhm (the unfused chain),
+                       or 'mask' to smooth within the mask as 3dBlurInMask,
+                       the GLM is performed in the mask either way
+            keep_intermediates: store the scaled and smoothed data next to the output
+                                with '_scaled' and '_blurred' suffix if True
+            mem_limit: memory budget in MB
+            n_workers: number of worker processes for GLM
+            n_threads: number of threads for smoothing
+            cache_dir: directory of design matrix cache, kept only in memory if None
+            group_size: number of concurrent jobs to be solved together, see glm_func
+            stdout: IO stream for message
+            stderr: IO stream for error message
+        Returns:
+            0 if success else 1
+    """
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+
+    stdout.write('[UNCCH_CAMRI] Scaling, Smoothing and General Linear Model:\n')
+    work_path = None
+    try:
+        if smoothing not in ('volume', 'mask'):
+            raise ValueError('smoothing must be "volume" or "mask".')
+        input_nii = nib.load(input, keep_file_open=True)
+        mask_nii = load_image(mask)
+        shape = input_nii.shape
+        n_vols = shape[-1]
+        mask_data = np.asarray(mask_nii.dataobj, dtype=np.float64)
+        pixdim = np.asarray(input_nii.header.get_zooms()[:3], dtype=np.float64)
+        if input_nii.header.get_xyzt_units()[0] == 'micron':
+            pixdim /= 1000
+        kernels = [gaussian_kernel(sigma) for sigma in fwhm_to_sigma(float(fwhm), pixdim)]
+        weights = blur_weights(mask_data != 0, kernels) if smoothing == 'mask' else None
+
+        # working array which is updated in-place by each stage
+        if mem_limit is not None and np.prod(shape) * 4 > mem_limit * 1024 ** 2:
+            import tempfile
+            fd, work_path = tempfile.mkstemp(suffix='.dat',
+                                             dir=get_tempdir(os.path.dirname(output) or None,
+                                                             int(np.prod(shape)) * 4))
+            os.close(fd)
+            work = np.memmap(work_path, dtype=np.float32, mode='w+', shape=shape)
+        else:
+            work = np.empty(shape, dtype=np.float32)
+
+        bytes_per_volume = int(np.prod(shape[:3])) * 8 * 4
+        block_size = get_chunk_size(n_vols, bytes_per_volume, mem_limit)
+        total = np.zeros(shape[:3])
+        for t0, data in iter_volumes(input_nii, block_size):
+            work[..., t0:t0 + data.shape[-1]] = data
+            total += data.sum(-1)
+        mean_data = total / n_vols
+
+        header = make_header(input_nii, shape)
+        writers = dict()
+        n_threads = 1 if n_threads is None else max(int(n_threads), 1)
+        if keep_intermediates:
+            writers = {tag: SlabWriter(_intermediate_path(output, tag), header, n_threads=n_threads)
+                       for tag in ('scaled', 'blurred')}
+        try:
+            with ThreadPoolExecutor(n_threads) as executor:
+                for t0 in range(0, n_vols, block_size):
+                    t1 = min(t0 + block_size, n_vols)
+                    scaled = np.divide(work[..., t0:t1], mean_data[..., np.newaxis],
+                                       out=np.zeros((shape[:3] + (t1 - t0,))),
+                                       where=mean_data[..., np.newaxis] != 0) * mean_value
+                    if max_value is not None:
+                        scaled = np.minimum(scaled, max_value)
+                    scaled *= mask_data[..., np.newaxis]
+                    if keep_intermediates:
+                        writers['scaled'].write_volumes(t0, t1, scaled)
+                    chunks = split_chunks(t1 - t0, n_threads)
+                    if smoothing == 'mask':
+                        results = executor.map(lambda c: blur_in_mask(scaled[..., c[0]:c[1]],
+                                                                      mask_data, weights, kernels),
+                                               chunks)
+                    else:
+                        results = executor.map(lambda c: blur(scaled[..., c[0]:c[1]], kernels), chunks)
+                    for (s, e), result in zip(chunks, results):
+                        work[..., t0 + s:t0 + e] = result
+                    if keep_intermediates:
+                        writers['blurred'].write_volumes(t0, t1, work[..., t0:t1])
+        except:
+            for writer in writers.values():
+                writer.close(discard=True)
+            raise
+        for writer in writers.values():
+            writer.close()
+
+        work_nii = nib.Nifti1Image(work, input_nii.affine, header)
+        _fit_glm(work_nii, mask_nii, output, onset_time, model, parameters, polort, method,
+                 mem_limit, n_workers, cache_dir, group_size)
+        stdout.write('Done...\n')
+
+    except:
+        import traceback
+        stderr.write('[ERROR] Failed.\n')
+        traceback.print_exception(*sys.exc_info(), file=stderr)
+        return 1
+    finally:
+        if work_path is not None:
+            os.remove(work_path)
+    return 0
+
+
+def _slicetiming_task(arrays, task):
+    z, shift = task
+    arrays['output'][:, :, z] = fourier_shift(arrays['input'][:, :, z], shift)
+
+
+@helpers('.nifti', '.preprocessing')
+def slicetiming_func(input, output, tr=None, tpattern=None, mem_limit=None, n_workers=None,
+                     stdout=None, stderr=None):
+    """ Correct slice timing by Fourier interpolation, equivalent to 3dTshift -Fourier,
+    all voxels in a slice are shifted in a single batched FFT.
+        Args:
+            input: file path of input data (.nii or .nii.gz)
+            output: file path for output destination (.nii or .nii.gz)
+            tr: repetition time in second, header value is used if None
+            tpattern: slice timing pattern of 3dTshift (e.g. altplus, alt+z2, seqminus),
+                      slice timing in the header is used if None
+            mem_limit: memory budget in MB, the input is read by z-slabs to fit in the budget
+            n_workers: number of worker processes, the slices are distributed to the workers
+                       through shared memory
+            stdout: IO stream for message
+            stderr: IO stream for error message
+        Returns:
+            0 if success else 1
+    """
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+
+    stdout.write('[UNCCH_CAMRI] Slice Timing Correction:\n')
+    try:
+        input_nii = nib.load(input)
+        shape = input_nii.shape
+        if tr is None:
+            tr = float(input_nii.header['pixdim'][4])
+            if input_nii.header.get_xyzt_units()[1] == 'msec':
+                tr /= 1000
+        if tpattern is None:
+            offsets = np.asarray(input_nii.header.get_slice_times(), dtype=np.float64)
+            if input_nii.header.get_xyzt_units()[1] == 'msec':
+                offsets /= 1000
+        else:
+            offsets = slice_offsets(tpattern, shape[2], tr)
+        # align to the average of slice offsets as 3dTshift does
+        shifts = (offsets.mean() - offsets) / tr
+
+        # float64 copies, the symmetric extension and its spectrum
+        bytes_per_voxel = 8 * 8 * shape[-1]
+        slab_size = get_slab_size(shape, bytes_per_voxel, mem_limit)
+
+        pool = None
+        if n_workers is not None and n_workers > 1:
+            buffer_shape = shape[:2] + (slab_size, shape[-1])
+            pool = SharedPool(n_workers,
+                              input=(buffer_shape, np.float64),
+                              output=(buffer_shape, np.float64))
+        try:
+            with SlabWriter(output, make_header(input_nii, shape), n_threads=n_workers) as writer:
+                for z0, z1 in iter_slabs(shape[2], slab_size):
+                    input_data = read_slab(input_nii, z0, z1)
+                    if pool is None:
+                        output_data = np.stack([fourier_shift(input_data[:, :, z - z0], shifts[z])
+                                                for z in range(z0, z1)], axis=2)
+                    else:
+                        pool['input'][:, :, :z1 - z0] = input_data
+                        pool.map(_slicetiming_task, [(z - z0, shifts[z]) for z in range(z0, z1)])
+                        output_data = pool['output'][:, :, :z1 - z0]
+                    writer.write(z0, z1, output_data)
+        finally:
+            if pool is not None:
+                pool.close()
+        stdout.write('Done...\n')
+
+    except:
+        import traceback
+        stderr.write('[ERROR] Failed.\n')
+        traceback.print_exception(*sys.exc_info(), file=stderr)
+        return 1
+    return 0
+
+
+@helpers('.nifti', '.preprocessing')
+def blur_func(input, output, fwhm, mask=None, mem_limit=None, n_threads=None,
+              stdout=None, stderr=None):
+    """ Gaussian smoothing within the mask using separable kernels normalized by in-mask weights,
+    equivalent to 3dBlurInMask, all volumes in a block are smoothed at once.
+        Args:
+            input: file path of input data (.nii or .nii.gz)
+            output: file path for output destination (.nii or .nii.gz)
+            fwhm: full width half maximum in mm, converted to voxels using pixdim of the header
+            mask: file path of mask image, the kernel is normalized at the edge of the image if None
+            mem_limit: memory budget in MB, the input is read by blocks of volumes to fit in the budget
+            n_threads: number of threads, the volumes in a block are distributed to the threads
+            stdout: IO stream for message
+            stderr: IO stream for error message
+        Returns:
+            0 if success else 1
+    """
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+
+    stdout.write('[UNCCH_CAMRI] Gaussian Smoothing:\n')
+    try:
+        input_nii = nib.load(input, keep_file_open=True)
+        shape = input_nii.shape
+        pixdim = np.asarray(input_nii.header.get_zooms()[:3], dtype=np.float64)
+        if input_nii.header.get_xyzt_units()[0] == 'micron':
+            pixdim /= 1000
+        kernels = [gaussian_kernel(sigma) for sigma in fwhm_to_sigma(float(fwhm), pixdim)]
+        if mask is None:
+            mask_data = np.ones(shape[:3])
+        else:
+            mask_data = np.asarray(load_image(mask).dataobj) != 0
+        weights = blur_weights(mask_data, kernels)
+
+        n_threads = 1 if n_threads is None else max(int(n_threads), 1)
+        with SlabWriter(output, make_header(input_nii, shape), n_threads=n_threads) as writer:
+            if len(shape) == 3:
+                writer.write(0, shape[2], blur_in_mask(np.asarray(input_nii.dataobj),
+                                                       mask_data, weights, kernels))
+            else:
+                # input, masked copy and the results of the passes
+                bytes_per_volume = int(np.prod(shape[:3])) * 8 * 4
+                block_size = get_chunk_size(shape[-1], bytes_per_volume, mem_limit)
+                with ThreadPoolExecutor(n_threads) as executor:
+                    for t0, data in iter_volumes(input_nii, block_size):
+                        chunks = split_chunks(data.shape[-1], n_threads)
+                        results = executor.map(lambda c: blur_in_mask(data[..., c[0]:c[1]],
+                                                                      mask_data, weights, kernels),
+                                               chunks)
+                        for (s, e), result in zip(chunks, results):
+                            writer.write_volumes(t0 + s, t0 + e, result)
+        stdout.write('Done...\n')
+
+    except:
+        import traceback
+        stderr.write('[ERROR] Failed.\n')
+        traceback.print_exception(*sys.exc_info(), file=stderr)
+        return 1
+    return 0
+
+
+def _resample_series(input_nii, base_nii, resampler, output, mem_limit=None, n_threads=None):
+    """ apply the resampler to all volumes of the input, the volumes in a block are split into
+    chunks and resampled by the threads """
+    grid_shape = base_nii.shape[:3]
+    shape = grid_shape + input_nii.shape[3:]
+    header = make_header(input_nii, shape)
+    header.set_qform(base_nii.affine)
+    header.set_sform(base_nii.affine)
+
+    n_threads = 1 if n_threads is None else max(int(n_threads), 1)
+    with SlabWriter(output, header, n_threads=n_threads) as writer:
+        if len(shape) == 3:
+            writer.write(0, shape[2], resampler.apply(np.asarray(input_nii.dataobj)))
+        else:
+            # input block, its row copy and the output with the gathered rows
+            bytes_per_volume = int(np.prod(input_nii.shape[:3])) * 8 + int(np.prod(grid_shape)) * 12
+            block_size = get_chunk_size(shape[-1], bytes_per_volume, mem_limit)
+            with ThreadPoolExecutor(n_threads) as executor:
+                for t0, data in iter_volumes(input_nii, block_size):
+                    chunks = split_chunks(data.shape[-1], n_threads)
+                    results = executor.map(lambda c: resampler.apply(data[..., c[0]:c[1]]), chunks)
+                    for (s, e), result in zip(chunks, results):
+                        writer.write_volumes(t0 + s, t0 + e, result)
+
+
+@helpers('.nifti', '.transform')
+def spatial_norm_func(input, output, base, tfmat, tfmorph=None, mem_limit=None, n_threads=None,
+                      cache_dir=None, stdout=None, stderr=None):
+    """ Apply the spatial normalization transform of ANTs or AFNI to all volumes, equivalent to
+    WarpTimeSeriesImageMultiTransform (or 3dAllineate -1Dmatrix_apply) with trilinear interpolation.
+    The sampling coordinates and weights are computed once per subject and cached (see transform.ResamplerCache),
+    so the other runs of the subject only gather and weight the input voxels.
+        Args:
+            input: file path of input data (.nii or .nii.gz) in the anatomy space
+            output: file path for output destination (.nii or .nii.gz)
+            base: file path of the image that defines the output grid (e.g. template space image)
+            tfmat: affine transform of the spatial normalization, ANTs .mat if tfmorph is provided,
+                   else 3dAllineate matrix (.aff12.1D) which maps the template space to anatomy space
+            tfmorph: displacement field of ANTs (_1Warp.nii.gz)
+            mem_limit: memory budget in MB, the input is read by blocks of volumes to fit in the budget
+            n_threads: number of threads, the volumes in a block are distributed to the threads
+            cache_dir: directory of resampler cache, kept only in memory if None
+            stdout: IO stream for message
+            stderr: IO stream for error message
+        Returns:
+            0 if success else 1
+    """
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+
+    stdout.write('[UNCCH_CAMRI] Apply Spatial Normalization:\n')
+    try:
+        input_nii = nib.load(input, keep_file_open=True)
+        base_nii = nib.load(base)
+
+        def load_transforms():
+            if tfmorph is None:
+                return [transform.read_afni_matrix(tfmat)]
+            return [transform.DisplacementField(tfmorph), transform.read_ants_affine(tfmat)]
+
+        files = [tfmat] if tfmorph is None else [tfmorph, tfmat]
+        resampler = transform.get_resampler(base_nii, input_nii, files, load_transforms, cache_dir)
+        _resample_series(input_nii, base_nii, resampler, output, mem_limit, n_threads)
+        stdout.write('Done...\n')
+
+    except:
+        import traceback
+        stderr.write('[ERROR] Failed.\n')
+        traceback.print_exception(*sys.exc_info(), file=stderr)
+        return 1
+    return 0
+
+
+@helpers('.nifti', '.transform')
+def combined_transform_func(input, output, base, tfcoreg, tfmat, tfmorph=None, mem_limit=None,
+                            n_threads=None, cache_dir=None, stdout=None, stderr=None):
+    """ Resample the input into the template space in single interpolation, by composing the
+    co-registration matrix with the spatial normalization transform of ANTs or AFNI
+        Args:
+            input: file path of input data (.nii or .nii.gz) in the original space
+            output: file path for output destination (.nii or .nii.gz)
+            base: file path of the image that defines the output grid (e.g. template space image)
+            tfcoreg: 3dAllineate matrix (.aff12.1D) which maps anatomy space to the input space
+            tfmat: affine transform of the spatial normalization, ANTs .mat if tfmorph is provided,
+                   else 3dAllineate matrix (.aff12.1D) which maps the template space to anatomy space
+            tfmorph: displacement field of ANTs (_1Warp.nii.gz)
+            mem_limit: memory budget in MB, the input is read by blocks of volumes to fit in the budget
+            n_threads: number of threads, the volumes in a block are distributed to the threads
+            cache_dir: directory of resampler cache, kept only in memory if None
+            stdout: IO stream for message
+            stderr: IO stream for error message
+        Returns:
+            0 if success else 1
+    """
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+
+    stdout.write('[UNCCH_CAMRI] Apply Combined Transform:\n')
+    try:
+        input_nii = nib.load(input, keep_file_open=True)
+        base_nii = nib.load(base)
+
+        def load_transforms():
+            if tfmorph is None:
+                transforms = [transform.read_afni_matrix(tfmat)]
+            else:
+                transforms = [transform.DisplacementField(tfmorph), transform.read_ants_affine(tfmat)]
+            transforms.append(transform.read_afni_matrix(tfcoreg))
+            return transforms
+
+        files = ([tfmat] if tfmorph is None else [tfmorph, tfmat]) + [tfcoreg]
+        resampler = transform.get_resampler(base_nii, input_nii, files, load_transforms, cache_dir)
+        _resample_series(input_nii, base_nii, resampler, output, mem_limit, n_threads)
+        stdout.write('Done...\n')
+
+    except:
+        import traceback
+        stderr.write('[ERROR] Failed.\n')
+        traceback.print_exception(*sys.exc_info(), file=stderr)
+        return 1
+    return 0
+
+
+def _read_subbrick(path, index):
+    """ (x, y, z) sub-brick of the image, the volumes of AFNI bucket (x, y, z, 1, n) are also accepted """
+    nii = nib.load(path)
+    if len(nii.shape) == 3:
+        if index not in (0, None):
+            raise IndexError('sub-brick [{}] is out of range of 3D image {}'.format(index, path))
+        return np.asarray(nii.dataobj, dtype=np.float64), nii
+    data = nii.dataobj[..., index] if len(nii.shape) == 4 else nii.dataobj[:, :, :, 0, index]
+    return np.asarray(data, dtype=np.float64), nii
+
+
+def _permutation_task(arrays, task):
+    """ largest cluster sizes of the null samples [start, end) """
+    start, end, seed, n_a, thresholds, nn = task
+    resid = arrays['resid']
+    mask = arrays['mask'] != 0
+    structure = group.get_structure(nn)
+    volume = np.zeros(mask.shape)
+    sizes = []
+    for i in range(start, end):
+        # the samples do not depend on the number of workers
+        volume[mask] = group.null_tstat(resid, n_a, np.random.RandomState([seed, i]))
+        sizes.append(group.max_cluster_sizes(volume, thresholds, structure))
+    return np.array(sizes).reshape(-1, len(thresholds))
+
+
+def _image_stem(path):
+    return re.sub(r'\.nii(\.gz)?$', '', path)
+
+
+def clustsim_path(output, nn):
+    """ file path of the cluster threshold table of the t-test output """
+    return '{}.CSim.NN{}_bisided.1D'.format(_image_stem(output), nn)
+
+
+@helpers('.nifti', '.group')
+def ttest_func(groupA, output, resid, groupB=None, index_a=1, index_b=1, mask=None,
+               clustsim=True, n_iter=1000, nn=2, seed=0, n_workers=None,
+               stdout=None, stderr=None):
+    """ One-sample or two-sample t-test of the sub-bricks, native alternative of 3dttest++ with -resid and -Clustsim.
+    The cluster-size thresholds are estimated by flipping the signs (one-sample) or permuting the group labels
+    (two-sample) of the residuals, and the null samples are distributed to the worker processes.
+        Args:
+            groupA: list of file paths of group A (.nii or .nii.gz)
+            output: file path for output destination, contains mean and Tstat for one-sample test, or
+                    difference, Tstat, mean and Tstat of A and mean and Tstat of B for two-sample test
+            resid: file path for the residuals of the group means, the subjects of A followed by B
+            groupB: list of file paths of group B, one-sample test if None
+            index_a: index of sub-brick of group A (e.g. 1 for the coefficient of GLM output)
+            index_b: index of sub-brick of group B
+            mask: file path of mask image (.nii or .nii.gz), voxels non-zero in any subject are used if None
+            clustsim: estimate the cluster-size thresholds if True, the table is written next to
+                      the output ('<output>.CSim.NN<nn>_bisided.1D')
+            n_iter: number of null samples
+            nn: connectivity of the clusters, 1 (faces), 2 (edges) or 3 (corners)
+            seed: random seed, the table is reproducible with the same seed regardless of n_workers
+            n_workers: number of worker processes for the null samples
+            stdout: IO stream for message
+            stderr: IO stream for error message
+        Returns:
+            0 if success else 1
+    """
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+
+    stdout.write('[UNCCH_CAMRI] Group T-Test:\n')
+    try:
+        groupA = [groupA] if isinstance(groupA, str) else list(groupA)
+        if isinstance(groupB, str):
+            groupB = [groupB]
+        volumes_a = [_read_subbrick(path, index_a) for path in groupA]
+        volumes_b = None if groupB is None else [_read_subbrick(path, index_b) for path in groupB]
+        ref_nii = volumes_a[0][1]
+        shape = ref_nii.shape[:3]
+        if mask is None:
+            mask_data = np.zeros(shape, dtype=bool)
+            for data, _ in volumes_a + (volumes_b or []):
+                mask_data |= data != 0
+        else:
+            mask_data = np.asarray(load_image(mask).dataobj) != 0
+
+        data_a = np.stack([data[mask_data] for data, _ in volumes_a])
+        data_b = None if volumes_b is None else np.stack([data[mask_data] for data, _ in volumes_b])
+        stdout.write('{} subjects, {} voxels\n'.format(len(groupA) + len(groupB or []), int(mask_data.sum())))
+        stats, resid_data, dof = group.ttest(data_a, data_b)
+
+        output_data = np.zeros(shape + (stats.shape[0],), dtype=np.float32)
+        output_data[mask_data] = stats.T
+        output_header = make_header(ref_nii, output_data.shape)
+        output_header.set_xyzt_units(xyz=ref_nii.header.get_xyzt_units()[0], t='unknown')
+        output_header['pixdim'][4] = 1
+        save_image(nib.Nifti1Image(output_data, ref_nii.affine, output_header), output, n_workers)
+
+        resid_vol = np.zeros(shape + (resid_data.shape[0],), dtype=np.float32)
+        resid_vol[mask_data] = resid_data.T
+        save_image(nib.Nifti1Image(resid_vol, ref_nii.affine, make_header(ref_nii, resid_vol.shape)), resid,
+                   n_workers)
+        del resid_vol
+
+        if clustsim:
+            n_a = None if data_b is None else data_a.shape[0]
+            thresholds = group.t_thresholds(group.P_THRESHOLDS, dof)
+            n_workers = 1 if n_workers is None else max(int(n_workers), 1)
+            with SharedPool(n_workers,
+                            resid=(resid_data.shape, np.float64),
+                            mask=(shape, np.uint8)) as pool:
+                pool['resid'][:] = resid_data
+                pool['mask'][:] = mask_data
+                tasks = [(start, end, seed, n_a, thresholds, nn)
+                         for start, end in split_chunks(n_iter, n_workers * 4)]
+                max_sizes = np.concatenate(pool.map(_permutation_task, tasks))
+            table = group.cluster_thresholds(max_sizes, group.ALPHAS)
+            with open(clustsim_path(output, nn), 'w') as f:
+                f.write(group.format_cluster_table(table, group.P_THRESHOLDS, group.ALPHAS, nn, n_iter, seed))
+        stdout.write('Done...\n')
+
+    except:
+        import traceback
+        stderr.write('[ERROR] Failed.\n')
+        traceback.print_exception(*sys.exc_info(), file=stderr)
+        return 1
+    return 0
+
+
+def _mvm_task(arrays, task):
+    start, end, model = task
+    arrays['output'][:, start:end] = model.fit(arrays['input'][:, start:end])
+
+
+@helpers('.nifti', '.group')
+def mvm_func(input, output, table, bs_vars=None, ws_vars=None, glt_codes=None, glf_codes=None, index=1,
+             mask=None, n_workers=None, stdout=None, stderr=None):
+    """ Voxel-wise multi-variable modeling (ANOVA) of between-subject and within-subject factors,
+    native alternative of 3dMVM. The model is built once from the data table and the masked voxels are
+    solved in batched least squares, split into chunks over the worker processes.
+        Args:
+            input: list of file paths (.nii or .nii.gz), in the order of the rows of the data table
+            output: file path for output destination, contains F-stat of each model term followed by
+                    value and t-stat of each GLT and F-stat of each GLF. the labels and the degrees of freedom
+                    of the sub-bricks are written next to the output ('<output>.json')
+            table: dict of columns of the data table, 'Subj' and the variables (see group.make_datatable)
+            bs_vars: between-subject variables (e.g. 'group*sex')
+            ws_vars: within-subject variables (e.g. 'cond*time')
+            glt_codes: dict of label: code of general linear tests (e.g. dict(AvsB='cond : 1*A -1*B'))
+            glf_codes: dict of label: code of general linear F-tests (e.g. dict(cond='cond : 1*A -1*B & 1*A -1*C'))
+            index: index of sub-brick of the inputs
+            mask: file path of mask image (.nii or .nii.gz), voxels non-zero in any input are used if None
+            n_workers: number of worker processes
+            stdout: IO stream for message
+            stderr: IO stream for error message
+        Returns:
+            0 if success else 1
+    """
+    import json
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+
+    stdout.write('[UNCCH_CAMRI] Multi-Variable Modeling:\n')
+    try:
+        input = [input] if isinstance(input, str) else list(input)
+        if any(len(column) != len(input) for column in table.values()):
+            raise ValueError('the number of rows of the data table does not match the inputs.')
+        if isinstance(glt_codes, dict):
+            glt_codes = sorted(glt_codes.items())
+        if isinstance(glf_codes, dict):
+            glf_codes = sorted(glf_codes.items())
+        model = group.GroupModel(table, bs_vars, ws_vars, glt_codes, glf_codes)
+
+        ref_nii = None
+        mask_data = None if mask is None else np.asarray(load_image(mask).dataobj) != 0
+        volumes = []
+        for path in input:
+            data, nii = _read_subbrick(path, index)
+            ref_nii = nii if ref_nii is None else ref_nii
+            volumes.append(data)
+        if mask_data is None:
+            mask_data = np.zeros(ref_nii.shape[:3], dtype=bool)
+            for data in volumes:
+                mask_data |= data != 0
+        n_voxels = int(mask_data.sum())
+        stdout.write('{} subjects, {} inputs, {} voxels\n'.format(len(model.subjects), len(input), n_voxels))
+
+        n_labels = len(model.labels)
+        n_workers = 1 if n_workers is None else max(int(n_workers), 1)
+        with SharedPool(n_workers,
+                        input=((len(input), n_voxels), np.float64),
+                        output=((n_labels, n_voxels), np.float64)) as pool:
+            for i, data in enumerate(volumes):
+                pool['input'][i] = data[mask_data]
+            del volumes
+            n_chunks = max(n_workers * 4, n_voxels // 65536 + 1)
+            pool.map(_mvm_task, [(start, end, model) for start, end in split_chunks(n_voxels, n_chunks)])
+            output_data = np.zeros(mask_data.shape + (n_labels,), dtype=np.float32)
+            output_data[mask_data] = pool['output'].T
+
+        output_header = make_header(ref_nii, output_data.shape)
+        output_header.set_xyzt_units(xyz=ref_nii.header.get_xyzt_units()[0], t='unknown')
+        output_header['pixdim'][4] = 1
+        save_image(nib.Nifti1Image(output_data, ref_nii.affine, output_header), output, n_workers)
+        with open('{}.json'.format(_image_stem(output)), 'w') as f:
+            json.dump(dict(bsVars=bs_vars, wsVars=ws_vars, subjects=len(model.subjects),
+                           subbricks=model.labels), f, indent=2)
+        stdout.write('Done...\n')
+
+    except:
+        import traceback
+        stderr.write('[ERROR] Failed.\n')
+        traceback.print_exception(*sys.exc_info(), file=stderr)
+        return 1
+    return 0
+
+
 if __name__ == '__main__':
     pass
 
@@ -0,0 +1,408 @@
+""" General linear model for single-run task fMRI, batched across voxels """
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# grid of AR(1) coefficients, voxels are grouped by the nearest value and solved together
+AR1_STEP = 0.05
+AR1_LIMIT = 0.8
+
+
+def _block4_integral(t):
+    """ integral of t^4 exp(-t) from 0 to t, normalized with the peak of t^4 exp(-t) """
+    t = np.maximum(t, 0)
+    poly = t ** 4 + 4 * t ** 3 + 12 * t ** 2 + 24 * t + 24
+    return (24 - np.exp(-t) * poly) / (4 ** 4 * np.exp(-4))
+
+
+def _response(model, parameters, t):
+    """ response function of single event at time t (in second) following 3dDeconvolve's definitions """
+    model = model.upper()
+    parameters = list(parameters or [])
+    if model in ['BLOCK', 'BLOCK4']:
+        if len(parameters) not in [1, 2]:
+            raise ValueError('BLOCK model takes (d) or (d, p) parameters.')
+        d = parameters[0]
+        response = _block4_integral(t) - _block4_integral(t - d)
+        if len(parameters) == 2 and parameters[1] > 0:
+            grid = np.arange(0, d + 15, 0.01)
+            peak = (_block4_integral(grid) - _block4_integral(grid - d)).max()
+            response = response / peak * parameters[1]
+        return response
+    elif model == 'GAM':
+        if len(parameters) not in [0, 2]:
+            raise ValueError('GAM model takes () or (p, q) parameters.')
+        p, q = parameters if len(parameters) else (8.6, 0.547)
+        t = np.maximum(t, 0)
+        return (t / (p * q)) ** p * np.exp(p - t / q)
+    raise ValueError('unsupported response model "{}", use BLOCK or GAM.'.format(model))
+
+
+def stim_regressor(onset_time, model, parameters, tr, n_vols):
+    """ sampled stimulus regressor
+        Args:
+            onset_time: list of onset time in second
+            model: response model, 'BLOCK' or 'GAM'
+            parameters: parameters of the response model
+            tr: repetition time in second
+            n_vols: number of time points
+        Returns:
+            (n_vols,) regressor
+    """
+    t = np.arange(n_vols) * tr
+    regressor = np.zeros(n_vols)
+    for onset in onset_time:
+        regressor += _response(model, parameters, t - onset)
+    return regressor
+
+
+def baseline_regressors(n_vols, polort):
+    """ Legendre polynomials up to the order of polort as the baseline model, as 3dDeconvolve does """
+    from numpy.polynomial.legendre import legvander
+    return legvander(np.linspace(-1, 1, n_vols), polort)
+
+
+def ar1_whiten(data, rho):
+    """ Prais-Winsten transform of (T, ...) data for AR(1) coefficient rho """
+    whitened = np.empty(data.shape)
+    whitened[0] = np.sqrt(1 - rho ** 2) * data[0]
+    whitened[1:] = data[1:] - rho * data[:-1]
+    return whitened
+
+
+class Design(object):
+    """ Design matrix with the factorization required for the batched solve
+
+    The columns are the baseline regressors followed by the stimulus regressors.
+    """
+
+    def __init__(self, matrix, n_baseline, pinv=None, pinv_baseline=None):
+        """
+        Args:
+            matrix: (T, p) design matrix
+            n_baseline: number of baseline columns at the beginning of matrix
+            pinv: pseudo-inverse of matrix, computed if None
+            pinv_baseline: pseudo-inverse of baseline columns, computed if None
+        """
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        self.n_baseline = int(n_baseline)
+        self.pinv = np.linalg.pinv(self.matrix) if pinv is None else pinv
+        self.pinv_baseline = np.linalg.pinv(self.baseline) if pinv_baseline is None else pinv_baseline
+        self._whitened = dict()
+
+    @classmethod
+    def from_model(cls, onset_time, model, parameters, tr, n_vols, polort=2):
+        baseline = baseline_regressors(n_vols, polort)
+        stim = stim_regressor(onset_time, model, parameters, tr, n_vols)
+        return cls(np.column_stack([baseline, stim]), baseline.shape[1])
+
+    @property
+    def baseline(self):
+        return self.matrix[:, :self.n_baseline]
+
+    @property
+    def n_stims(self):
+        return self.matrix.shape[1] - self.n_baseline
+
+    @property
+    def dof(self):
+        return self.matrix.shape[0] - self.matrix.shape[1]
+
+    @property
+    def cov_diag(self):
+        """ diagonal of (X'X)^-1 for the stimulus regressors """
+        return (self.pinv[self.n_baseline:] ** 2).sum(-1)
+
+    @property
+    def n_whitened(self):
+        return len(self._whitened)
+
+    def whiten(self, rho):
+        """ AR(1) whitened design, kept for the reuse across chunks """
+        if rho not in self._whitened:
+            self._whitened[rho] = Design(ar1_whiten(self.matrix, rho), self.n_baseline)
+        return self._whitened[rho]
+
+    def to_arrays(self):
+        """ serialize the design and its whitened factorizations into dict of arrays """
+        whitened_designs = dict(self._whitened)
+        arrays = dict(matrix=self.matrix, n_baseline=np.array(self.n_baseline),
+                      pinv=self.pinv, pinv_baseline=self.pinv_baseline,
+                      rho=np.array(sorted(whitened_designs.keys()), dtype=np.float64))
+        for i, rho in enumerate(arrays['rho']):
+            whitened = whitened_designs[rho]
+            arrays['w{}_matrix'.format(i)] = whitened.matrix
+            arrays['w{}_pinv'.format(i)] = whitened.pinv
+            arrays['w{}_pinv_baseline'.format(i)] = whitened.pinv_baseline
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        n_baseline = int(arrays['n_baseline'])
+        design = cls(arrays['matrix'], n_baseline, arrays['pinv'], arrays['pinv_baseline'])
+        for i, rho in enumerate(arrays['rho']):
+            design._whitened[float(rho)] = cls(arrays['w{}_matrix'.format(i)], n_baseline,
+                                               arrays['w{}_pinv'.format(i)],
+                                               arrays['w{}_pinv_baseline'.format(i)])
+        return design
+
+
+class DesignCache(object):
+    """ Persistent cache of Design and its factorizations
+
+    The designs are keyed by the stimulus model, TR, polort and the number of time points,
+    so the runs sharing same design (e.g. all subjects in a cohort) reuse the pseudo-inverses,
+    including the AR(1) whitened ones. The recently used designs are kept in memory as well,
+    and the least recently used files are removed when the number of entries exceeds max_entries.
+    """
+
+    def __init__(self, path=None, max_entries=256, max_memory_entries=16):
+        """
+        Args:
+            path: cache directory, the designs are kept only in memory if None
+            max_entries: maximum number of designs stored on disk
+            max_memory_entries: maximum number of designs kept in memory
+        """
+        self._path = path
+        self._max_entries = max_entries
+        self._max_memory_entries = max_memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self._path
+
+    @staticmethod
+    def get_key(onset_time, model, parameters, tr, n_vols, polort):
+        params = [[float(t) for t in onset_time], str(model).upper(),
+                  [float(p) for p in (parameters or [])],
+                  round(float(tr), 6), int(polort), int(n_vols)]
+        return hashlib.sha1(json.dumps(params).encode('utf-8')).hexdigest()
+
+    def _filepath(self, key):
+        return os.path.join(self._path, '{}.npz'.format(key))
+
+    def get(self, onset_time, model, parameters, tr, n_vols, polort=2):
+        """ return cached design or create new one
+            Returns:
+                key, Design
+        """
+        key = self.get_key(onset_time, model, parameters, tr, n_vols, polort)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return key, self._memory[key]
+        filepath = None if self._path is None else self._filepath(key)
+        design = None
+        if filepath is not None and os.path.exists(filepath):
+            try:
+                with np.load(filepath) as arrays:
+                    design = Design.from_arrays(arrays)
+                os.utime(filepath, None)
+            except (IOError, OSError, ValueError, KeyError):
+                design = None
+        if design is None:
+            design = Design.from_model(onset_time, model, parameters, tr, n_vols, polort)
+            self.save(key, design)
+        self._remember(key, design)
+        return key, design
+
+    def _remember(self, key, design):
+        with self._lock:
+            self._memory[key] = design
+            self._memory.move_to_end(key)
+            while len(self._memory) > self._max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def save(self, key, design):
+        """ store design on disk, the file is replaced atomically """
+        if self._path is None:
+            return
+        try:
+            if not os.path.exists(self._path):
+                os.makedirs(self._path, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=self._path)
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **design.to_arrays())
+            os.replace(tmp_path, self._filepath(key))
+        except (IOError, OSError):
+            # caching is optional, the design will be regenerated next time
+            return
+        self.evict()
+
+    def evict(self):
+        """ remove least recently used entries exceeding max_entries """
+        if self._path is None:
+            return
+        try:
+            files = [os.path.join(self._path, f) for f in os.listdir(self._path) if f.endswith('.npz')]
+            files = sorted(files, key=os.path.getmtime)
+            for f in files[:max(len(files) - self._max_entries, 0)]:
+                os.remove(f)
+        except (IOError, OSError):
+            pass
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if self._path is not None and os.path.exists(self._path):
+            for f in os.listdir(self._path):
+                if f.endswith('.npz'):
+                    os.remove(os.path.join(self._path, f))
+
+
+_design_caches = dict()
+
+
+def get_design_cache(path=None):
+    """ process-wide DesignCache instance for the given directory """
+    if path not in _design_caches:
+        _design_caches[path] = DesignCache(path)
+    return _design_caches[path]
+
+
+def _ols(design, data):
+    """ fit (T, n) data, returns (1 + 2 * n_stims, n) stats and residuals """
+    beta = design.pinv.dot(data)
+    resid = data - design.matrix.dot(beta)
+    rss = (resid ** 2).sum(0)
+    baseline_resid = data - design.baseline.dot(design.pinv_baseline.dot(data))
+    rss_baseline = (baseline_resid ** 2).sum(0)
+
+    sigma2 = rss / design.dof
+    stim_beta = beta[design.n_baseline:]
+    se = np.sqrt(design.cov_diag[:, np.newaxis] * sigma2[np.newaxis, :])
+    tstat = np.divide(stim_beta, se, out=np.zeros(stim_beta.shape), where=se > 0)
+    fstat = np.divide((rss_baseline - rss) / design.n_stims, sigma2,
+                      out=np.zeros(rss.shape), where=sigma2 > 0)
+
+    stats = np.empty((1 + 2 * design.n_stims, data.shape[1]))
+    stats[0] = fstat
+    stats[1::2] = stim_beta
+    stats[2::2] = tstat
+    return stats, resid
+
+
+def fit(design, data, method='AR1'):
+    """ voxel-wise GLM fit
+        Args:
+            design: Design instance
+            data: (T, n_voxels) time series
+            method: 'OLS' or 'AR1' (prewhitening with voxel-wise AR(1) coefficient,
+                    estimated from OLS residuals and grouped on a grid to solve in batch)
+        Returns:
+            (1 + 2 * n_stims, n_voxels) array of Full F-stat followed by coefficient and t-stat of
+            each stimulus, in the order of 3dREMLfit's -Rbuck output
+    """
+    data = np.asarray(data, dtype=np.float64)
+    stats, resid = _ols(design, data)
+    if method.upper() == 'OLS':
+        return stats
+    elif method.upper() != 'AR1':
+        raise ValueError('unsupported method "{}", use OLS or AR1.'.format(method))
+
+    ss = (resid ** 2).sum(0)
+    rho = np.divide((resid[1:] * resid[:-1]).sum(0), ss, out=np.zeros(ss.shape), where=ss > 0)
+    rho = np.clip(np.round(np.round(rho / AR1_STEP) * AR1_STEP, 4), -AR1_LIMIT, AR1_LIMIT)
+    for value in np.unique(rho):
+        if value == 0:
+            continue
+        idx = rho == value
+        stats[:, idx] = _ols(design.whiten(float(value)), ar1_whiten(data[:, idx], value))[0]
+    return stats
+
+
+class _Batch(object):
+    def __init__(self):
+        self.data = []
+        self.results = None
+        self.error = None
+        self.done = False
+
+
+class GroupSolver(object):
+    """ Solve the GLM of concurrent jobs sharing the same design in a single batch
+
+    Each job (e.g. a subject run executed by the InterfaceBuilder's worker threads) submits its
+    (T, n_voxels) chunk. The chunks with the same design key are stacked along the voxel axis
+    until group_size chunks are collected, and then the thread that completes the batch solves
+    it once and splits the results back to each job.
+
+    The jobs register their design key by join() before the first chunk and leave() after the last one,
+    so that the batch is closed as soon as all running jobs with the same key have submitted, when fewer
+    jobs than group_size are running (e.g. the cores granted to the step, the last runs, the runs with
+    different length). The timeout only bounds the wait of the jobs that are not registered.
+    """
+
+    def __init__(self, group_size, timeout=5.0):
+        """
+        Args:
+            group_size: number of chunks to be stacked
+            timeout: maximum seconds to wait other jobs before solving incomplete batch
+        """
+        self._group_size = group_size
+        self._timeout = timeout
+        self._pending = dict()
+        self._active = dict()
+        self._cond = threading.Condition()
+
+    def join(self, key):
+        """ register the running job which will submit its chunks with the key """
+        with self._cond:
+            self._active[key] = self._active.get(key, 0) + 1
+
+    def leave(self, key):
+        """ unregister the job, the batch waiting for it is closed """
+        with self._cond:
+            self._active[key] -= 1
+            if not self._active[key]:
+                del self._active[key]
+            self._cond.notify_all()
+
+    def _is_full(self, key, batch):
+        # the number of running jobs is group_size if no job is registered
+        return len(batch.data) >= min(self._group_size, self._active.get(key, self._group_size))
+
+    def fit(self, key, design, data, method='AR1'):
+        """ same as glm.fit, but solved together with the chunks from other jobs with the same key """
+        with self._cond:
+            batch = self._pending.setdefault(key, _Batch())
+            slot = len(batch.data)
+            batch.data.append(np.asarray(data, dtype=np.float64))
+            if not self._is_full(key, batch):
+                self._cond.wait_for(lambda: batch.done or self._is_full(key, batch), timeout=self._timeout)
+            leader = not batch.done and self._pending.get(key) is batch
+            if leader:
+                # close the batch so that the late jobs start new one
+                del self._pending[key]
+        if leader:
+            try:
+                sizes = [d.shape[1] for d in batch.data]
+                stats = fit(design, np.concatenate(batch.data, axis=1), method)
+                batch.results = np.split(stats, np.cumsum(sizes)[:-1], axis=1)
+            except Exception as e:
+                batch.error = e
+            with self._cond:
+                batch.done = True
+                self._cond.notify_all()
+        else:
+            with self._cond:
+                self._cond.wait_for(lambda: batch.done)
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[slot]
+
+
+_group_solvers = dict()
+
+
+def get_group_solver(group_size):
+    """ process-wide GroupSolver instance for the given group size """
+    if group_size not in _group_solvers:
+        _group_solvers[group_size] = GroupSolver(group_size)
+    return _group_solvers[group_size]
@@ -0,0 +1,433 @@
+""" Voxel-wise group statistics for the native 2nd level functions
+
+The images of the subjects are stacked into (n_subjects, n_voxels) arrays of the masked voxels,
+and the statistics of all voxels are computed at once.
+The cluster-size thresholds are estimated from the null distribution of the maximum cluster size,
+which is sampled by flipping the signs (one-sample) or permuting the group labels (two-sample)
+of the residuals, the same approach as 3dttest++ -Clustsim.
+"""
+import re
+import itertools
+import numpy as np
+
+# default thresholds of 3dClustSim
+P_THRESHOLDS = [0.05, 0.02, 0.01, 0.005, 0.002, 0.001, 0.0005, 0.0002, 0.0001]
+ALPHAS = [0.10, 0.05, 0.02, 0.01]
+
+
+def _one_sample(data):
+    """ mean and t-stat of (n, n_voxels) data """
+    n = data.shape[0]
+    mean = data.mean(0)
+    se = data.std(0, ddof=1) / np.sqrt(n)
+    return mean, np.divide(mean, se, out=np.zeros_like(mean), where=se > 0)
+
+
+def _two_sample(data_a, data_b):
+    """ difference and t-stat of pooled variance """
+    n_a, n_b = data_a.shape[0], data_b.shape[0]
+    diff = data_a.mean(0) - data_b.mean(0)
+    ss = ((data_a - data_a.mean(0)) ** 2).sum(0) + ((data_b - data_b.mean(0)) ** 2).sum(0)
+    se = np.sqrt(ss / (n_a + n_b - 2) * (1. / n_a + 1. / n_b))
+    return diff, np.divide(diff, se, out=np.zeros_like(diff), where=se > 0)
+
+
+def ttest(data_a, data_b=None):
+    """ one-sample or two-sample (pooled variance) t-test, sub-bricks are in the same order as 3dttest++
+        Args:
+            data_a: (n_a, n_voxels) data of group A
+            data_b: (n_b, n_voxels) data of group B, one-sample test if None
+        Returns:
+            stats: (n_bricks, n_voxels), [mean, Tstat] for one-sample test, or
+                   [diff, Tstat, meanA, TstatA, meanB, TstatB] for two-sample test
+            resid: (n_a + n_b, n_voxels) residuals of the group means
+            dof: degrees of freedom of the t-stat
+    """
+    data_a = np.asarray(data_a, dtype=np.float64)
+    if data_b is None:
+        mean, t = _one_sample(data_a)
+        return np.stack([mean, t]), data_a - mean, data_a.shape[0] - 1
+    data_b = np.asarray(data_b, dtype=np.float64)
+    diff, t = _two_sample(data_a, data_b)
+    stats = np.stack([diff, t] + list(_one_sample(data_a)) + list(_one_sample(data_b)))
+    resid = np.concatenate([data_a - data_a.mean(0), data_b - data_b.mean(0)])
+    return stats, resid, data_a.shape[0] + data_b.shape[0] - 2
+
+
+def t_thresholds(p_values, dof):
+    """ two-sided t thresholds of the voxel-wise p-values """
+    from scipy.stats import t
+    return t.isf(np.asarray(p_values) / 2., dof)
+
+
+def null_tstat(resid, n_a, rng):
+    """ t-stat of randomized residuals, signs are flipped if n_a is None, else the group labels are permuted
+        Args:
+            resid: (n, n_voxels) residuals from ttest
+            n_a: number of subjects in group A, None for one-sample test
+            rng: numpy RandomState
+        Returns:
+            (n_voxels,) t-stat
+    """
+    n = resid.shape[0]
+    if n_a is None:
+        signs = rng.randint(0, 2, n) * 2 - 1
+        return _one_sample(resid * signs[:, np.newaxis])[1]
+    order = rng.permutation(n)
+    return _two_sample(resid[order[:n_a]], resid[order[n_a:]])[1]
+
+
+def get_structure(nn):
+    """ connectivity of the clusters, NN1 (faces), NN2 (edges) or NN3 (corners) as 3dClustSim """
+    from scipy.ndimage import generate_binary_structure
+    if nn not in (1, 2, 3):
+        raise ValueError('nn must be 1, 2 or 3.')
+    return generate_binary_structure(3, nn)
+
+
+def max_cluster_sizes(volume, thresholds, structure):
+    """ largest cluster size of each threshold, positive and negative clusters are formed separately (bi-sided)
+        Args:
+            volume: (x, y, z) t-stat map, 0 outside the mask
+            thresholds: list of positive thresholds
+            structure: connectivity, see get_structure
+        Returns:
+            (n_thresholds,) int array
+    """
+    from scipy.ndimage import label
+    sizes = np.zeros(len(thresholds), dtype=np.int64)
+    for i, thr in enumerate(thresholds):
+        for supra in (volume >= thr, volume <= -thr):
+            if not supra.any():
+                continue
+            labels, n_labels = label(supra, structure)
+            sizes[i] = max(sizes[i], np.bincount(labels.ravel())[1:].max())
+    return sizes
+
+
+def cluster_thresholds(max_sizes, alphas=ALPHAS):
+    """ minimum cluster size of which probability under the null is not larger than alpha
+        Args:
+            max_sizes: (n_iter, n_thresholds) largest cluster sizes of the null samples
+            alphas: list of family-wise error rates
+        Returns:
+            (n_thresholds, n_alphas) int array
+    """
+    max_sizes = np.sort(np.asarray(max_sizes), axis=0)
+    n_iter = max_sizes.shape[0]
+    table = np.zeros((max_sizes.shape[1], len(alphas)), dtype=np.int64)
+    for j, alpha in enumerate(alphas):
+        # the number of the null samples with larger cluster must not exceed alpha * n_iter
+        idx = min(int(np.ceil((1 - alpha) * n_iter)) - 1, n_iter - 1)
+        table[:, j] = max_sizes[max(idx, 0)] + 1
+    return table
+
+
+def format_cluster_table(table, p_values, alphas, nn, n_iter, seed):
+    """ cluster threshold table in the layout of 3dClustSim """
+    lines = ['# CLUSTER SIZE THRESHOLD(pthr,alpha) in Voxels',
+             '# -NN {} | bi-sided | {} iterations (seed={})'.format(nn, n_iter, seed),
+             '#  pthr  | alpha = Prob(Cluster >= given size)',
+             '#        | ' + ' '.join('{:.5f}'.format(a)[1:] for a in alphas),
+             '# ------ | ' + ' '.join(['------'] * len(alphas))]
+    for p, row in zip(p_values, table):
+        lines.append(' {:.6f} '.format(p) + ' '.join('{:6d}'.format(int(v)) for v in row))
+    return '\n'.join(lines) + '\n'
+
+
+def parse_terms(formula):
+    """ model terms of the variables of 3dMVM (e.g. 'group*sex', 'group+sex+group:sex')
+        Returns:
+            list of tuples of variable names, main effects followed by the interactions
+    """
+    terms = []
+    if formula:
+        for part in formula.replace(' ', '').split('+'):
+            if not part:
+                continue
+            if '*' in part:
+                names = part.split('*')
+                candidates = [c for k in range(1, len(names) + 1) for c in itertools.combinations(names, k)]
+            else:
+                candidates = [tuple(part.split(':'))]
+            for term in candidates:
+                if term not in terms:
+                    terms.append(term)
+    return sorted(terms, key=len)
+
+
+def parse_contrast(code):
+    """ coding of GLT or GLF of 3dMVM (e.g. 'group : 1*pat -1*ctl cond : 1*A -1*B & 1*A -1*C')
+        Returns:
+            list of (variable, list of rows), each row is a dict of level: weight
+    """
+    contrast = []
+    for var, spec in re.findall(r'(\S+)\s*:\s*(.*?)(?=\s+\S+\s*:|$)', code.strip()):
+        rows = []
+        for row_spec in spec.split('&'):
+            row = dict()
+            for token in row_spec.split():
+                weight, _, level = token.partition('*')
+                if not level:
+                    raise ValueError('invalid contrast term "{}" in "{}".'.format(token, code))
+                row[level] = row.get(level, 0) + float(weight)
+            rows.append(row)
+        contrast.append((var, rows))
+    return contrast
+
+
+def _sum_coding(n_levels):
+    """ sum-to-zero coding (contr.sum) of factor, (n_levels, n_levels - 1) """
+    coding = np.zeros((n_levels, n_levels - 1))
+    coding[:-1] = np.eye(n_levels - 1)
+    coding[-1] = -1
+    return coding
+
+
+def _orthonormal_contrasts(n_levels):
+    """ orthonormal contrasts of factor levels, (n_levels, n_levels - 1) """
+    q = np.linalg.qr(np.column_stack([np.ones(n_levels), _sum_coding(n_levels)]))[0]
+    return q[:, 1:]
+
+
+class GroupModel(object):
+    """ Univariate multi-variable model of 3dMVM for between-subject (bsVars) and within-subject (wsVars)
+    factors, with type III tests of the sum-to-zero coded terms, general linear tests (GLT)
+    and general linear F-tests (GLF).
+
+    The model matrix, the projections of the terms and the contrasts are computed once from the data table,
+    then fit() solves the (n_inputs, n_voxels) data of any number of voxels in batch.
+    The within-subject terms are tested against their subject interaction (sphericity assumed).
+
+    Example:
+        model = GroupModel(table, bs_vars='group', ws_vars='cond', glt_codes=[('AvsB', 'cond : 1*A -1*B')])
+        stats = model.fit(data)     # (len(model.labels), n_voxels)
+    """
+
+    def __init__(self, table, bs_vars=None, ws_vars=None, glt_codes=None, glf_codes=None):
+        """
+        Args:
+            table: dict of columns, 'Subj' and the variables, one row for each input
+            bs_vars: formula of between-subject factors (e.g. 'group*sex')
+            ws_vars: formula of within-subject factors, full factorial (e.g. 'cond*time')
+            glt_codes: list of (label, code) of general linear tests
+            glf_codes: list of (label, code) of general linear F-tests
+        """
+        subjects = [str(s) for s in table['Subj']]
+        n_rows = len(subjects)
+        bs_terms = parse_terms(bs_vars)
+        ws_terms = parse_terms(ws_vars)
+        bs_factors = sorted(set(v for term in bs_terms for v in term), key=lambda v: bs_vars.index(v))
+        ws_factors = sorted(set(v for term in ws_terms for v in term), key=lambda v: ws_vars.index(v))
+        for var in bs_factors + ws_factors:
+            if var not in table:
+                raise ValueError('variable "{}" is not in the data table.'.format(var))
+        columns = {var: [str(v) for v in table[var]] for var in bs_factors + ws_factors}
+        self.levels = {var: sorted(set(values)) for var, values in columns.items()}
+        self.bs_factors = bs_factors
+        self.ws_factors = ws_factors
+
+        # rows of the subjects x within-subject cells
+        self.cells = list(itertools.product(*[self.levels[v] for v in ws_factors]))
+        self.subjects = sorted(set(subjects), key=subjects.index)
+        index = dict()
+        for i in range(n_rows):
+            cell = tuple(columns[v][i] for v in ws_factors)
+            if (subjects[i], cell) in index:
+                raise ValueError('duplicated input of subject "{}" for {}.'.format(subjects[i], cell))
+            index[(subjects[i], cell)] = i
+        self.order = []
+        for subj in self.subjects:
+            for cell in self.cells:
+                if (subj, cell) not in index:
+                    raise ValueError('missing input of subject "{}" for {}.'.format(subj, cell))
+                self.order.append(index[(subj, cell)])
+        if len(self.order) != n_rows:
+            raise ValueError('the number of inputs does not match the within-subject design.')
+        bs_levels = dict()
+        for i in range(n_rows):
+            levels = tuple(columns[v][i] for v in bs_factors)
+            if bs_levels.setdefault(subjects[i], levels) != levels:
+                raise ValueError('between-subject variables vary within subject "{}".'.format(subjects[i]))
+
+        # model matrix of the between-subject terms
+        codings = {v: _sum_coding(len(self.levels[v])) for v in bs_factors}
+        self.bs_cells = list(itertools.product(*[self.levels[v] for v in bs_factors]))
+
+        def design_row(levels):
+            row, term_cols = [1.], dict()
+            for term in bs_terms:
+                cols = np.ones(1)
+                for v in term:
+                    cols = np.kron(cols, codings[v][self.levels[v].index(levels[bs_factors.index(v)])])
+                term_cols[term] = list(range(len(row), len(row) + cols.size))
+                row.extend(cols)
+            return np.array(row), term_cols
+
+        self.X = np.array([design_row(bs_levels[s])[0] for s in self.subjects])
+        self.bs_rows = np.array([design_row(cell)[0] for cell in self.bs_cells])
+        term_cols = design_row(self.bs_cells[0])[1]
+        n_subjects, n_params = self.X.shape
+        self.dof = n_subjects - n_params
+        if self.dof < 1 or np.linalg.matrix_rank(self.X) < n_params:
+            raise ValueError('not enough subjects for the between-subject model.')
+        self.xtx_inv = np.linalg.inv(self.X.T.dot(self.X))
+        self.pinv = self.xtx_inv.dot(self.X.T)
+
+        # effects of between x within terms
+        self.effects = []
+        self.labels = []
+        for ws_term in [()] + ws_terms:
+            # orthonormal contrasts of the cells for the term, the other factors are averaged
+            transform = np.ones((1, 1))
+            for v in ws_factors:
+                n_levels = len(self.levels[v])
+                if v in ws_term:
+                    transform = np.kron(transform, _orthonormal_contrasts(n_levels))
+                else:
+                    transform = np.kron(transform, np.ones((n_levels, 1)) / np.sqrt(n_levels))
+            tests = []
+            for bs_term in [()] + bs_terms:
+                cols = [0] if not bs_term else term_cols[bs_term]
+                L = np.eye(n_params)[cols]
+                tests.append((cols, np.linalg.inv(L.dot(self.xtx_inv).dot(L.T))))
+                name = ':'.join(bs_term + ws_term) or '(Intercept)'
+                d = transform.shape[1]
+                self.labels.append(dict(label='{} F'.format(name), stat='F',
+                                        dof=[len(cols) * d, self.dof * d]))
+            self.effects.append((transform, tests))
+
+        self.glts = []
+        for label, code in (glt_codes or []):
+            c, w = self._contrast_rows(code)
+            if len(c) != 1 or len(w) != 1:
+                raise ValueError('GLT "{}" must have single row, use GLF for multiple rows.'.format(label))
+            self.glts.append((c[0], w[0][:, 0], c[0].dot(self.xtx_inv).dot(c[0])))
+            self.labels.append(dict(label=label, stat='value', dof=None))
+            self.labels.append(dict(label='{} t'.format(label), stat='t', dof=[self.dof]))
+
+        self.glfs = []
+        for label, code in (glf_codes or []):
+            c, w = self._contrast_rows(code)
+            L = np.array(c)
+            M = np.concatenate(w, axis=1)
+            if len(c) > 1 and M.shape[1] > 1:
+                raise ValueError('GLF "{}" with multiple rows on both between-subject and '
+                                 'within-subject variables is not supported.'.format(label))
+            A = np.linalg.inv(L.dot(self.xtx_inv).dot(L.T))
+            self.glfs.append((L, M, A))
+            if M.shape[1] == 1:
+                dof = [len(c), self.dof]
+            else:
+                dof = [M.shape[1], self.dof - M.shape[1] + 1]
+            self.labels.append(dict(label='{} F'.format(label), stat='F', dof=dof))
+
+    def _weights(self, factors, spec):
+        """ weights of the cells of the factors, the factors not in spec are averaged """
+        weights = []
+        for levels in itertools.product(*[self.levels[v] for v in factors]):
+            weight = 1.
+            for v, level in zip(factors, levels):
+                if v in spec:
+                    weight *= spec[v].get(level, 0)
+                else:
+                    weight /= len(self.levels[v])
+            weights.append(weight)
+        return np.array(weights)
+
+    def _contrast_rows(self, code):
+        """ between-subject contrasts of the parameters and within-subject weights of the cells """
+        contrast = parse_contrast(code)
+        bs_specs, ws_specs = [dict()], [dict()]
+        for var, rows in contrast:
+            if var not in self.levels:
+                raise ValueError('variable "{}" of "{}" is not in the model.'.format(var, code))
+            for row in rows:
+                for level in row:
+                    if level not in self.levels[var]:
+                        raise ValueError('level "{}" of "{}" is not in the data table.'.format(level, var))
+            specs = bs_specs if var in self.bs_factors else ws_specs
+            specs[:] = [dict(spec, **{var: row}) for spec, row in itertools.product(specs, rows)]
+        c = [self._weights(self.bs_factors, spec).dot(self.bs_rows) for spec in bs_specs]
+        w = [self._weights(self.ws_factors, spec)[:, np.newaxis] for spec in ws_specs]
+        return c, w
+
+    def fit(self, data):
+        """ statistics of the voxels
+            Args:
+                data: (n_inputs, n_voxels) data in the order of the data table
+            Returns:
+                (len(labels), n_voxels) array
+        """
+        data = np.asarray(data, dtype=np.float64)[self.order]
+        data = data.reshape(len(self.subjects), len(self.cells), -1)
+        stats = []
+        for transform, tests in self.effects:
+            z = np.einsum('scv,cd->sdv', data, transform)
+            b = np.einsum('ps,sdv->pdv', self.pinv, z)
+            resid = z - np.einsum('sp,pdv->sdv', self.X, b)
+            mse = (resid ** 2).sum((0, 1)) / (self.dof * transform.shape[1])
+            for cols, A in tests:
+                lb = b[cols]
+                ssh = np.einsum('qdv,qr,rdv->v', lb, A, lb)
+                msh = ssh / (len(cols) * transform.shape[1])
+                stats.append(np.divide(msh, mse, out=np.zeros_like(msh), where=mse > 0))
+
+        for c, w, cvc in self.glts:
+            z = np.einsum('scv,c->sv', data, w)
+            b = self.pinv.dot(z)
+            value = c.dot(b)
+            se = np.sqrt(((z - self.X.dot(b)) ** 2).sum(0) / self.dof * cvc)
+            stats.append(value)
+            stats.append(np.divide(value, se, out=np.zeros_like(value), where=se > 0))
+
+        for L, M, A in self.glfs:
+            z = np.einsum('scv,cr->srv', data, M)
+            b = np.einsum('ps,srv->prv', self.pinv, z)
+            resid = z - np.einsum('sp,prv->srv', self.X, b)
+            value = np.einsum('qp,prv->qrv', L, b)
+            if M.shape[1] == 1:
+                mse = (resid[:, 0] ** 2).sum(0) / self.dof
+                msh = np.einsum('qv,qr,rv->v', value[:, 0], A, value[:, 0]) / L.shape[0]
+                stats.append(np.divide(msh, mse, out=np.zeros_like(msh), where=mse > 0))
+            else:
+                # Hotelling's T-squared of the within-subject contrasts
+                r = M.shape[1]
+                cov = np.einsum('srv,stv->vrt', resid, resid) / self.dof
+                v = value[0].T
+                t2 = np.einsum('vr,vrt,vt->v', v, np.linalg.pinv(cov), v) * A[0, 0]
+                stats.append(t2 * (self.dof - r + 1) / (self.dof * r))
+        return np.array(stats)
+
+
+def make_datatable(inputs, regex, regex_label, reindex_subj_by=False):
+    """ data table of the inputs for the multi-variable model, the columns are parsed from the file paths
+        Args:
+            inputs: list of file paths
+            regex: regular expression pattern with groups
+            regex_label: dict of column label and group number of the pattern, 'Subj' is required
+            reindex_subj_by: between-subject variable to reindex subject id (e.g. the subject ids are
+                             reused across the groups), no reindexing if False
+        Returns:
+            OrderedDict of columns, 'Subj' followed by the variables
+    """
+    from collections import OrderedDict
+    p = re.compile(regex)
+    table = OrderedDict()
+    table['Subj'] = [p.search(f).group(regex_label['Subj']) for f in inputs]
+    for label, idx in regex_label.items():
+        if label != 'Subj':
+            table[label] = [p.search(f).group(idx) for f in inputs]
+
+    if reindex_subj_by is not False:
+        subjs = np.array(table['Subj'], dtype=object)
+        reindex_base = np.array(table[reindex_subj_by])
+        offset = 0
+        for item in sorted(set(reindex_base)):
+            sub_set = subjs[reindex_base == item]
+            sub_num = sorted(list(set(sub_set)))
+            mapping = {n: 's{}'.format(i + 1 + offset) for i, n in enumerate(sub_num)}
+            subjs[reindex_base == item] = [mapping[s] for s in sub_set]
+            offset += len(sub_num)
+        table['Subj'] = list(subjs)
+    return table
@@ -0,0 +1,283 @@
+""" Resource usage of the steps and the run report of the pipeline stages
+
+Each job of the step appends a record (wall time, CPU time, peak RSS and bytes read from and written to
+the storage) into the record file of its pipeline stage ('<project>/.profile/<stage>.jsonl').
+The shell commands are executed through this file as a wrapper script
+(python instrument.py RECORD STAGE STEP STEP_PATH JOB OUTPUT -- command ...), so that the usage
+of the command and all of its child processes is measured, and the python functions are measured in-process
+by profiled(). The scope of each record tells whether the usage is of the job alone (see SCOPES).
+The report of the stage (<stage>.json, <stage>.csv and the summary table in <stage>.txt) is updated from the records whenever a step finishes.
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import resource
+import threading
+
+PROFILE_DIR = '.profile'
+FIELDS = ['stage', 'step', 'subject', 'session', 'file', 'job', 'start', 'wall', 'cpu_user', 'cpu_system',
+          'max_rss', 'read_bytes', 'write_bytes', 'returncode', 'scope']
+# job:      the usage of the job and its child processes
+# thread:   the CPU time and IO of the thread running the python function, since the other jobs were running
+#           in the same process at the same time, its worker processes and helper threads are not included
+# process:  the usage of the whole process including the concurrent jobs (per-thread usage is not available)
+SCOPES = ['job', 'thread', 'process']
+# read_bytes and write_bytes are the block I/O of the storage (ru_inblock and ru_oublock) for both
+# the commands and the python functions, the reads served from the page cache are not counted
+USAGE_FIELDS = ['ru_utime', 'ru_stime', 'ru_inblock', 'ru_oublock']
+BLOCK_SIZE = 512
+
+_lock = threading.Lock()
+# overlap flags of the python functions running in this process
+_running = []
+
+
+def get_record_path(project_path, stage):
+    return os.path.join(project_path, PROFILE_DIR, '{}.jsonl'.format(stage))
+
+
+def parse_output(step_path, output):
+    """ subject, session and filename of the output of the step """
+    if not output:
+        return None, None, None
+    parts = os.path.relpath(output, step_path).split(os.sep)
+    if parts[0] == '..':
+        return None, None, os.path.basename(output)
+    subject = parts[0] if len(parts) > 1 else None
+    session = parts[1] if len(parts) > 2 else None
+    return subject, session, parts[-1]
+
+
+def _usage():
+    """ user and system CPU time and blocks read and written by this process and its terminated child processes """
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return [getattr(self_usage, f) + getattr(child_usage, f) for f in USAGE_FIELDS]
+
+
+def _thread_usage():
+    """ user and system CPU time and blocks read and written by the calling thread (Linux), None if not available """
+    if not hasattr(resource, 'RUSAGE_THREAD'):
+        return None
+    usage = resource.getrusage(resource.RUSAGE_THREAD)
+    return [getattr(usage, f) for f in USAGE_FIELDS]
+
+
+def _enter():
+    """ register the running python function, the functions running at the same time are marked as overlapped """
+    state = [False]
+    with _lock:
+        if _running:
+            state[0] = True
+            for other in _running:
+                other[0] = True
+        _running.append(state)
+    return state
+
+
+def _exit(state):
+    """ unregister the python function, True if another function was running at the same time """
+    with _lock:
+        _running.remove(state)
+    return state[0]
+
+
+def _max_rss(usage):
+    """ ru_maxrss in bytes, which is reported in kilobytes on Linux and in bytes on macOS """
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def append_record(record_path, record):
+    """ append the record as a line of JSON, the lines are short enough to be written atomically """
+    os.makedirs(os.path.dirname(record_path), exist_ok=True)
+    line = json.dumps(record) + '\n'
+    with _lock:
+        with open(record_path, 'a') as f:
+            f.write(line)
+
+
+def load_records(record_path):
+    records = []
+    if not os.path.exists(record_path):
+        return records
+    with open(record_path, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # partially written line of the interrupted job
+                continue
+    return records
+
+
+def make_record(stage, step, step_path, output, job, start, wall, cpu_user, cpu_system,
+                max_rss, read_bytes, write_bytes, returncode, scope='job'):
+    subject, session, fname = parse_output(step_path, output)
+    return dict(stage=stage, step=step, subject=subject, session=session, file=fname, job=job,
+                start=start, wall=wall, cpu_user=cpu_user, cpu_system=cpu_system, max_rss=max_rss,
+                read_bytes=read_bytes, write_bytes=write_bytes, returncode=returncode, scope=scope)
+
+
+def profiled(func, record_path, stage, step, step_path):
+    """ wrap the python function of the step to record its resource usage for each job
+
+    The wrapper keeps the argument names and the defaults of the function, since the arguments are
+    matched by the names of the function. The CPU time and block IO of the process and its worker processes
+    are recorded if no other job was running in the process at the same time, else those of the thread
+    running the job (see SCOPES). The peak RSS is of the whole process, which cannot be measured for each job.
+    """
+    code = func.__code__
+    names = list(code.co_varnames[:code.co_argcount])
+    defaults = func.__defaults__ or ()
+    n_required = len(names) - len(defaults)
+    params = [n if i < n_required else '{}=_defaults[{}]'.format(n, i - n_required) for i, n in enumerate(names)]
+    source = 'def {0}({1}):\n    return _call({2})\n'.format(func.__name__, ', '.join(params),
+                                                           ', '.join('{0}={0}'.format(n) for n in names))
+
+    def call(**kwargs):
+        state = _enter()
+        thread_usage = _thread_usage()
+        usage = _usage()
+        start = time.time()
+        returncode = None
+        try:
+            returncode = func(**kwargs)
+            return returncode
+        finally:
+            wall = time.time() - start
+            overlapped = _exit(state)
+            if overlapped and thread_usage is not None:
+                # the usage of the process includes the other jobs, only the thread running the job is measured
+                scope = 'thread'
+                delta = [e - s for s, e in zip(thread_usage, _thread_usage())]
+            else:
+                scope = 'process' if overlapped else 'job'
+                delta = [e - s for s, e in zip(usage, _usage())]
+            max_rss = max(_max_rss(resource.getrusage(resource.RUSAGE_SELF)),
+                          _max_rss(resource.getrusage(resource.RUSAGE_CHILDREN)))
+            output = kwargs.get('output')
+            record = make_record(stage, step, step_path, output if isinstance(output, str) else None, 0,
+                                 start, wall, delta[0], delta[1], max_rss, delta[2] * BLOCK_SIZE,
+                                 delta[3] * BLOCK_SIZE, returncode, scope)
+            append_record(record_path, record)
+
+    namespace = dict(_call=call, _defaults=defaults)
+    exec(source, namespace)
+    wrapper = namespace[func.__name__]
+    wrapper.__doc__ = func.__doc__
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
+def wrap_command(cmd, record_path, stage, step, step_path, job, output_placeholder=None):
+    """ command template executed through the profiler, the file is executed as script
+    to avoid importing the package (and pynipt) for every command """
+    args = [sys.executable, os.path.abspath(__file__), record_path, stage, step, step_path, str(job),
+            output_placeholder if output_placeholder is not None else '-']
+    return '{} -- {}'.format(' '.join(shlex.quote(arg) for arg in args), cmd)
+
+
+def run_command(argv):
+    """ execute the command and record the resource usage of the command and its child processes
+        Args:
+            argv: [record_path, stage, step, step_path, job, output, '--', command ...]
+        Returns:
+            return code of the command
+    """
+    import subprocess
+    record_path, stage, step, step_path, job, output = argv[:6]
+    command = argv[argv.index('--') + 1:]
+    start = time.time()
+    returncode = subprocess.call(command)
+    wall = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    record = make_record(stage, step, step_path, None if output == '-' else output, int(job), start, wall,
+                         usage.ru_utime, usage.ru_stime, _max_rss(usage),
+                         usage.ru_inblock * BLOCK_SIZE, usage.ru_oublock * BLOCK_SIZE, returncode)
+    append_record(record_path, record)
+    return returncode
+
+
+def _aggregate(records, keys):
+    """ sum of the usage grouped by the keys, the peak RSS is the maximum """
+    groups = dict()
+    for r in records:
+        group = tuple(r.get(k) for k in keys)
+        if group not in groups:
+            groups[group] = dict(zip(keys, group), n_jobs=0, wall=0., cpu=0., max_rss=0, read_bytes=0,
+                                 write_bytes=0, failed=0)
+        g = groups[group]
+        g['n_jobs'] += 1
+        g['wall'] += r['wall']
+        g['cpu'] += r['cpu_user'] + r['cpu_system']
+        g['max_rss'] = max(g['max_rss'], r['max_rss'] or 0)
+        g['read_bytes'] += r['read_bytes'] or 0
+        g['write_bytes'] += r['write_bytes'] or 0
+        g['failed'] += int(r['returncode'] not in (0, None))
+    return sorted(groups.values(), key=lambda g: g['wall'], reverse=True)
+
+
+def summarize(records, top=10):
+    """ slowest steps and subjects
+        Returns:
+            dict of 'steps' and 'subjects', lists of aggregated usage sorted by wall time,
+            and 'scopes', number of the records of each scope
+    """
+    scopes = {scope: 0 for scope in SCOPES}
+    for r in records:
+        scope = r.get('scope', 'process')
+        scopes[scope] = scopes.get(scope, 0) + 1
+    return dict(steps=_aggregate(records, ['step'])[:top],
+                subjects=_aggregate([r for r in records if r.get('subject')], ['step', 'subject'])[:top],
+                scopes=scopes)
+
+
+def format_summary(summary):
+    """ summary table in text """
+    lines = []
+    for title, keys in [('Slowest steps', ['step']), ('Slowest subjects', ['step', 'subject'])]:
+        lines.append(title)
+        lines.append('{:<40} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            ' / '.join(keys), 'jobs', 'wall(s)', 'cpu(s)', 'rss(MB)', 'read(MB)', 'write(MB)'))
+        for g in summary['steps' if keys == ['step'] else 'subjects']:
+            lines.append('{:<40} {:>6} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                ' / '.join(str(g[k]) for k in keys)[:40], g['n_jobs'], g['wall'], g['cpu'],
+                g['max_rss'] / 1024 ** 2, g['read_bytes'] / 1024 ** 2, g['write_bytes'] / 1024 ** 2))
+        lines.append('')
+    scopes = summary.get('scopes', dict())
+    if scopes.get('thread'):
+        lines.append('* {} job(s) ran concurrently with the other jobs in the same process, '
+                     'only the thread running the job is measured.'.format(scopes['thread']))
+    if scopes.get('process'):
+        lines.append('* {} job(s) are measured for the whole process, '
+                     'the usage includes the concurrent jobs.'.format(scopes['process']))
+    if scopes.get('thread') or scopes.get('process'):
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def write_report(record_path, top=10):
+    """ write the report of the stage as JSON (records and summary), CSV (records) and text (summary table)
+        Returns:
+            summary, see summarize
+    """
+    import csv
+    records = load_records(record_path)
+    summary = summarize(records, top)
+    prefix = os.path.splitext(record_path)[0]
+    with _lock:
+        with open(prefix + '.json', 'w') as f:
+            json.dump(dict(records=records, summary=summary), f, indent=1)
+        with open(prefix + '.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(records)
+        with open(prefix + '.txt', 'w') as f:
+            f.write(format_summary(summary))
+    return summary
+
+
+if __name__ == '__main__':
+    sys.exit(run_command(sys.argv[1:]))
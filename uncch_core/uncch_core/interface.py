@@ -1,22 +1,35 @@
-from pynipt import Processor, InterfaceBuilder
+from pynipt import Processor
+from .builder import InterfaceBuilder, get_cache_dir
 from shleeh.errors import *
 import sys
 
 
 class Interface(Processor):
     """command line interface example
+
+    The native functions with n_workers start worker processes by forkserver (or spawn), which import
+    the main script, so the script running the steps must guard its entry point by
+    "if __name__ == '__main__':", otherwise the jobs are executed without the workers (see parallel.SharedPool).
     """
 
     def __init__(self, *args, **kwargs):
         super(Interface, self).__init__(*args, **kwargs)
 
-    def camri_Periodogram(self, input_path, mask_path=None, dt=None, nfft=None,
+    def camri_Periodogram(self, input_path, mask_path=None, dt=None, nfft=None, bands=None,
+                          mem_limit=None, n_workers=None,
                           file_idx=None, regex=None, img_ext='nii.gz',
                           step_idx=None, sub_code=None, suffix=None):
         """
         Args:
             input_path(str):    datatype or stepcode of input data
             mask_path(str):      mask
+            dt(int or float):   sampling interval in second
+            nfft(int):          length of the FFT
+            bands(list):        frequency bands in Hz (e.g. [[0.01, 0.1]]), if provided, ALFF and fALFF
+                                maps of each band are stored instead of the full spectrum
+            mem_limit(int):     memory budget in MB for each job, stream input by z-slabs if provided
+            n_workers(int):     number of worker processes for each job, if provided,
+                                the files will be processed one at a time.
             file_idx(int):      index of file if the process need to be executed on a specific file
                                 in session folder.
             regex(str):         regular express pattern to filter dataset
@@ -27,7 +40,10 @@ class Interface(Processor):
             suffix(str):        suffix to identify the current step
         """
         from .funcs import periodogram_func
-        itf = InterfaceBuilder(self)
+        if n_workers is None:
+            itf = InterfaceBuilder(self)
+        else:
+            itf = InterfaceBuilder(self, n_threads=1)
         itf.init_step(title='Periodogram', mode='processing', type='python',
                       idx=step_idx, subcode=sub_code, suffix=suffix)
         if regex is not None:
@@ -39,7 +55,606 @@ class Interface(Processor):
         itf.set_var(label='mask', value=mask_path)
         itf.set_var(label='dt', value=dt)
         itf.set_var(label='nfft', value=nfft)
+        itf.set_var(label='bands', value=bands)
+        itf.set_var(label='mem_limit', value=mem_limit)
+        itf.set_var(label='n_workers', value=n_workers)
         itf.set_func(periodogram_func)
         itf.set_output(label='output')
         itf.set_output_checker(label='output')
         itf.run()
+
+    def camri_MeanImageCalc(self, input_path, range=None, mem_limit=None,
+                            file_idx=0, regex=None, img_ext='nii.gz',
+                            step_idx=None, sub_code=None, suffix=None):
+        """Calculate mean intensity image of one or multiple time windows with single read of input
+        Args:
+            input_path(str):    datatype or stepcode of input data
+            range(list):        range for averaging, [start, end] or list of them (e.g. [[0, 19], [80, 99]]).
+                                multiple windows are stored as volumes of output in given order.
+                                (default=None)
+            mem_limit(int):     memory budget in MB for each job, stream input by blocks of volumes
+            file_idx(int):      index of file if the process need to be executed on a specific file
+                                in session folder.
+            regex(str):         regular express pattern to filter dataset
+            img_ext(str):       file extension (default='nii.gz')
+            step_idx(int):      stepcode index (positive integer lower than 99)
+            sub_code(str):      sub stepcode, one character, 0 or A-Z
+            suffix(str):        suffix to identify the current step
+        """
+        from .funcs import meanimage_func
+        itf = InterfaceBuilder(self)
+        itf.init_step(title='MeanImageCalculation', mode='processing', type='python',
+                      idx=step_idx, subcode=sub_code, suffix=suffix)
+        if regex is not None:
+            filter_dict = dict(regex=regex, ext=img_ext)
+        else:
+            filter_dict = dict(ext=img_ext)
+        itf.set_input(label='input', input_path=input_path, group_input=False, idx=file_idx,
+                      filter_dict=filter_dict)
+        if range is not None:
+            if all(isinstance(r, int) for r in range):
+                range = [range]
+            for r in range:
+                if not isinstance(r, list) or len(r) != 2 or not all(isinstance(i, int) for i in r):
+                    self.logging('warn', 'incorrect range values.')
+        itf.set_var(label='ranges', value=range)
+        itf.set_var(label='mem_limit', value=mem_limit)
+        itf.set_func(meanimage_func)
+        itf.set_output(label='output')
+        itf.set_output_checker(label='output')
+        itf.run()
+
+    def camri_Calc(self, input_path, expr, mask_path=None, mem_limit=None,
+                   file_idx=None, regex=None, img_ext='nii.gz',
+                   step_idx=None, sub_code=None, suffix=None):
+        """ voxel-wise calculation of 3dcalc-style expression over z-slabs of the input
+        Args:
+            input_path(str):    datatype or stepcode of input data, variable 'a' of the expression
+            expr(str):          expression, e.g. 'a*step(b)', temporal reductions such as tmean(a) are
+                                computed on the fly without temporary file
+            mask_path(str):     path for mask image, variable 'b' of the expression
+            mem_limit(int):     memory budget in MB for each job
+            file_idx(int):      index of file if the process need to be executed on a specific file
+                                in session folder.
+            regex(str):         regular express pattern to filter dataset
+            img_ext(str):       file extension (default='nii.gz')
+            step_idx(int):      stepcode index (positive integer lower than 99)
+            sub_code(str):      sub stepcode, one character, 0 or A-Z
+            suffix(str):        suffix to identify the current step
+        """
+        from .funcs import calc_func
+        itf = InterfaceBuilder(self)
+        itf.init_step(title='Calculation', mode='processing', type='python',
+                      idx=step_idx, subcode=sub_code, suffix=suffix)
+        if regex is not None:
+            filter_dict = dict(regex=regex, ext=img_ext)
+        else:
+            filter_dict = dict(ext=img_ext)
+        itf.set_input(label='input', input_path=input_path, idx=file_idx,
+                      filter_dict=filter_dict, group_input=False)
+        itf.set_var(label='expr', value=expr)
+        itf.set_var(label='mask', value=mask_path)
+        itf.set_var(label='mem_limit', value=mem_limit)
+        itf.set_func(calc_func)
+        itf.set_output(label='output')
+        itf.set_output_checker(label='output')
+        itf.run()
+
+    def camri_SkullStripping(self, input_path, mask_path, mem_limit=None,
+                             file_idx=None, regex=None, img_ext='nii.gz',
+                             step_idx=None, sub_code=None, suffix=None):
+        """ stripping the skull using brain mask, native replacement of afni_SkullStripping
+        Args:
+            input_path(str):    datatype or stepcode of input data
+            mask_path(str):     stepcode of mask_path
+            mem_limit(int):     memory budget in MB for each job
+            file_idx(int):      index of file if the process need to be executed on a specific file
+                                in session folder.
+            regex(str):         regular express pattern to filter dataset
+            img_ext(str):       file extension (default='nii.gz')
+            step_idx(int):      stepcode index (positive integer lower than 99)
+            sub_code(str):      sub stepcode, one character, 0 or A-Z
+            suffix(str):        suffix to identify the current step
+        """
+        from .funcs import calc_func
+        itf = InterfaceBuilder(self)
+        itf.init_step(title='SkullStripping', mode='processing', type='python',
+                      idx=step_idx, subcode=sub_code, suffix=suffix)
+        if regex is not None:
+            filter_dict = dict(regex=regex, ext=img_ext)
+        else:
+            filter_dict = dict(ext=img_ext)
+        itf.set_input(label='input', input_path=input_path, idx=file_idx,
+                      filter_dict=filter_dict, group_input=False)
+        itf.set_static_input(label='mask', input_path=mask_path,
+                             idx=0, mask=True, filter_dict=dict(regex=r'.*_mask$', ext=img_ext))
+        itf.set_var(label='expr', value='a*step(b)')
+        itf.set_var(label='mem_limit', value=mem_limit)
+        itf.set_func(calc_func)
+        itf.set_output(label='output')
+        itf.set_output_checker(label='output')
+        itf.run()
+
+    def camri_Scaling(self, input_path, mask_path, mean=100, max=200, mem_limit=None,
+                      file_idx=None, regex=None, img_ext='nii.gz',
+                      step_idx=None, sub_code=None, suffix=None):
+        """ Scaling the time series dataset to have given mean in the mask,
+        native replacement of afni_Scailing which computes the temporal mean in the same pass.
+        If max value is inputted, the max value will be cut at given value.
+        Args:
+            input_path(str):    datatype or stepcode of input data
+            mask_path(str):     path for brain mask image
+            mean(int, float):   desired mean value
+            max(int, float):    desired max value
+            mem_limit(int):     memory budget in MB for each job
+            file_idx(int):      index of file if the process need to be executed on a specific file
+                                in session folder.
+            regex(str):         regular express pattern to filter dataset
+            img_ext(str):       file extension (default='nii.gz')
+            step_idx(int):      stepcode index (positive integer lower than 99)
+            sub_code(str):      sub stepcode, one character, 0 or A-Z
+            suffix(str):        suffix to identify the current step
+        """
+        from .funcs import calc_func
+        itf = InterfaceBuilder(self)
+        itf.init_step(title='Scaling', mode='processing', type='python',
+                      idx=step_idx, subcode=sub_code, suffix=suffix)
+        if regex is not None:
+            filter_dict = dict(regex=regex, ext=img_ext)
+        else:
+            filter_dict = dict(ext=img_ext)
+        itf.set_input(label='input', input_path=input_path, idx=file_idx,
+                      filter_dict=filter_dict, group_input=False)
+        if max is not None:
+            expr = 'b * min({}, a/tmean(a)*{})'.format(max, mean)
+        else:
+            expr = 'b * a/tmean(a)*{}'.format(mean)
+        itf.set_var(label='expr', value=expr)
+        itf.set_var(label='mask', value=mask_path)
+        itf.set_var(label='mem_limit', value=mem_limit)
+        itf.set_func(calc_func)
+        itf.set_output(label='output')
+        itf.set_output_checker(label='output')
+        itf.run()
+
+    def camri_GLM(self, input_path, mask_path, onset_time, model, parameters, polort=2, method='AR1',
+                  mem_limit=None, n_workers=None, cache_dir=None, group_size=None,
+                  regex=None, img_ext='nii.gz', file_idx=None,
+                  step_idx=None, sub_code=None, suffix=None):
+        """ General Linear Model analysis with batched solve across all masked voxels,
+        native alternative of afni_Deconvolution for the single stimulation model.
+        The output contains Full F-stat, coefficient and t-stat of the stimulus.
+        Args:
+            input_path(str):    datatype or stepcode of input data
+            mask_path(str):     path for brain mask image
+            onset_time(list):   stimulation onset time, list of int (e.g. [10, 50, 90])
+            model(str):         response model, BLOCK or GAM
+            parameters(list):   parameters for response model
+            polort(int):        polynomial regressor for detrending
+            method(str):        OLS or AR1 (default='AR1')
+            mem_limit(int):     memory budget in MB for each job
+            n_workers(int):     number of worker processes for each job, if provided,
+                                the files will be processed one at a time.
+            cache_dir(str):     directory of design matrix cache, the scratch session if set by set_scratch,
+                                else '<project>/.cache/design'
+            group_size(int):    number of runs to be solved together in a single batch, the runs are
+                                executed with the same number of threads. (cannot be used with n_workers)
+            file_idx(int):      index of file if the process need to be executed on a specific file
+                                in session folder.
+            regex(str):         regular express pattern to filter dataset
+            img_ext(str):       file extension (default='nii.gz')
+            step_idx(int):      stepcode index (positive integer lower than 99)
+            sub_code(str):      sub stepcode, one character, 0 or A-Z
+            suffix(str):        suffix to identify the current step
+        """
+        from .funcs import glm_func
+        if group_size is not None:
+            itf = InterfaceBuilder(self, n_threads=group_size)
+        elif n_workers is not None:
+            itf = InterfaceBuilder(self, n_threads=1)
+        else:
+            itf = InterfaceBuilder(self)
+        itf.init_step(title='GLM', mode='processing', type='python',
+                      idx=step_idx, subcode=sub_code, suffix=suffix)
+        if regex is not None:
+            filter_dict = dict(regex=regex, ext=img_ext)
+        else:
+            filter_dict = dict(ext=img_ext)
+        itf.set_input(label='input', input_path=input_path, idx=file_idx,
+                      filter_dict=filter_dict, group_input=False)
+        itf.set_var(label='mask', value=mask_path)
+        itf.set_var(label='onset_time', value=onset_time)
+        itf.set_var(label='model', value=model)
+        itf.set_var(label='parameters', value=parameters)
+        itf.set_var(label='polort', value=polort)
+        itf.set_var(label='method', value=method)
+        itf.set_var(label='mem_limit', value=mem_limit)
+        itf.set_var(label='n_workers', value=n_workers)
+        itf.set_var(label='cache_dir', value=cache_dir or get_cache_dir(self, 'design'))
+        itf.set_var(label='group_size', value=group_size)
+        itf.set_func(glm_func)
+        itf.set_output(label='output')
+        itf.set_output_checker(label='output')
+        itf.run()
+
+    def camri_SliceTimingCorrection(self, input_path, tr=None, tpattern=None,
+                                    mem_limit=None, n_workers=None,
+                                    file_idx=None, regex=None, img_ext='nii.gz',
+                                    step_idx=None, sub_code=None, suffix=None):
+        """ slice timing correction using Fourier interpolation, the native alternative of afni_SliceTimingCorrection
+        Args:
+            input_path(str):    datatype or stepcode of input data
+            tr(int or float):   repetition time in second, the value in the header is used if not provided
+            tpattern(str):      slice timing pattern of 3dTshift (e.g. altplus, alt+z2, seqplus),
+                                the slice timing in the header is used if not provided
+            mem_limit(int):     memory budget in MB for each job, stream input by z-slabs if provided
+            n_workers(int):     number of worker processes for each job, if provided,
+                                the files will be processed one at a time.
+            file_idx(int):      index of file if the process need to be executed on a specific file
+                                in session folder.
+            regex(str):         regular express pattern to filter dataset
+            img_ext(str):       file extension (default='nii.gz')
+            step_idx(int):      stepcode index (positive integer lower than 99)
+            sub_code(str):      sub stepcode, one character, 0 or A-Z
+            suffix(str):        suffix to identify the current step
+        """
+        from .funcs import slicetiming_func
+        if n_workers is None:
+            itf = InterfaceBuilder(self)
+        else:
+            itf = InterfaceBuilder(self, n_threads=1)
+        itf.init_step(title='SliceTimingCorrection', mode='processing', type='python',
+                      idx=step_idx, subcode=sub_code, suffix=suffix)
+        if regex is not None:
+            filter_dict = dict(regex=regex, ext=img_ext)
+        else:
+            filter_dict = dict(ext=img_ext)
+        itf.set_input(label='input', input_path=input_path, idx=file_idx,
+                      filter_dict=filter_dict, group_input=False)
+        itf.set_var(label='tr', value=tr)
+        itf.set_var(label='tpattern', value=tpattern)
+        itf.set_var(label='mem_limit', value=mem_limit)
+        itf.set_var(label='n_workers', value=n_workers)
+        itf.set_func(slicetiming_func)
+        itf.set_output(label='output')
+        itf.set_output_checker(label='output')
+        itf.run()
+
+    def camri_BlurInMask(self, input_path, fwhm, mask_path=None, mem_limit=None, n_threads=None,
+                         file_idx=None, regex=None, img_ext='nii.gz',
+                         step_idx=None, sub_code=None, suffix=None):
+        """ FWHM based spatial gaussian smoothing within the mask, the native alternative of
+        afni_BlurInMask and afni_BlurToFWHM
+        Args:
+            input_path(str):    datatype or stepcode of input data
+            fwhm(float):        full width half maximum value in mm
+            mask_path(str):     path for brain mask image, whole image is smoothed if not provided
+            mem_limit(int):     memory budget in MB for each job, stream input by blocks of volumes if provided
+            n_threads(int):     number of threads for each job, if provided,
+                                the files will be processed one at a time.
+            file_idx(int):      index of file if the process need to be executed on a specific file
+                                in session folder.
+            regex(str):         regular express pattern to filter dataset
+            img_ext(str):       file extension (default='nii.gz')
+            step_idx(int):      stepcode index (positive integer lower than 99)
+            sub_code(str):      sub stepcode, one character, 0 or A-Z
+            suffix(str):        suffix to identify the current step
+        """
+        from .funcs import blur_func
+        if n_threads is None:
+            itf = InterfaceBuilder(self)
+        else:
+            itf = InterfaceBuilder(self, n_threads=1)
+        itf.init_step(title='BlurInMask', mode='processing', type='python',
+                      idx=step_idx, subcode=sub_code, suffix=suffix)
+        if regex is not None:
+            filter_dict = dict(regex=regex, ext=img_ext)
+        else:
+            filter_dict = dict(ext=img_ext)
+        itf.set_input(label='input', input_path=input_path, idx=file_idx,
+                      filter_dict=filter_dict, group_input=False)
+        itf.set_var(label='fwhm', value=fwhm)
+        itf.set_var(label='mask', value=mask_path)
+        itf.set_var(label='mem_limit', value=mem_limit)
+        itf.set_var(label='n_threads', value=n_threads)
+        itf.set_func(blur_func)
+        itf.set_output(label='output')
+        itf.set_output_checker(label='output')
+        itf.run()
+
+    def camri_GLMChain(self, input_path, mask_path, fwhm, onset_time, model, parameters,
+                       mean=100, max=200, polort=2, method='AR1', smoothing='volume', keep_intermediates=False,
+                       mem_limit=None, n_workers=None, n_threads=None, cache_dir=None, group_size=None,
+                       regex=None, img_ext='nii.gz', file_idx=None,
+                       step_idx=None, sub_code=None, suffix=None):
+        """ scaling, smoothing and GLM analysis in single step without intermediate files,
+        the fused alternative of afni_Scailing, afni_BlurToFWHM and afni_Deconvolution
+        Args:
+            input_path(str):            datatype or stepcode of input data
+            mask_path(str):             path for brain mask image
+            fwhm(float):                full width half maximum value in mm
+            onset_time(list):           stimulation onset times in second
+            model(str):                 response model, 'BLOCK' or 'GAM'
+            parameters(list):           parameters for response model
+            mean(int, float):           desired mean value
+            max(int, float):            desired max value
+            polort(int):                order of polynomials for detrending
+            method(str):                'OLS' or 'AR1'
+            smoothing(str):             'volume' to smooth the whole volume as afni_BlurToFWHM,
+                                        or 'mask' to smooth within the mask as camri_BlurInMask
+            keep_intermediates(bool):   store scaled and smoothed data in the output folder if True
+            mem_limit(int):             memory budget in MB for each job, the working array is
+                                        memory-mapped if it exceeds the budget
+            n_workers(int):             number of worker processes of GLM for each job
+            n_threads(int):             number of threads of smoothing for each job
+            cache_dir(str):             directory of design matrix cache, see camri_GLM
+            group_size(int):            number of runs to be solved together in batch, see camri_GLM
+            file_idx(int):              index of file if the process need to be executed on a specific file
+                                        in session folder.
+            regex(str):                 regular express pattern to filter dataset
+            img_ext(str):               file extension (default='nii.gz')
+            step_idx(int):              stepcode index (positive integer lower than 99)
+            sub_code(str):              sub stepcode, one character, 0 or A-Z
+            suffix(str):                suffix to identify the current step
+        """
+        from .funcs import glm_chain_func
+        if group_size is not None:
+            itf = InterfaceBuilder(self, n_threads=group_size)
+        elif n_workers is not None or n_threads is not None:
+            itf = InterfaceBuilder(self, n_threads=1)
+        else:
+            itf = InterfaceBuilder(self)
+        itf.init_step(title='GLMChain', mode='processing', type='python',
+                      idx=step_idx, subcode=sub_code, suffix=suffix)
+        if regex is not None:
+            filter_dict = dict(regex=regex, ext=img_ext)
+        else:
+            filter_dict = dict(ext=img_ext)
+        itf.set_input(label='input', input_path=input_path, idx=file_idx,
+                      filter_dict=filter_dict, group_input=False)
+        itf.set_var(label='mask', value=mask_path)
+        itf.set_var(label='fwhm', value=fwhm)
+        itf.set_var(label='onset_time', value=onset_time)
+        itf.set_var(label='model', value=model)
+        itf.set_var(label='parameters', value=parameters)
+        itf.set_var(label='mean_value', value=mean)
+        itf.set_var(label='max_value', value=max)
+        itf.set_var(label='polort', value=polort)
+        itf.set_var(label='method', value=method)
+        itf.set_var(label='smoothing', value=smoothing)
+        itf.set_var(label='keep_intermediates', value=keep_intermediates)
+        itf.set_var(label='mem_limit', value=mem_limit)
+        itf.set_var(label='n_workers', value=n_workers)
+        itf.set_var(label='n_threads', value=n_threads)
+        itf.set_var(label='cache_dir', value=cache_dir or get_cache_dir(self, 'design'))
+        itf.set_var(label='group_size', value=group_size)
+        itf.set_func(glm_chain_func)
+        itf.set_output(label='output')
+        itf.set_output_checker(label='output')
+        itf.run()
+
+    def camri_ApplySpatialNorm(self, input_path, ref_path, method='ants', mem_limit=None, n_threads=None,
+                               cache_dir=None, file_idx=None, regex=None, img_ext='nii.gz',
+                               step_idx=None, sub_code=None, suffix=None):
+        """ apply the spatial normalization transform to all volumes with trilinear interpolation,
+        the native alternative of ants_ApplySpatialNorm and afni_ApplySpatialNorm. The displacement field
+        and the affine transform are evaluated once per subject and the sampling weights are shared
+        by the runs of the subject.
+        Args:
+            input_path(str):    datatype or stepcode of input data
+            ref_path(str):      stepcode of spatial normalization (ants_SpatialNorm or afni_SpatialNorm)
+            method(str):        'ants' or 'afni', the tool used for spatial normalization
+            mem_limit(int):     memory budget in MB for each job, stream input by blocks of volumes if provided
+            n_threads(int):     number of threads for each job, if provided,
+                                the files will be processed one at a time.
+            cache_dir(str):     directory of resampler cache, the scratch session if set by set_scratch,
+                                else '<project>/.cache/resampler'
+            file_idx(int):      index of file if the process need to be executed on a specific file
+                                in session folder.
+            regex(str):         regular express pattern to filter dataset
+            img_ext(str):       file extension (default='nii.gz')
+            step_idx(int):      stepcode index (positive integer lower than 99)
+            sub_code(str):      sub stepcode, one character, 0 or A-Z
+            suffix(str):        suffix to identify the current step
+        """
+        from .funcs import spatial_norm_func
+        if n_threads is None:
+            itf = InterfaceBuilder(self)
+        else:
+            itf = InterfaceBuilder(self, n_threads=1)
+        itf.init_step(title='ApplySpatialNorm', mode='processing', type='python',
+                      idx=step_idx, subcode=sub_code, suffix=suffix)
+        if regex is not None:
+            filter_dict = dict(regex=regex, ext=img_ext)
+        else:
+            filter_dict = dict(ext=img_ext)
+        itf.set_input(label='input', input_path=input_path, idx=file_idx,
+                      filter_dict=filter_dict, group_input=False)
+        if method == 'ants':
+            itf.set_static_input(label='base', input_path=ref_path,
+                                 idx=0, filter_dict=dict(regex=r'.*_Warped$', ext='nii.gz'))
+            itf.set_static_input(label='tfmorph', input_path=ref_path,
+                                 idx=0, filter_dict=dict(regex=r'.*_1Warp$', ext='nii.gz'))
+            itf.set_static_input(label='tfmat', input_path=ref_path,
+                                 idx=0, filter_dict=dict(ext='mat'))
+        elif method == 'afni':
+            itf.set_static_input(label='base', input_path=ref_path,
+                                 idx=0, filter_dict=dict(ext='nii.gz'))
+            itf.set_static_input(label='tfmat', input_path=ref_path,
+                                 idx=0, filter_dict=dict(ext='aff12.1D'))
+        else:
+            raise ValueError('method must be "ants" or "afni".')
+        itf.set_var(label='mem_limit', value=mem_limit)
+        itf.set_var(label='n_threads', value=n_threads)
+        itf.set_var(label='cache_dir', value=cache_dir or get_cache_dir(self, 'resampler'))
+        itf.set_func(spatial_norm_func)
+        itf.set_output(label='output')
+        itf.set_output_checker(label='output')
+        itf.run()
+
+    def camri_ApplyCombinedTransform(self, input_path, ref_path, coreg_path, method='ants', mem_limit=None,
+                                     n_threads=None, cache_dir=None, file_idx=None, regex=None, img_ext='nii.gz',
+                                     step_idx=None, sub_code=None, suffix=None):
+        """ resample the data into template space in single interpolation by composing the co-registration
+        matrix with the spatial normalization transform, instead of afni_ApplyTransform followed by
+        ants_ApplySpatialNorm or afni_ApplySpatialNorm
+        Args:
+            input_path(str):    datatype or stepcode of input data
+            ref_path(str):      stepcode of spatial normalization (ants_SpatialNorm or afni_SpatialNorm)
+            coreg_path(str):    stepcode of co-registration (afni_Coregistration)
+            method(str):        'ants' or 'afni', the tool used for spatial normalization
+            mem_limit(int):     memory budget in MB for each job, stream input by blocks of volumes if provided
+            n_threads(int):     number of threads for each job, if provided,
+                                the files will be processed one at a time.
+            cache_dir(str):     directory of resampler cache, the scratch session if set by set_scratch,
+                                else '<project>/.cache/resampler'
+            file_idx(int):      index of file if the process need to be executed on a specific file
+                                in session folder.
+            regex(str):         regular express pattern to filter dataset
+            img_ext(str):       file extension (default='nii.gz')
+            step_idx(int):      stepcode index (positive integer lower than 99)
+            sub_code(str):      sub stepcode, one character, 0 or A-Z
+            suffix(str):        suffix to identify the current step
+        """
+        from .funcs import combined_transform_func
+        if n_threads is None:
+            itf = InterfaceBuilder(self)
+        else:
+            itf = InterfaceBuilder(self, n_threads=1)
+        itf.init_step(title='ApplyCombinedTransform', mode='processing', type='python',
+                      idx=step_idx, subcode=sub_code, suffix=suffix)
+        if regex is not None:
+            filter_dict = dict(regex=regex, ext=img_ext)
+        else:
+            filter_dict = dict(ext=img_ext)
+        itf.set_input(label='input', input_path=input_path, idx=file_idx,
+                      filter_dict=filter_dict, group_input=False)
+        if method == 'ants':
+            itf.set_static_input(label='base', input_path=ref_path,
+                                 idx=0, filter_dict=dict(regex=r'.*_Warped$', ext='nii.gz'))
+            itf.set_static_input(label='tfmorph', input_path=ref_path,
+                                 idx=0, filter_dict=dict(regex=r'.*_1Warp$', ext='nii.gz'))
+            itf.set_static_input(label='tfmat', input_path=ref_path,
+                                 idx=0, filter_dict=dict(ext='mat'))
+        elif method == 'afni':
+            itf.set_static_input(label='base', input_path=ref_path,
+                                 idx=0, filter_dict=dict(ext='nii.gz'))
+            itf.set_static_input(label='tfmat', input_path=ref_path,
+                                 idx=0, filter_dict=dict(ext='aff12.1D'))
+        else:
+            raise ValueError('method must be "ants" or "afni".')
+        itf.set_static_input(label='tfcoreg', input_path=coreg_path,
+                             idx=0, filter_dict=dict(ext='aff12.1D'))
+        itf.set_var(label='mem_limit', value=mem_limit)
+        itf.set_var(label='n_threads', value=n_threads)
+        itf.set_var(label='cache_dir', value=cache_dir or get_cache_dir(self, 'resampler'))
+        itf.set_func(combined_transform_func)
+        itf.set_output(label='output')
+        itf.set_output_checker(label='output')
+        itf.run()
+
+    def camri_TTest(self, input_a, regex_a, data_idx_a=1, output_filename=None, mask_path=None,
+                    clustsim=True, n_iter=1000, nn=2, seed=0, n_workers=None,
+                    input_b=None, regex_b=None, data_idx_b=1,
+                    img_ext='nii.gz', step_idx=None, sub_code=None, suffix=None):
+        """ one-sample or two-sample t-test with the cluster-size thresholds estimated by
+        sign-flipping or permutation of the residuals, native alternative of afni_TTest.
+        The output, residuals and cluster threshold table ('.CSim.NN<nn>_bisided.1D') are stored in the step folder.
+        Args:
+            input_a(str):           datatype or stepcode of input data of group A
+            regex_a(str):           regular express pattern to filter group A
+            input_b(str):           datatype or stepcode of input data of group B
+            regex_b(str):           regular express pattern to filter group B
+            output_filename(str):   output filename
+            mask_path(str):         path for brain mask image
+            data_idx_a(int):        index of sub-brick wants to input for group A
+            data_idx_b(int):        index of sub-brick wants to input for group B
+            clustsim(bool):         estimate the cluster-size thresholds if True
+            n_iter(int):            number of null samples for the cluster-size thresholds
+            nn(int):                connectivity of the clusters, 1 (faces), 2 (edges) or 3 (corners)
+            seed(int):              random seed of the null samples
+            n_workers(int):         number of worker processes for the null samples
+            img_ext(str):           file extension (default='nii.gz')
+            step_idx(int):          stepcode index (positive integer lower than 99)
+            sub_code(str):          sub stepcode, one character, 0 or A-Z
+            suffix(str):            suffix to identify the current step
+        """
+        from .funcs import ttest_func
+        if n_workers is None:
+            itf = InterfaceBuilder(self)
+        else:
+            itf = InterfaceBuilder(self, n_threads=1)
+        if input_b is None:
+            title = 'OneSampleTTest'
+        else:
+            title = 'TwoSampleTTest'
+        itf.init_step(title=title, mode='reporting', type='python',
+                      idx=step_idx, subcode=sub_code, suffix=suffix)
+        itf.set_input(label='groupA', input_path=input_a, group_input=True, join_modifier=False,
+                      filter_dict=dict(regex=regex_a, ext=img_ext))
+        if input_b is not None:
+            itf.set_input(label='groupB', input_path=input_b, group_input=True, join_modifier=False,
+                          filter_dict=dict(regex=regex_b, ext=img_ext))
+        itf.set_var(label='index_a', value=data_idx_a)
+        itf.set_var(label='index_b', value=data_idx_b)
+        itf.set_var(label='mask', value=mask_path)
+        itf.set_var(label='clustsim', value=clustsim)
+        itf.set_var(label='n_iter', value=n_iter)
+        itf.set_var(label='nn', value=nn)
+        itf.set_var(label='seed', value=seed)
+        itf.set_var(label='n_workers', value=n_workers)
+        itf.set_func(ttest_func)
+        itf.set_output(label='output', modifier=output_filename, ext='nii.gz')
+        itf.set_output(label='resid', modifier=output_filename, suffix='_resid', ext='nii.gz')
+        itf.set_output_checker(label='output')
+        itf.run()
+
+    def camri_MultiVarModeling(self, input_path, regex, regex_label, subbrick_idx=1, mask_path=None,
+                               output_filename=None, bsVars=None, wsVars=None, glt_codes=None, glf_codes=None,
+                               reindex_subj_by=False, n_workers=None,
+                               img_ext='nii.gz', step_idx=None, sub_code=None, suffix=None):
+        """ Group Analysis with Multi-Variable Modeling of between-subject and within-subject variables,
+        native alternative of afni_MultiVarModeling which solves all voxels in batch without R.
+        The labels of the sub-bricks are stored next to the output ('<output_filename>.json').
+        Args:
+            input_path(str):        datatype or stepcode of input data
+            regex(raw str):         regular express pattern to filter dataset
+            regex_label(dict):      label and group number to specify columns of data table, 'Subj' is required
+            subbrick_idx(int):      index of sub-brick wants to input
+            mask_path(str):         path for brain mask image
+            output_filename(str):   output filename
+            bsVars(str):            between subject variables (e.g. 'group*sex')
+            wsVars(str):            within subject variables (e.g. 'cond')
+            glt_codes(dict):        glt codes dict(title=code, ...)
+            glf_codes(dict):        glf codes dict(title=code, ...)
+            reindex_subj_by(str):   one of between subject variable if want to reindex subject id
+            n_workers(int):         number of worker processes, the voxels are split into chunks
+            img_ext(str):           file extension (default='nii.gz')
+            step_idx(int):          stepcode index (positive integer lower than 99)
+            sub_code(str):          sub stepcode, one character, 0 or A-Z
+            suffix(str):            suffix to identify the current step
+        """
+        from .funcs import mvm_func
+        from .group import make_datatable
+        if n_workers is None:
+            itf = InterfaceBuilder(self)
+        else:
+            itf = InterfaceBuilder(self, n_threads=1)
+        itf.init_step('MultiVarModeling', mode='reporting', type='python',
+                      idx=step_idx, subcode=sub_code, suffix=suffix)
+        itf.set_input(label='input', input_path=input_path, group_input=True, join_modifier=False,
+                      filter_dict=dict(regex=regex, ext=img_ext))
+        # the group input of the function is given as single list
+        table = make_datatable(itf.get_inputs('input')[0], regex, regex_label, reindex_subj_by)
+        itf.set_var(label='table', value=dict(table))
+        itf.set_var(label='bs_vars', value=bsVars)
+        itf.set_var(label='ws_vars', value=wsVars)
+        itf.set_var(label='glt_codes', value=glt_codes)
+        itf.set_var(label='glf_codes', value=glf_codes)
+        itf.set_var(label='index', value=subbrick_idx)
+        itf.set_var(label='mask', value=mask_path)
+        itf.set_var(label='n_workers', value=n_workers)
+        itf.set_func(mvm_func)
+        itf.set_output(label='output', modifier=output_filename, ext='nii.gz')
+        itf.set_output_checker(label='output')
+        itf.run()
@@ -0,0 +1,313 @@
+import os
+import gzip
+import tempfile
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib
+from nibabel.openers import Opener
+import numpy as np
+from .scratch import get_tempdir
+
+
+def get_chunk_size(n_items, bytes_per_item, mem_limit=None):
+    """ Estimate the number of items (e.g. slices or volumes) to load at once
+        Args:
+            n_items: total number of items
+            bytes_per_item: estimated peak memory usage per item during processing
+            mem_limit: memory budget in MB, all items are returned if None
+        Returns:
+            number of items per chunk
+    """
+    if mem_limit is None:
+        return n_items
+    n_chunk = int(mem_limit * 1024 ** 2 // max(bytes_per_item, 1))
+    return int(min(max(n_chunk, 1), n_items))
+
+
+def get_slab_size(shape, bytes_per_voxel, mem_limit=None):
+    """ Estimate the number of z-slices to load at once
+        Args:
+            shape: image shape, (x, y, z, ...)
+            bytes_per_voxel: estimated peak memory usage per spatial voxel during processing
+            mem_limit: memory budget in MB, whole z-axis is returned if None
+        Returns:
+            number of z-slices per slab
+    """
+    nz = shape[2] if len(shape) > 2 else 1
+    return get_chunk_size(nz, int(np.prod(shape[:2])) * bytes_per_voxel, mem_limit)
+
+
+def iter_slabs(nz, slab_size):
+    """ Generate (start, end) index pairs along z-axis """
+    for z0 in range(0, nz, slab_size):
+        yield z0, min(z0 + slab_size, nz)
+
+
+def read_slab(nii, z0, z1):
+    """ Read z-slab through the array proxy without decoding whole image """
+    return np.asarray(nii.dataobj[:, :, z0:z1, ...])
+
+
+def iter_volumes(nii, block_size):
+    """ Read 4D image forward in blocks of volumes
+        Args:
+            nii: Nifti1Image, loaded with keep_file_open=True to avoid re-opening compressed file
+            block_size: number of volumes per block
+        Yields:
+            start index of the block and (x, y, z, n) data
+    """
+    n_vols = nii.shape[-1]
+    for t0 in range(0, n_vols, block_size):
+        yield t0, np.asarray(nii.dataobj[..., t0:min(t0 + block_size, n_vols)])
+
+
+ENV_IMAGE_CACHE = 'UNCCH_IMAGE_CACHE'
+IMAGE_CACHE_SIZE = 1024
+
+
+class ImageCache(object):
+    """ Size-bounded LRU cache of decoded images in the process
+
+    The images are keyed by the absolute path, mtime and size of the file, so that a modified file is decoded again.
+    The data is decoded once and shared by the jobs running in the process as read-only array,
+    which is intended for the images used by many jobs (e.g. masks and templates),
+    and the least recently used images are dropped when the total size exceeds the limit.
+
+    Example:
+        mask_nii = get_image_cache().load(mask_path)
+        mask_data = np.asarray(mask_nii.dataobj) != 0
+    """
+
+    def __init__(self, max_size=IMAGE_CACHE_SIZE, max_item_size=None):
+        """
+        Args:
+            max_size: memory limit in MB, nothing is cached if 0
+            max_item_size: size limit of single image in MB, the larger images are loaded without
+                           caching (default=max_size / 4)
+        """
+        self._max_bytes = int(max_size * 1024 ** 2)
+        if max_item_size is None:
+            self._max_item_bytes = self._max_bytes // 4
+        else:
+            self._max_item_bytes = min(int(max_item_size * 1024 ** 2), self._max_bytes)
+        self._images = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._key_locks = dict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    @property
+    def max_size(self):
+        return self._max_bytes / 1024 ** 2
+
+    @staticmethod
+    def get_key(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+    def load(self, path):
+        """ decoded image of the file
+            Returns:
+                Nifti1Image of which dataobj is read-only array of the scaled data
+        """
+        key = self.get_key(path)
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return self._images[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # the concurrent jobs wait for the first one instead of decoding the same file
+        with key_lock:
+            try:
+                with self._lock:
+                    if key in self._images:
+                        self.hits += 1
+                        return self._images[key]
+                    self.misses += 1
+                nii = nib.load(path)
+                if self._max_item_bytes < nii.dataobj.dtype.itemsize * int(np.prod(nii.shape)):
+                    # the estimate from the stored data type, the scaled data may be larger
+                    return nii
+                data = np.asanyarray(nii.dataobj)
+                data.flags.writeable = False
+                image = nib.Nifti1Image(data, nii.affine, nii.header)
+                self._remember(key, image)
+                return image
+            finally:
+                with self._lock:
+                    self._key_locks.pop(key, None)
+
+    def _remember(self, key, image):
+        nbytes = image.dataobj.nbytes
+        if nbytes > self._max_item_bytes:
+            return
+        with self._lock:
+            # the previous versions of the file are not used anymore
+            for old_key in [k for k in self._images if k[0] == key[0]]:
+                self._nbytes -= self._images.pop(old_key).dataobj.nbytes
+            self._images[key] = image
+            self._nbytes += nbytes
+            while self._nbytes > self._max_bytes:
+                self._nbytes -= self._images.popitem(last=False)[1].dataobj.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._nbytes = 0
+
+
+_image_cache = None
+
+
+def get_image_cache():
+    """ process-wide ImageCache instance, the memory limit in MB is taken from UNCCH_IMAGE_CACHE if set """
+    global _image_cache
+    if _image_cache is None:
+        _image_cache = ImageCache(float(os.environ.get(ENV_IMAGE_CACHE, IMAGE_CACHE_SIZE)))
+    return _image_cache
+
+
+def set_image_cache(max_size, max_item_size=None):
+    """ replace the process-wide ImageCache with the memory limit in MB, 0 to disable caching,
+    the limit is also published through the environment for the worker processes """
+    global _image_cache
+    os.environ[ENV_IMAGE_CACHE] = str(max_size)
+    _image_cache = ImageCache(max_size, max_item_size)
+    return _image_cache
+
+
+def load_image(path):
+    """ load the image shared by the jobs (e.g. mask and template) through the process-wide cache """
+    return get_image_cache().load(path)
+
+
+GZIP_BLOCK_SIZE = 16 * 1024 ** 2
+
+
+def write_gzip(src, dst, n_threads=None, compresslevel=None, block_size=GZIP_BLOCK_SIZE):
+    """ Compress the file into multi-member gzip stream, the blocks are compressed independently
+    on the threads (like pigz) and concatenated in order. The concatenated members are
+    standard gzip which can be read by AFNI, ANTs (zlib) and nibabel.
+        Args:
+            src: file path of uncompressed data
+            dst: file path for output destination (.gz)
+            n_threads: number of threads, the share of the cores granted to the job (default=1)
+            compresslevel: gzip compression level, the default level of nibabel if None
+            block_size: bytes of each member
+    """
+    n_threads = 1 if n_threads is None else max(int(n_threads), 1)
+    if compresslevel is None:
+        compresslevel = Opener.default_compresslevel
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        with ThreadPoolExecutor(n_threads) as executor:
+            # the number of blocks in flight is bounded to limit the memory usage
+            pending = deque()
+            for block in iter(lambda: fin.read(block_size), b''):
+                pending.append(executor.submit(gzip.compress, block, compresslevel))
+                if len(pending) >= 2 * n_threads:
+                    fout.write(pending.popleft().result())
+            while pending:
+                fout.write(pending.popleft().result())
+
+
+def save_image(nii, path, n_threads=None):
+    """ Save the image, '.nii.gz' is compressed by write_gzip on n_threads threads """
+    if not path.endswith('.gz'):
+        nii.to_filename(path)
+        return
+    fd, tmp_path = tempfile.mkstemp(suffix='.nii', dir=get_tempdir(os.path.dirname(path) or None))
+    os.close(fd)
+    try:
+        nii.to_filename(tmp_path)
+        write_gzip(tmp_path, path, n_threads)
+    finally:
+        os.remove(tmp_path)
+
+
+def make_header(ref_nii, shape, dtype=np.float32):
+    """ Create unscaled NIfTI header for the output data using geometry of reference image
+        Args:
+            ref_nii: reference image to copy affine and header information
+            shape: output data shape
+            dtype: data type of output
+        Returns:
+            Nifti1Header
+    """
+    header = nib.Nifti1Header.from_header(ref_nii.header)
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_slope_inter(None, None)
+    header.set_qform(ref_nii.affine)
+    header.set_sform(ref_nii.affine)
+    return header
+
+
+class SlabWriter(object):
+    """ Incremental NIfTI writer
+
+    The data is written into a memory-mapped uncompressed NIfTI file so that only
+    the slab being written has to reside in memory. If the destination is '.nii.gz',
+    the file is compressed by the threads (see write_gzip) when the writer is closed.
+    """
+
+    def __init__(self, path, header, n_threads=None):
+        """
+        Args:
+            path: file path for output destination (.nii or .nii.gz)
+            header: Nifti1Header of the output, see make_header
+            n_threads: number of threads for compression (default=1)
+        """
+        self._path = path
+        self._n_threads = n_threads
+        header = header.copy()
+        header['vox_offset'] = 0
+        shape = header.get_data_shape()
+        dtype = header.get_data_dtype()
+        if path.endswith('.gz'):
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            fd, self._tmp_path = tempfile.mkstemp(suffix='.nii',
+                                                  dir=get_tempdir(os.path.dirname(path) or None, nbytes))
+            os.close(fd)
+        else:
+            self._tmp_path = path
+
+        with open(self._tmp_path, 'wb') as f:
+            header.write_to(f)
+            offset = int(header.get_data_offset())
+            f.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+        self._data = np.memmap(self._tmp_path, dtype=dtype, mode='r+',
+                               offset=offset, shape=shape, order='F')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(discard=exc_type is not None)
+
+    def write(self, z0, z1, data):
+        """ Write z-slab [z0, z1) """
+        self._data[:, :, z0:z1, ...] = data
+
+    def write_volumes(self, t0, t1, data):
+        """ Write volumes [t0, t1) of 4D image """
+        self._data[..., t0:t1] = data
+
+    def close(self, discard=False):
+        if self._data is None:
+            return
+        self._data.flush()
+        self._data = None
+        if discard:
+            os.remove(self._tmp_path)
+        elif self._tmp_path != self._path:
+            try:
+                write_gzip(self._tmp_path, self._path, self._n_threads)
+            finally:
+                os.remove(self._tmp_path)
@@ -0,0 +1,148 @@
+import os
+import sys
+import ast
+import warnings
+import multiprocessing as mp
+import numpy as np
+
+# numpy views on shared buffers, populated in each worker process by the pool initializer
+_worker_arrays = dict()
+# guard of the main scripts, keyed by the path
+_main_guards = dict()
+
+
+def get_context():
+    """ start method of the workers, the pools are created from the job threads of the pipeline,
+    forking the multi-threaded process can deadlock the workers on the locks held by the other threads """
+    if 'forkserver' not in mp.get_all_start_methods():
+        return mp.get_context('spawn')
+    context = mp.get_context('forkserver')
+    # the server imports this package instead of the main script, so that the script is not
+    # executed again in the server, the task functions are imported by their modules
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def _is_main_test(node):
+    """ True if the node is the test of __name__ == '__main__' """
+    if not isinstance(node, ast.Compare) or len(node.ops) != 1 or not isinstance(node.ops[0], ast.Eq):
+        return False
+    operands = [node.left, node.comparators[0]]
+    names = [o.id for o in operands if isinstance(o, ast.Name)]
+    # the string literal is ast.Str before python 3.8
+    values = [getattr(o, 'value', getattr(o, 's', None)) for o in operands if not isinstance(o, ast.Name)]
+    return names == ['__name__'] and values == ['__main__']
+
+
+def is_main_guarded():
+    """ check if the main script guards its entry point by "if __name__ == '__main__':",
+    the workers started by forkserver or spawn import the main script, which runs the pipeline
+    again in every worker if it is not guarded. The interactive sessions are regarded as guarded.
+    """
+    path = getattr(sys.modules.get('__main__'), '__file__', None)
+    if path is None or not os.path.isfile(path):
+        return True
+    if path not in _main_guards:
+        try:
+            with open(path, 'rb') as f:
+                tree = ast.parse(f.read())
+            _main_guards[path] = any(isinstance(node, ast.If) and _is_main_test(node.test) for node in tree.body)
+        except (IOError, OSError, SyntaxError, ValueError):
+            _main_guards[path] = False
+    return _main_guards[path]
+
+
+def _as_array(spec):
+    raw, dtype, shape = spec
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _init_worker(specs):
+    _worker_arrays.clear()
+    for label, spec in specs.items():
+        _worker_arrays[label] = _as_array(spec)
+
+
+def _call_task(args):
+    func, task = args
+    return func(_worker_arrays, task)
+
+
+def split_chunks(n, n_chunks):
+    """ Split range(n) into contiguous (start, end) chunks
+        Args:
+            n: number of items
+            n_chunks: number of chunks
+        Returns:
+            list of (start, end) pairs, empty chunks are dropped
+    """
+    bounds = np.linspace(0, n, max(int(n_chunks), 1) + 1).astype(int)
+    return [(int(s), int(e)) for s, e in zip(bounds[:-1], bounds[1:]) if e > s]
+
+
+class SharedPool(object):
+    """ Process pool that works on numpy buffers placed in shared memory
+
+    The buffers are allocated once and passed to the workers at start-up,
+    so only the task descriptions (e.g. chunk indices) are pickled for each call.
+    A task function must be defined at module level and take (arrays, task) as
+    arguments, where arrays is the dict of shared numpy arrays.
+    The workers are started by forkserver (spawn if not available, see get_context),
+    which import the main script, so the script running the pipeline must guard its entry point by
+    "if __name__ == '__main__':". If the guard is not found (see is_main_guarded), the tasks are
+    executed in the calling process with a warning instead of starting the workers.
+
+    Example:
+        with SharedPool(4, input=((n, t), np.float64)) as pool:
+            pool['input'][:] = data
+            pool.map(func, [(s, e) for s, e in split_chunks(n, 16)])
+    """
+
+    def __init__(self, n_workers, **buffers):
+        """
+        Args:
+            n_workers: number of worker processes
+            buffers: label=(shape, dtype) of the shared buffers
+        """
+        self._n_workers = max(int(n_workers), 1)
+        if self._n_workers > 1 and not is_main_guarded():
+            warnings.warn('the worker processes are not started since the main script is not guarded by '
+                          '"if __name__ == \'__main__\':", the tasks are executed in the calling process.')
+            self._n_workers = 1
+        context = get_context()
+        specs = dict()
+        for label, (shape, dtype) in buffers.items():
+            dtype = np.dtype(dtype)
+            shape = tuple(int(s) for s in shape)
+            raw = context.RawArray('b', max(int(np.prod(shape)) * dtype.itemsize, 1))
+            specs[label] = (raw, dtype.str, shape)
+        self._arrays = {label: _as_array(spec) for label, spec in specs.items()}
+        if self._n_workers > 1:
+            self._pool = context.Pool(self._n_workers, initializer=_init_worker, initargs=(specs,))
+        else:
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getitem__(self, label):
+        return self._arrays[label]
+
+    @property
+    def n_workers(self):
+        return self._n_workers
+
+    def map(self, func, tasks):
+        """ Execute func(arrays, task) for each task, results are returned in order """
+        if self._pool is None:
+            return [func(self._arrays, task) for task in tasks]
+        return self._pool.map(_call_task, [(func, task) for task in tasks])
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
@@ -0,0 +1,132 @@
+""" Voxel-wise preprocessing kernels for the native functions """
+import numpy as np
+
+TPATTERN_ALIASES = {'altplus': 'alt+z', 'altminus': 'alt-z',
+                    'seqplus': 'seq+z', 'seqminus': 'seq-z',
+                    'simult': 'zero'}
+
+
+def slice_order(tpattern, n_slices):
+    """ acquisition order of slices for 3dTshift's tpattern
+        Args:
+            tpattern: alt+z(altplus), alt+z2, alt-z(altminus), alt-z2, seq+z(seqplus), seq-z(seqminus), zero
+            n_slices: number of slices
+        Returns:
+            list of slice indices in acquisition order, None for 'zero'
+    """
+    tpattern = TPATTERN_ALIASES.get(tpattern, tpattern)
+    indices = list(range(n_slices))
+    if tpattern == 'alt+z':
+        return indices[0::2] + indices[1::2]
+    elif tpattern == 'alt+z2':
+        return indices[1::2] + indices[0::2]
+    elif tpattern == 'alt-z':
+        return indices[::-1][0::2] + indices[::-1][1::2]
+    elif tpattern == 'alt-z2':
+        return indices[::-1][1::2] + indices[::-1][0::2]
+    elif tpattern == 'seq+z':
+        return indices
+    elif tpattern == 'seq-z':
+        return indices[::-1]
+    elif tpattern == 'zero':
+        return None
+    raise ValueError('unknown tpattern "{}".'.format(tpattern))
+
+
+def slice_offsets(tpattern, n_slices, tr):
+    """ acquisition time offset of each slice in second """
+    offsets = np.zeros(n_slices)
+    order = slice_order(tpattern, n_slices)
+    if order is not None:
+        offsets[order] = np.arange(n_slices) * tr / n_slices
+    return offsets
+
+
+def fourier_shift(data, shift):
+    """ shift (..., T) time series along the last axis by fractional number of samples
+    using Fourier interpolation, the result at n is the value of input at n + shift.
+    The linear trend is removed before shifting and restored at the shifted time points,
+    and the series is extended symmetrically to avoid wrap-around at the edges.
+    """
+    n_vols = data.shape[-1]
+    t = np.arange(n_vols, dtype=np.float64)
+    t_centered = t - t.mean()
+    data = np.asarray(data, dtype=np.float64)
+    mean = data.mean(-1, keepdims=True)
+    slope = (data * t_centered).sum(-1, keepdims=True) / (t_centered ** 2).sum()
+    resid = data - mean - slope * t_centered
+
+    extended = np.concatenate([resid, resid[..., ::-1]], axis=-1)
+    freqs = np.fft.rfftfreq(extended.shape[-1])
+    spectrum = np.fft.rfft(extended, axis=-1) * np.exp(2j * np.pi * freqs * shift)
+    shifted = np.fft.irfft(spectrum, n=extended.shape[-1], axis=-1)[..., :n_vols]
+    return shifted + mean + slope * (t_centered + shift)
+
+
+def fwhm_to_sigma(fwhm, pixdim):
+    """ convert FWHM in mm to the standard deviation of Gaussian kernel in voxels for each axis """
+    return [fwhm / np.sqrt(8 * np.log(2)) / float(d) for d in pixdim]
+
+
+def gaussian_kernel(sigma, truncate=4.0):
+    """ normalized 1D Gaussian kernel truncated at given number of standard deviations """
+    if sigma <= 0:
+        return np.ones(1)
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def _blur(data, kernels):
+    from scipy.ndimage import correlate1d
+    for axis, kernel in enumerate(kernels):
+        if kernel.size > 1:
+            data = correlate1d(data, kernel, axis=axis, mode='constant', cval=0)
+    return data
+
+
+def blur(data, kernels):
+    """ separable Gaussian smoothing of the whole volume, the voxels beyond the edges are
+    regarded as 0, the same as 3dmerge -1blur_fwhm does
+        Args:
+            data: (x, y, z, ...) data, all volumes are smoothed at once
+            kernels: list of 1D kernels for x, y and z axis
+        Returns:
+            smoothed data in float64
+    """
+    return _blur(np.asarray(data, dtype=np.float64), kernels)
+
+
+def blur_weights(mask, kernels):
+    """ sum of the kernel weights falling inside the mask at each voxel, the normalization
+    factor of in-mask smoothing, voxels outside the mask are set to 0
+        Args:
+            mask: (x, y, z) binary mask
+            kernels: list of 1D kernels for x, y and z axis
+        Returns:
+            (x, y, z) float64 array
+    """
+    mask = np.asarray(mask, dtype=np.float64)
+    weights = _blur(mask, kernels)
+    weights[mask == 0] = 0
+    return weights
+
+
+def blur_in_mask(data, mask, weights, kernels):
+    """ separable Gaussian smoothing restricted to the mask, the contributions of the voxels
+    outside the mask are excluded and the kernel is re-normalized by the weights,
+    the same as 3dBlurInMask does
+        Args:
+            data: (x, y, z, ...) data, all volumes are smoothed at once
+            mask: (x, y, z) binary mask
+            weights: normalization factor from blur_weights
+            kernels: list of 1D kernels for x, y and z axis
+        Returns:
+            smoothed data in float64, 0 outside the mask
+    """
+    extra = (1,) * (data.ndim - 3)
+    mask = np.asarray(mask, dtype=np.float64).reshape(mask.shape + extra)
+    blurred = _blur(np.asarray(data, dtype=np.float64) * mask, kernels)
+    weights = weights.reshape(weights.shape + extra)
+    return np.divide(blurred, weights, out=np.zeros(blurred.shape), where=weights > 0)
@@ -0,0 +1,158 @@
+""" Scratch space for the temporary files on fast local storage
+
+The temporary files of the steps (set_temporary) and the native functions (working arrays,
+uncompressed images before compression) are placed under the session folder of the scratch root
+(e.g. node-local NVMe or /dev/shm) instead of the project folder on the shared file system.
+The session folder is removed when the process exits, and the folders left by the processes
+no longer running are removed when a new session starts. If the usage of the scratch root exceeds
+the quota, the temporary files are placed at their default location.
+
+The session is also published through the environment (UNCCH_SCRATCH, UNCCH_SCRATCH_QUOTA and TMPDIR)
+so that the worker processes and the command line tools use the same scratch space.
+"""
+import os
+import socket
+import shutil
+import atexit
+import tempfile
+
+ENV_SCRATCH = 'UNCCH_SCRATCH'
+ENV_QUOTA = 'UNCCH_SCRATCH_QUOTA'
+SESSION_PREFIX = 'uncch-'
+
+
+def get_usage(path):
+    """ bytes allocated by the files under the folder """
+    usage = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                stat = os.lstat(os.path.join(root, f))
+            except OSError:
+                # removed while walking
+                continue
+            # memory-mapped working files are sparse until written
+            usage += min(stat.st_size, getattr(stat, 'st_blocks', stat.st_size // 512 + 1) * 512)
+    return usage
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def has_room(root, quota, nbytes=0):
+    """ check if nbytes can be added to the scratch root within the quota in MB """
+    if quota is None:
+        return True
+    return get_usage(root) + nbytes <= quota * 1024 ** 2
+
+
+def get_tempdir(default=None, nbytes=0):
+    """ folder for the temporary file of the native functions
+        Args:
+            default: folder used if the scratch space is not set or its quota is exceeded
+            nbytes: expected size of the temporary file
+        Returns:
+            path of the folder
+    """
+    path = os.environ.get(ENV_SCRATCH)
+    if path is None or not os.path.isdir(path):
+        return default
+    quota = os.environ.get(ENV_QUOTA)
+    if not has_room(os.path.dirname(path), None if quota is None else float(quota), nbytes):
+        return default
+    return path
+
+
+class ScratchSpace(object):
+    """ Session folder of the process under the scratch root
+
+    Example:
+        scratch = ScratchSpace('/dev/shm', quota=8192)
+        path = scratch.step_path('03A_SkullStripping')
+        ...
+        scratch.remove('03A_SkullStripping')
+    """
+
+    def __init__(self, root, quota=None, keep=False):
+        """
+        Args:
+            root: scratch root folder (e.g. node-local NVMe or /dev/shm)
+            quota: maximum usage of the scratch root in MB, no limit if None
+            keep: keep the session folder when the process exits (for debugging)
+        """
+        self._root = os.path.abspath(root)
+        self._quota = quota
+        self._keep = keep
+        os.makedirs(self._root, exist_ok=True)
+        self.clean_stale()
+        prefix = '{}{}@{}-'.format(SESSION_PREFIX, os.getpid(), socket.gethostname())
+        self._path = tempfile.mkdtemp(prefix=prefix, dir=self._root)
+        atexit.register(self.cleanup)
+
+    @property
+    def root(self):
+        return self._root
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def quota(self):
+        return self._quota
+
+    @property
+    def keep(self):
+        return self._keep
+
+    def usage(self):
+        """ bytes used in the scratch root, including the other sessions """
+        return get_usage(self._root)
+
+    def has_room(self, nbytes=0):
+        return has_room(self._root, self._quota, nbytes)
+
+    def step_path(self, *names):
+        return os.path.join(self._path, *names)
+
+    def remove(self, *names):
+        """ remove the folder of the session, e.g. temporary folder of the step """
+        shutil.rmtree(self.step_path(*names), ignore_errors=True)
+
+    def publish(self):
+        """ set the environment for the native functions, the worker processes and the command line tools """
+        os.environ[ENV_SCRATCH] = self._path
+        if self._quota is not None:
+            os.environ[ENV_QUOTA] = str(self._quota)
+        else:
+            os.environ.pop(ENV_QUOTA, None)
+        os.environ['TMPDIR'] = self._path
+        tempfile.tempdir = None
+
+    def cleanup(self):
+        if self._keep:
+            return
+        shutil.rmtree(self._path, ignore_errors=True)
+        if os.environ.get(ENV_SCRATCH) == self._path:
+            os.environ.pop(ENV_SCRATCH, None)
+
+    def clean_stale(self):
+        """ remove the session folders of the processes on this host which are not running """
+        hostname = socket.gethostname()
+        for name in os.listdir(self._root):
+            if not name.startswith(SESSION_PREFIX):
+                continue
+            pid, _, host = name[len(SESSION_PREFIX):].rpartition('-')[0].partition('@')
+            try:
+                pid = int(pid)
+            except ValueError:
+                continue
+            if host == hostname and pid != os.getpid() and not _is_running(pid):
+                shutil.rmtree(os.path.join(self._root, name), ignore_errors=True)
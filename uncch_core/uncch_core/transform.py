@@ -0,0 +1,336 @@
+""" Spatial transforms of AFNI and ANTs in the common physical space
+
+The points are handled in DICOM/LPS millimeter coordinates, which is the space of both
+the 3dAllineate matrix (.aff12.1D) and the ITK transforms of ANTs (.mat, _1Warp.nii.gz),
+while NIfTI affine maps the voxel indices into RAS coordinates.
+Each transform maps the points of the output (fixed, base) space into the points of the
+input (moving, source) space, so a chain of transforms is applied to the points in the
+order from the output to the input space.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+import nibabel as nib
+
+RAS_TO_LPS = np.diag([-1., -1., 1., 1.])
+
+
+def read_afni_matrix(path):
+    """ read 3dAllineate matrix saved by -1Dmatrix_save, the first row is used if multiple rows exist
+        Returns:
+            4x4 affine matrix of LPS coordinates, maps the points of base to source
+    """
+    values = np.atleast_2d(np.loadtxt(path, comments='#'))[0, :12]
+    return np.vstack([values.reshape(3, 4), [0, 0, 0, 1]])
+
+
+def read_ants_affine(path):
+    """ read affine transform of ANTs (e.g. _0GenericAffine.mat)
+        Returns:
+            4x4 affine matrix of LPS coordinates, maps the points of fixed to moving
+    """
+    from scipy.io import loadmat
+    mat = loadmat(path)
+    params = [v for k, v in mat.items() if k.startswith('AffineTransform')][0].ravel()
+    center = mat['fixed'].ravel()
+    matrix = params[:9].reshape(3, 3)
+    affine = np.eye(4)
+    affine[:3, :3] = matrix
+    affine[:3, 3] = params[9:12] + center - matrix.dot(center)
+    return affine
+
+
+class DisplacementField(object):
+    """ Displacement field of ANTs (e.g. _1Warp.nii.gz), maps the points of fixed to moving """
+
+    def __init__(self, path):
+        nii = nib.load(path)
+        self._field = np.asarray(nii.dataobj, dtype=np.float32).reshape(nii.shape[:3] + (3,))
+        self._affine = nii.affine
+        self._to_voxel = np.linalg.inv(RAS_TO_LPS.dot(nii.affine))
+
+    @property
+    def shape(self):
+        return self._field.shape[:3]
+
+    @property
+    def affine(self):
+        return self._affine
+
+    def __call__(self, points):
+        """ displace (3, n) LPS points """
+        from scipy.ndimage import map_coordinates
+        voxels = self._to_voxel[:3, :3].dot(points) + self._to_voxel[:3, 3:]
+        displacement = np.stack([map_coordinates(self._field[..., i], voxels, order=1,
+                                                 mode='nearest', prefilter=False)
+                                 for i in range(3)])
+        return points + displacement
+
+
+def transform_points(points, transforms):
+    """ apply the chain of transforms to (3, n) LPS points
+        Args:
+            points: (3, n) array
+            transforms: list of 4x4 affine matrices or callables (e.g. DisplacementField),
+                        applied in the given order
+        Returns:
+            (3, n) array
+    """
+    for transform in transforms:
+        if callable(transform):
+            points = transform(points)
+        else:
+            points = transform[:3, :3].dot(points) + transform[:3, 3:]
+    return points
+
+
+def sampling_coordinates(ref_affine, ref_shape, src_affine, transforms, z0=0, z1=None):
+    """ voxel coordinates of the source image to sample for each voxel of the reference grid
+        Args:
+            ref_affine: NIfTI affine of the output grid
+            ref_shape: (x, y, z) shape of the output grid
+            src_affine: NIfTI affine of the source image
+            transforms: chain of transforms from the output to the source space
+            z0, z1: z-range of the output grid to compute
+        Returns:
+            (3, n) float32 array, in the order of (x, y, z) voxels of the output grid (C order)
+    """
+    z1 = ref_shape[2] if z1 is None else z1
+    grid = np.mgrid[:ref_shape[0], :ref_shape[1], z0:z1].reshape(3, -1).astype(np.float64)
+    to_lps = RAS_TO_LPS.dot(ref_affine)
+    points = to_lps[:3, :3].dot(grid) + to_lps[:3, 3:]
+    points = transform_points(points, transforms)
+    to_voxel = np.linalg.inv(RAS_TO_LPS.dot(src_affine))
+    return (to_voxel[:3, :3].dot(points) + to_voxel[:3, 3:]).astype(np.float32)
+
+
+class Resampler(object):
+    """ Trilinear resampling onto the output grid with precomputed neighbours and weights
+
+    The sampling coordinates are reduced to the flat index of the lower corner of the source voxel
+    cell and the fractional offsets, for the output voxels inside the source image (the others are 0,
+    same as map_coordinates with order=1 and mode='constant'), so that the transforms are evaluated
+    once and applied to any number of volumes by gathering the (n_voxels, n_volumes) rows.
+    """
+
+    def __init__(self, grid_shape, src_shape, valid, corner, frac):
+        """
+        Args:
+            grid_shape: (x, y, z) shape of the output grid
+            src_shape: (x, y, z) shape of the source image
+            valid: flat indices (C order) of the output voxels inside the source image
+            corner: flat indices (C order) of the lower corner in the source image for the valid voxels
+            frac: (3, n) fractional offsets from the lower corner
+        """
+        self._grid_shape = tuple(int(s) for s in grid_shape)
+        self._src_shape = tuple(int(s) for s in src_shape)
+        self._valid = np.asarray(valid, dtype=np.int64)
+        self._corner = np.asarray(corner, dtype=np.int64)
+        self._frac = np.asarray(frac, dtype=np.float32)
+        strides = np.cumprod((1,) + self._src_shape[::-1])[:3][::-1]
+        # neighbours along the axis of single voxel collapse into the corner
+        self._strides = [int(st) if n > 1 else 0 for st, n in zip(strides, self._src_shape)]
+
+    @classmethod
+    def from_coordinates(cls, coords, grid_shape, src_shape):
+        """ create from (3, n) voxel coordinates of the source image (see sampling_coordinates) """
+        coords = np.asarray(coords, dtype=np.float64)
+        upper = np.asarray(src_shape[:3], dtype=np.float64).reshape(3, 1) - 1
+        valid = np.flatnonzero(np.all((coords >= 0) & (coords <= upper), axis=0))
+        coords = coords[:, valid]
+        lower = np.minimum(np.floor(coords), np.maximum(upper - 1, 0)).astype(np.int64)
+        corner = np.ravel_multi_index(tuple(lower), tuple(src_shape[:3]))
+        return cls(grid_shape, src_shape, valid, corner, coords - lower)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['grid_shape'], arrays['src_shape'], arrays['valid'], arrays['corner'], arrays['frac'])
+
+    def to_arrays(self):
+        return dict(grid_shape=np.asarray(self._grid_shape), src_shape=np.asarray(self._src_shape),
+                    valid=self._valid, corner=self._corner, frac=self._frac)
+
+    @property
+    def grid_shape(self):
+        return self._grid_shape
+
+    @property
+    def src_shape(self):
+        return self._src_shape
+
+    @property
+    def nbytes(self):
+        return self._valid.nbytes + self._corner.nbytes + self._frac.nbytes
+
+    def apply(self, data):
+        """ resample the source data
+            Args:
+                data: (x, y, z) volume or (x, y, z, n) block of volumes of the source image
+            Returns:
+                float32 array of (x, y, z) or (x, y, z, n) on the output grid
+        """
+        extra = data.shape[3:]
+        n_vols = int(np.prod(extra))
+        rows = np.ascontiguousarray(data, dtype=np.float32).reshape(-1, n_vols)
+        result = np.zeros((len(self._valid), n_vols), dtype=np.float32)
+        fx, fy, fz = self._frac
+        for dx in (0, 1):
+            wx = fx if dx else 1 - fx
+            for dy in (0, 1):
+                wy = wx * (fy if dy else 1 - fy)
+                for dz in (0, 1):
+                    weight = wy * (fz if dz else 1 - fz)
+                    offset = dx * self._strides[0] + dy * self._strides[1] + dz * self._strides[2]
+                    result += rows[self._corner + offset] * weight[:, np.newaxis]
+        output = np.zeros((int(np.prod(self._grid_shape)), n_vols), dtype=np.float32)
+        output[self._valid] = result
+        return output.reshape(self._grid_shape + extra)
+
+
+class ResamplerCache(object):
+    """ Persistent cache of Resamplers
+
+    The resamplers are keyed by the fingerprints of the transform files and the geometry of
+    the output grid and the source image, so the runs of a subject sharing the same transforms
+    evaluate the displacement field and the affine transforms only once, even when the runs are
+    processed by separate jobs. The recently used resamplers are kept in memory as well,
+    and the least recently used files are removed when the number of entries exceeds max_entries.
+    """
+
+    def __init__(self, path=None, max_entries=16, max_memory_entries=2):
+        """
+        Args:
+            path: cache directory, the resamplers are kept only in memory if None
+            max_entries: maximum number of resamplers stored on disk
+            max_memory_entries: maximum number of resamplers kept in memory
+        """
+        self._path = path
+        self._max_entries = max_entries
+        self._max_memory_entries = max_memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = dict()
+
+    @property
+    def path(self):
+        return self._path
+
+    @staticmethod
+    def get_key(transform_files, ref_nii, src_nii):
+        """ key of the transforms from the output grid of ref_nii to the source image src_nii """
+        from .cache import fingerprint
+        params = [[[os.path.abspath(f), fingerprint(f)] for f in transform_files],
+                  [list(ref_nii.shape[:3]), np.round(ref_nii.affine, 6).tolist()],
+                  [list(src_nii.shape[:3]), np.round(src_nii.affine, 6).tolist()]]
+        return hashlib.sha1(json.dumps(params).encode('utf-8')).hexdigest()
+
+    def _filepath(self, key):
+        return os.path.join(self._path, '{}.npz'.format(key))
+
+    def get(self, key, factory):
+        """ return cached resampler or create new one by calling factory() """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # the concurrent jobs of the same subject wait for the first one instead of repeating the setup
+        with key_lock:
+            try:
+                with self._lock:
+                    if key in self._memory:
+                        return self._memory[key]
+                filepath = None if self._path is None else self._filepath(key)
+                resampler = None
+                if filepath is not None and os.path.exists(filepath):
+                    try:
+                        with np.load(filepath) as arrays:
+                            resampler = Resampler.from_arrays(arrays)
+                        os.utime(filepath, None)
+                    except (IOError, OSError, ValueError, KeyError):
+                        resampler = None
+                if resampler is None:
+                    resampler = factory()
+                    self.save(key, resampler)
+                self._remember(key, resampler)
+                return resampler
+            finally:
+                with self._lock:
+                    self._key_locks.pop(key, None)
+
+    def _remember(self, key, resampler):
+        with self._lock:
+            self._memory[key] = resampler
+            self._memory.move_to_end(key)
+            while len(self._memory) > self._max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def save(self, key, resampler):
+        """ store resampler on disk, the file is replaced atomically """
+        if self._path is None:
+            return
+        try:
+            if not os.path.exists(self._path):
+                os.makedirs(self._path, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=self._path)
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **resampler.to_arrays())
+            os.replace(tmp_path, self._filepath(key))
+        except (IOError, OSError):
+            # caching is optional, the resampler will be regenerated next time
+            return
+        self.evict()
+
+    def evict(self):
+        """ remove least recently used entries exceeding max_entries """
+        if self._path is None:
+            return
+        try:
+            files = [os.path.join(self._path, f) for f in os.listdir(self._path) if f.endswith('.npz')]
+            files = sorted(files, key=os.path.getmtime)
+            for f in files[:max(len(files) - self._max_entries, 0)]:
+                os.remove(f)
+        except (IOError, OSError):
+            pass
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if self._path is not None and os.path.exists(self._path):
+            for f in os.listdir(self._path):
+                if f.endswith('.npz'):
+                    os.remove(os.path.join(self._path, f))
+
+
+_resampler_caches = dict()
+
+
+def get_resampler_cache(path=None):
+    """ process-wide ResamplerCache instance for the given directory """
+    if path not in _resampler_caches:
+        _resampler_caches[path] = ResamplerCache(path)
+    return _resampler_caches[path]
+
+
+def get_resampler(ref_nii, src_nii, transform_files, load_transforms, cache_dir=None):
+    """ resampler from the output grid of ref_nii to the source image through the transforms
+        Args:
+            ref_nii: image defining the output grid
+            src_nii: source image (only the header is used)
+            transform_files: list of file paths of the transforms, used as the key of the cache
+            load_transforms: callable that returns the chain of transforms (see transform_points)
+            cache_dir: directory of resampler cache, kept only in memory if None
+        Returns:
+            Resampler
+    """
+    cache = get_resampler_cache(cache_dir)
+    key = cache.get_key(transform_files, ref_nii, src_nii)
+
+    def factory():
+        coords = sampling_coordinates(ref_nii.affine, ref_nii.shape[:3], src_nii.affine, load_transforms())
+        return Resampler.from_coordinates(coords, ref_nii.shape[:3], src_nii.shape[:3])
+    return cache.get(key, factory)